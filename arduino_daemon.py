@@ -0,0 +1,278 @@
+import itertools
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+
+from pipeline import BuildCancelled, BuildError
+
+# Постоянный процесс arduino-cli на сессию вместо процесса на каждую команду. Настройки, индексы
+# пакетов и ядро загружаются один раз при создании экземпляра, дальше board list, compile и upload -
+# запросы к уже готовому процессу. Подходит BuildPipeline(backend=...) вместо pipeline.CliBackend
+DAEMON_START_TIMEOUT = 30
+BOARD_LIST_TIMEOUT_MS = 1000
+GRPC_MODULES_HINT = ("Для arduino-cli daemon нужны grpcio и модули cc.arduino.cli.commands.v1, "
+                     "сгенерированные grpc_tools.protoc из rpc/ в исходниках arduino-cli")
+
+
+def daemon_available():
+    """Есть ли grpcio и модули протокола arduino-cli, без которых DaemonBackend не запустится."""
+    try:
+        import grpc  # noqa: F401
+        from cc.arduino.cli.commands.v1 import commands_pb2_grpc  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _parse_cli_args(args):
+    """Разбирает аргументы, которые формирует BuildPipeline: {опция: [значения]} и путь к скетчу."""
+    options = {}
+    positional = []
+    rest = iter(args[1:])
+    for arg in rest:
+        if arg.startswith("--"):
+            options.setdefault(arg, []).append(next(rest))
+        else:
+            positional.append(arg)
+    return options, positional
+
+
+class _LineSplitter:
+    """Собирает строки из кусков вывода, которые daemon присылает без привязки к концам строк."""
+
+    def __init__(self, on_line, output):
+        self.on_line = on_line
+        self.output = output
+        self.tail = ""
+
+    def feed(self, chunk):
+        *lines, self.tail = (self.tail + chunk.decode("utf-8", errors="replace")).split("\n")
+        for line in lines:
+            self.emit(line.rstrip("\r"))
+
+    def emit(self, line):
+        self.output.append(line)
+        self.on_line(line)
+
+    def close(self):
+        if self.tail:
+            self.emit(self.tail.rstrip("\r"))
+            self.tail = ""
+
+
+class DaemonBackend:
+    """
+    arduino-cli daemon: процесс запускается при первой команде, экземпляр создаётся и инициализируется
+    один раз и переиспользуется всеми сборками сессии. Команды из разных потоков выполняются
+    параллельно, как и в CliBackend. Если daemon завершился, следующая команда запустит его заново.
+    """
+
+    def __init__(self, cli_command):
+        self.cli_command = [cli_command] if isinstance(cli_command, str) else list(cli_command)
+        self._lock = threading.Lock()
+        self._process = None
+        self._channel = None
+        self._client = None
+        self._instance = None
+
+    def _start(self):
+        with self._lock:
+            if self._client is not None:
+                return self._client, self._instance
+            try:
+                import grpc
+                from cc.arduino.cli.commands.v1 import commands_pb2, commands_pb2_grpc
+            except ImportError:
+                raise BuildError(GRPC_MODULES_HINT)
+
+            process = subprocess.Popen(self.cli_command + ["daemon", "--port", "0", "--format", "json"],
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       text=True, encoding="utf-8", errors="replace")
+            try:
+                # Первая строка - адрес, на котором daemon слушает: {"IP": "127.0.0.1", "Port": "50051"}
+                address = json.loads(process.stdout.readline() or "{}")
+                if "Port" not in address:
+                    raise BuildError("arduino-cli daemon не сообщил порт")
+                threading.Thread(target=lambda: process.stdout.read(), daemon=True).start()
+                channel = grpc.insecure_channel(f"{address.get('IP', '127.0.0.1')}:{address['Port']}")
+                grpc.channel_ready_future(channel).result(timeout=DAEMON_START_TIMEOUT)
+                client = commands_pb2_grpc.ArduinoCoreServiceStub(channel)
+                instance = client.Create(commands_pb2.CreateRequest()).instance
+                for response in client.Init(commands_pb2.InitRequest(instance=instance)):
+                    if response.WhichOneof("message") == "error":
+                        raise BuildError(f"arduino-cli daemon: {response.error.message}")
+            except BaseException:
+                process.terminate()
+                process.wait()
+                raise
+            self._process, self._channel, self._client, self._instance = process, channel, client, instance
+            return client, instance
+
+    def run(self, args, on_line, cancel_event):
+        """Выполняет compile или upload с аргументами командной строки arduino-cli."""
+        # _start() первым: без grpcio он сообщает, что установить, а не ImportError
+        client, instance = self._start()
+        import grpc
+        from cc.arduino.cli.commands.v1 import compile_pb2, port_pb2, upload_pb2
+
+        options, positional = _parse_cli_args(args)
+
+        def option(name):
+            return options.get(name, [""])[-1]
+
+        sketch_path = os.path.abspath(positional[-1])
+        if args[0] == "compile":
+            call = client.Compile(compile_pb2.CompileRequest(
+                instance=instance, fqbn=option("--fqbn"), sketch_path=sketch_path,
+                build_path=os.path.abspath(option("--build-path")) if "--build-path" in options else "",
+                build_cache_path=option("--build-cache-path"), export_dir=option("--output-dir"),
+                libraries=options.get("--libraries", []), build_properties=options.get("--build-property", [])))
+        elif args[0] == "upload":
+            call = client.Upload(upload_pb2.UploadRequest(
+                instance=instance, fqbn=option("--fqbn"), sketch_path=sketch_path,
+                port=port_pb2.Port(address=option("--port"), protocol="serial"), import_dir=option("--input-dir"),
+                upload_properties=options.get("--upload-property", [])))
+        else:
+            raise BuildError(f"arduino-cli daemon: команда {args[0]} не поддерживается")
+
+        output = []
+        splitter = _LineSplitter(on_line, output)
+        finished = threading.Event()
+
+        def cancel_on_request():
+            while not finished.wait(0.1):
+                if cancel_event.is_set():
+                    call.cancel()
+                    return
+
+        threading.Thread(target=cancel_on_request, daemon=True).start()
+        try:
+            for response in call:
+                splitter.feed(response.out_stream)
+                splitter.feed(response.err_stream)
+        except grpc.RpcError as e:
+            splitter.close()
+            if e.code() == grpc.StatusCode.CANCELLED and cancel_event.is_set():
+                raise BuildCancelled()
+            if e.code() == grpc.StatusCode.UNAVAILABLE:
+                self.close()
+            raise BuildError("\n".join(output[-20:] + [e.details() or str(e.code())]))
+        finally:
+            finished.set()
+        splitter.close()
+        return output
+
+    def board_list(self):
+        """Платы в том же виде, что board list --format json."""
+        client, instance = self._start()
+        from cc.arduino.cli.commands.v1 import board_pb2
+
+        response = client.BoardList(board_pb2.BoardListRequest(instance=instance, timeout=BOARD_LIST_TIMEOUT_MS))
+        return {"detected_ports": [
+            {"port": {"address": detected.port.address, "properties": dict(detected.port.properties)},
+             "matching_boards": [{"fqbn": board.fqbn} for board in detected.matching_boards]}
+            for detected in response.ports]}
+
+    def close(self):
+        with self._lock:
+            if self._channel is not None:
+                self._channel.close()
+            if self._process is not None:
+                self._process.terminate()
+                self._process.wait()
+            self._process = self._channel = self._client = self._instance = None
+
+
+class StubDaemonBackend:
+    """
+    Постоянный процесс заменителя (stub_arduino_cli.py daemon) для проверки и бенчмарков без arduino-cli
+    и grpcio: тот же порядок запуска и отмены, что у DaemonBackend, но команды идут строками JSON.
+    """
+
+    def __init__(self, cli_command):
+        self.cli_command = [cli_command] if isinstance(cli_command, str) else list(cli_command)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._process = None
+        self._responses = {}
+        self._ids = itertools.count()
+
+    def _start(self):
+        with self._lock:
+            if self._process is not None and self._process.poll() is None:
+                return self._process
+            process = subprocess.Popen(self.cli_command + ["daemon"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       text=True, encoding="utf-8")
+            if not json.loads(process.stdout.readline() or "{}").get("ready"):
+                process.kill()
+                raise BuildError("Заменитель arduino-cli daemon не запустился")
+            threading.Thread(target=self._read_responses, args=(process,), daemon=True).start()
+            self._process = process
+            return process
+
+    def _read_responses(self, process):
+        for line in process.stdout:
+            message = json.loads(line)
+            responses = self._responses.get(message["id"])
+            if responses is not None:
+                responses.put(message)
+        # Процесс завершился: ждущие команды получают ошибку
+        for responses in list(self._responses.values()):
+            responses.put({"exit": None})
+
+    def _send(self, process, message):
+        with self._write_lock:
+            process.stdin.write(json.dumps(message) + "\n")
+            process.stdin.flush()
+
+    def run(self, args, on_line, cancel_event):
+        process = self._start()
+        request_id = next(self._ids)
+        responses = self._responses[request_id] = queue.Queue()
+        output = []
+        cancel_sent = False
+        try:
+            self._send(process, {"id": request_id, "args": args})
+            while True:
+                if cancel_event.is_set() and not cancel_sent:
+                    self._send(process, {"id": request_id, "cancel": True})
+                    cancel_sent = True
+                try:
+                    message = responses.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if "line" in message:
+                    output.append(message["line"])
+                    on_line(message["line"])
+                    continue
+                if cancel_sent:
+                    raise BuildCancelled()
+                if message["exit"] != 0:
+                    raise BuildError("\n".join(output[-20:]) or f"arduino-cli {args[0]} завершился с ошибкой")
+                return output
+        finally:
+            self._responses.pop(request_id, None)
+
+    def board_list(self):
+        return json.loads("\n".join(self.run(["board", "list", "--format", "json"], lambda line: None,
+                                             threading.Event())) or "{}")
+
+    def close(self):
+        with self._lock:
+            if self._process is not None:
+                self._process.stdin.close()
+                self._process.wait()
+                self._process = None
+
+
+def create_daemon_backend(cli_command):
+    """Заменитель для скрипта .py (stub_arduino_cli.py), иначе настоящий arduino-cli daemon."""
+    cli_command = [cli_command] if isinstance(cli_command, str) else list(cli_command)
+    if cli_command[-1].endswith(".py"):
+        if len(cli_command) == 1:
+            cli_command.insert(0, sys.executable)
+        return StubDaemonBackend(cli_command)
+    return DaemonBackend(cli_command)
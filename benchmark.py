@@ -0,0 +1,869 @@
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from generate import (build_progmem_tables, count_action_reports, default_matrix, firmware_build_properties,
+                      generate_action_executor, generate_ino_file, generate_table_dispatch, typing_code,
+                      typing_reports, write_sketch, HOST_PENDING, TAP_HOLD_MS, TELEMETRY_FLAG, TYPING_PROFILES)
+
+FQBN = "arduino:avr:leonardo"
+F_CPU_MHZ = 16
+MODE_COUNTS = [1, 2, 4, 8, 16, 32, 64]
+DEVICE_COUNTS = [1, 2, 4, 8]
+STUB_CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_arduino_cli.py")
+MODES_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "modes.json")
+# Профиль больше, чем помещается во flash: 64 кнопки (предел маски) и до 255 режимов
+LARGE_BUTTONS = 64
+LARGE_ACTIONS = [4096, 8192, 16320]
+COMBINATIONS = ["Ctrl+C", "Ctrl+V", "Alt+F4", "Ctrl+Shift+Esc", "Win+Tab", "Ctrl+Z", "Shift+F10"]
+# Шаблон письма для печати: буквы обоих регистров, цифры, знаки с Shift, повторы букв и переводы строк
+TYPING_TEMPLATE = ("Hello {n}, your order #{n}42 (total: $1{n}.99) has shipped!\n"
+                   "Tracking: https://example.com/track?id=A{n}B&lang=en; questions -> support@example.com\n")
+
+
+def synthetic_modes(num_modes, num_buttons):
+    """Создаёт профиль из num_modes режимов с чередующимися текстами и комбинациями клавиш."""
+    modes = {}
+    for m in range(num_modes):
+        standard_buttons = {}
+        for b in range(num_buttons):
+            n = m * num_buttons + b
+            if b % 2 == 0:
+                # Часть текстов повторяется между режимами, как в реальных профилях
+                standard_buttons[f"button{b + 1}"] = {"type": "Print Text", "action": f"Snippet number {n % 17}"}
+            else:
+                standard_buttons[f"button{b + 1}"] = {"type": "Key Combination",
+                                                      "action": COMBINATIONS[n % len(COMBINATIONS)]}
+        modes[f"Mode{m + 1}"] = {
+            "standard_buttons": standard_buttons,
+            "dropdown_buttons": {"dropdown_button1": "Volume"},
+        }
+    return modes
+
+
+def open_arduino_cli():
+    """Возвращает обёртку arduino-cli или None, если инструменты не установлены."""
+    try:
+        import pyduinocli
+        from pipeline import ARDUINO_CLI_PATH
+    except ImportError:
+        return None
+    if not os.path.exists(ARDUINO_CLI_PATH):
+        return None
+
+    return pyduinocli.Arduino(ARDUINO_CLI_PATH)
+
+
+def section_sizes(compile_result):
+    """Возвращает размеры секций text (flash) и data (SRAM) из результата компиляции."""
+    sections = compile_result['result']['builder_result']['executable_sections_size']
+    sizes = {section['name']: section['size'] for section in sections}
+    return sizes.get('text'), sizes.get('data')
+
+
+def measure_loop_ns(arduino, sketch_dir, fqbn, port, timeout=10):
+    """
+    Загружает сборку с -DLOOP_BENCHMARK и читает из Serial среднее время loop() в наносекундах
+    и самый долгий проход в микросекундах. Возвращает (None, None), если плата не ответила.
+    """
+    import serial
+
+    build_dir = os.path.join(sketch_dir, "build")
+    arduino.compile(sketch=sketch_dir, fqbn=fqbn, output_dir=build_dir,
+                    build_properties=firmware_build_properties(extra_flags=["-DLOOP_BENCHMARK"]))
+    arduino.upload(sketch=sketch_dir, fqbn=fqbn, port=port, input_dir=build_dir)
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with serial.Serial(port, baudrate=115200, timeout=1) as ser:
+                loop_ns = None
+                while time.monotonic() < deadline:
+                    line = ser.readline().decode("ascii", errors="replace").strip()
+                    if line.startswith("LOOP_NS "):
+                        loop_ns = int(line.split()[1])
+                    elif line.startswith("LOOP_MAX_US ") and loop_ns is not None:
+                        return loop_ns, int(line.split()[1])
+        except serial.SerialException:
+            # После загрузки порт появляется заново не сразу
+            time.sleep(0.2)
+    return None, None
+
+
+def bench_dispatch(args):
+    """Сравнивает классы на режим и таблицу действий по размеру прошивки и времени loop()."""
+    arduino = open_arduino_cli()
+    if arduino is None:
+        print("arduino-cli не найден, измеряется только генерация")
+
+    print(f"{'layout':<8}{'modes':>6}{'generate_ms':>12}{'source':>10}{'flash':>8}{'sram':>7}"
+          f"{'loop_ns':>10}{'cycles':>9}{'max_us':>8}")
+    results = []
+    for dispatch in ("classes", "table"):
+        for num_modes in args.modes:
+            modes = synthetic_modes(num_modes, args.buttons)
+            with tempfile.TemporaryDirectory() as tmp:
+                sketch_dir = os.path.join(tmp, "kurs")
+                os.makedirs(sketch_dir)
+                sketch_path = os.path.join(sketch_dir, "kurs.ino")
+
+                start = time.perf_counter()
+                generate_ino_file(modes, args.buttons, 1, dispatch=dispatch, output_filename=sketch_path)
+                row = {
+                    "dispatch": dispatch,
+                    "modes": num_modes,
+                    "generate_ms": round((time.perf_counter() - start) * 1000, 2),
+                    "source_bytes": os.path.getsize(sketch_path),
+                    "flash": None,
+                    "sram": None,
+                    "loop_ns": None,
+                    "loop_max_us": None,
+                }
+                if arduino is not None:
+                    compile_result = arduino.compile(sketch=sketch_dir, fqbn=args.fqbn)
+                    row["flash"], row["sram"] = section_sizes(compile_result)
+                    if args.port:
+                        row["loop_ns"], row["loop_max_us"] = measure_loop_ns(arduino, sketch_dir, args.fqbn,
+                                                                             args.port)
+            results.append(row)
+            print_row(row)
+    return results
+
+
+def print_row(row):
+    cycles = row["loop_ns"] * F_CPU_MHZ // 1000 if row["loop_ns"] else None
+    print(f"{row['dispatch']:<8}{row['modes']:>6}{row['generate_ms']:>12}{row['source_bytes']:>10}"
+          f"{str(row['flash']):>8}{str(row['sram']):>7}{str(row['loop_ns']):>10}{str(cycles):>9}"
+          f"{str(row['loop_max_us']):>8}")
+
+
+def bench_fleet(args):
+    """Сравнивает последовательную и параллельную прошивку N плат по общему времени."""
+    from firmware_cache import BuildDirectories
+    from pipeline import BuildPipeline
+    from ports import BoardPort, PortCache, list_boards
+
+    if args.real:
+        cli_path = None
+        real_boards = [board for board in list_boards() if not board.bootloader]
+        counts = [len(real_boards)]
+        print(f"Подключено плат: {len(real_boards)}")
+    else:
+        # Заменитель arduino-cli выдерживает паузу вместо загрузки; платы считаются уже в загрузчике
+        cli_path = [sys.executable, STUB_CLI]
+        os.environ["STUB_UPLOAD_SECONDS"] = str(args.upload_seconds)
+        counts = args.devices
+
+    print(f"{'devices':>8}{'sequential_s':>14}{'parallel_s':>12}{'speedup':>9}")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        sketch_dir = os.path.join(tmp, "kurs")
+        os.makedirs(sketch_dir)
+        sketch_path = os.path.join(sketch_dir, "kurs.ino")
+        generate_ino_file(synthetic_modes(4, 4), 4, 1, output_filename=sketch_path)
+
+        for count in counts:
+            if args.real:
+                boards = real_boards
+            else:
+                boards = [BoardPort(f"STUB{i}", args.fqbn, True, f"STUB{i}") for i in range(count)]
+            row = {"devices": count}
+            for name, workers in (("sequential", 1), ("parallel", None)):
+                pipeline = BuildPipeline(port_cache=PortCache(os.path.join(tmp, "ports.json")),
+                                         build_dir=os.path.join(tmp, "build"),
+                                         build_dirs=BuildDirectories(os.path.join(tmp, "build_paths"),
+                                                                     os.path.join(tmp, "core")),
+                                         metrics_path=os.path.join(tmp, "metrics.jsonl"),
+                                         **({"cli_path": cli_path} if cli_path else {}))
+                start = time.perf_counter()
+                fleet = pipeline.run_fleet(sketch_path, boards=boards, max_workers=workers)
+                row[f"{name}_s"] = round(time.perf_counter() - start, 3)
+                if not fleet.success:
+                    print(f"{name}: {fleet.error}")
+                    for device in fleet.devices:
+                        if not device.success:
+                            print(f"  {device.device}: {device.error}")
+            row["speedup"] = round(row["sequential_s"] / row["parallel_s"], 2)
+            results.append(row)
+            print(f"{row['devices']:>8}{row['sequential_s']:>14}{row['parallel_s']:>12}{row['speedup']:>9}")
+    return results
+
+
+def bench_compile(args):
+    """Время холодной и тёплых компиляций при изменении только профиля."""
+    from firmware_cache import BuildDirectories, load_compile_metrics
+    from pipeline import ARDUINO_CLI_PATH, BuildPipeline
+
+    if os.path.exists(ARDUINO_CLI_PATH) and not args.stub:
+        cli_path = ARDUINO_CLI_PATH
+    else:
+        print("Используется заменитель arduino-cli")
+        cli_path = [sys.executable, STUB_CLI]
+        os.environ.setdefault("STUB_CORE_SECONDS", "2")
+        os.environ.setdefault("STUB_COMPILE_SECONDS", "0.3")
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        sketch_dir = os.path.join(tmp, "kurs")
+        os.makedirs(sketch_dir)
+        sketch_path = os.path.join(sketch_dir, "kurs.ino")
+        metrics_path = os.path.join(tmp, "metrics.jsonl")
+        pipeline = BuildPipeline(cli_path, build_dir=os.path.join(tmp, "build"),
+                                 build_dirs=BuildDirectories(os.path.join(tmp, "build_paths"), os.path.join(tmp, "core")),
+                                 metrics_path=metrics_path)
+
+        print(f"{'build':>6}{'warm':>6}{'compile_s':>11}")
+        for build in range(args.builds):
+            # Каждая сборка получает другой профиль, как после правки режима в интерфейсе
+            modes = synthetic_modes(args.modes, args.buttons)
+            modes["Mode1"]["standard_buttons"]["button1"]["action"] = f"Revision {build}"
+            generate_ino_file(modes, args.buttons, 1, output_filename=sketch_path)
+            result = pipeline.compile(sketch_path, args.fqbn)
+            if not result.success:
+                print(f"Ошибка компиляции: {result.error}")
+                break
+            metrics = load_compile_metrics(metrics_path)[-1]
+            results.append({"build": build, **metrics})
+            print(f"{build:>6}{str(metrics['warm']):>6}{metrics['seconds']:>11}")
+
+    cold = [row["seconds"] for row in results if not row["warm"]]
+    warm = [row["seconds"] for row in results if row["warm"]]
+    if cold and warm:
+        print(f"Ускорение тёплой сборки: {cold[0] / (sum(warm) / len(warm)):.1f}x")
+    return results
+
+
+def bench_daemon(args):
+    """
+    Задержка board list, тёплой компиляции и загрузки: процесс arduino-cli на команду против
+    постоянного daemon. Первая команда daemon (запуск и инициализация) выводится отдельно.
+    """
+    from arduino_daemon import DaemonBackend, StubDaemonBackend, daemon_available
+    from pipeline import ARDUINO_CLI_PATH, CliBackend
+
+    if args.real:
+        if not os.path.exists(ARDUINO_CLI_PATH) or not daemon_available():
+            print(f"Нужны {ARDUINO_CLI_PATH}, grpcio и модули протокола arduino-cli")
+            return []
+        backends = [("spawn", CliBackend([ARDUINO_CLI_PATH])), ("daemon", DaemonBackend([ARDUINO_CLI_PATH]))]
+    else:
+        # Заменитель тратит STUB_STARTUP_SECONDS на запуск каждого процесса, как arduino-cli на загрузку
+        # настроек, индексов и ядра
+        os.environ["STUB_STARTUP_SECONDS"] = str(args.startup_seconds)
+        os.environ.setdefault("STUB_COMPILE_SECONDS", "0.1")
+        os.environ.setdefault("STUB_UPLOAD_SECONDS", "0.1")
+        backends = [("spawn", CliBackend([sys.executable, STUB_CLI])),
+                    ("daemon", StubDaemonBackend([sys.executable, STUB_CLI]))]
+    port = args.port or (None if args.real else "STUB0")
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        sketch_dir = os.path.join(tmp, "kurs")
+        os.makedirs(sketch_dir)
+        sketch_path = os.path.join(sketch_dir, "kurs.ino")
+        generate_ino_file(synthetic_modes(4, 4), 4, 1, output_filename=sketch_path)
+        output_dir = os.path.join(tmp, "build")
+        operations = [
+            ("board_list", None),
+            ("compile", ["compile", "--fqbn", args.fqbn, "--build-path", os.path.join(tmp, "build_path"),
+                         "--output-dir", output_dir, sketch_path]),
+        ]
+        if port:
+            operations.append(("upload", ["upload", "--fqbn", args.fqbn, "--port", port, "--input-dir", output_dir,
+                                          sketch_path]))
+
+        timings = {}
+        for name, backend in backends:
+            cancel_event = threading.Event()
+
+            def execute(cli_args):
+                start = time.perf_counter()
+                if cli_args is None:
+                    backend.board_list()
+                else:
+                    backend.run(cli_args, lambda line: None, cancel_event)
+                return (time.perf_counter() - start) * 1000
+
+            try:
+                # Первая компиляция собирает ядро, у daemon она же включает запуск процесса
+                timings[(name, "first_command")] = execute(operations[1][1])
+                for operation, cli_args in operations:
+                    timings[(name, operation)] = sum(execute(cli_args) for _ in range(args.repeat)) / args.repeat
+            finally:
+                backend.close()
+
+    print(f"{'operation':<15}{'spawn_ms':>10}{'daemon_ms':>11}{'speedup':>9}")
+    for operation in ["first_command"] + [operation for operation, _ in operations]:
+        spawn_ms, daemon_ms = timings[("spawn", operation)], timings[("daemon", operation)]
+        row = {"operation": operation, "spawn_ms": round(spawn_ms, 1), "daemon_ms": round(daemon_ms, 1),
+               "speedup": round(spawn_ms / daemon_ms, 2)}
+        results.append(row)
+        print(f"{operation:<15}{row['spawn_ms']:>10}{row['daemon_ms']:>11}{row['speedup']:>9}")
+    return results
+
+
+def bench_reports(args):
+    """Сравнивает число USB-отчётов на действие: комбинация одним отчётом против отчёта на клавишу."""
+    modes = synthetic_modes(args.modes, args.buttons)
+    tables = build_progmem_tables(modes, args.buttons)
+    per_key = count_action_reports(tables, single_report=False)
+    single = count_action_reports(tables, single_report=True)
+
+    print(f"{'action':<28}{'per_key':>9}{'single':>8}")
+    results = []
+    for index, program in enumerate(tables['programs']):
+        name = "+".join(key[4:] for key in tables['key_sequences'][program[0][1]]) \
+            if program[0][0] == 'press' else f"text {len(tables['texts'][program[0][1]])} chars"
+        results.append({"action": name, "per_key": per_key[index], "single": single[index]})
+        print(f"{name:<28}{per_key[index]:>9}{single[index]:>8}")
+    # При опросе раз в poll_interval_ms хост забирает не больше одного отчёта за интервал
+    worst_key = max((row for row in results if not row["action"].startswith("text")),
+                    key=lambda row: row["per_key"], default=None)
+    if worst_key:
+        print(f"Худшая комбинация {worst_key['action']}: {worst_key['per_key'] * args.poll_interval} мс "
+              f"против {worst_key['single'] * args.poll_interval} мс при опросе раз в {args.poll_interval} мс")
+    return results
+
+
+def sample_profiles():
+    """Профили для симулятора: сохранённый modes.json и синтетические разного размера."""
+    profiles = []
+    if os.path.exists(MODES_JSON):
+        with open(MODES_JSON, "r", encoding="utf-8") as f:
+            profiles.append(("modes.json", json.load(f), 4))
+    profiles.append(("synthetic 4x4", synthetic_modes(4, 4), 4))
+    profiles.append(("synthetic 16x12", synthetic_modes(16, 12), 12))
+    macros = synthetic_modes(2, 4)
+    for mode in macros.values():
+        mode["standard_buttons"]["button1"] = {"type": "Macro", "action": 'Ctrl+A; wait 20; Ctrl+C; "copied"'}
+        mode["dropdown_buttons"]["dropdown_button1"] = "Scroll"
+    profiles.append(("macros", macros, 4))
+    return profiles
+
+
+def bench_sim(args):
+    """
+    Прогоняет сгенерированную прошивку в симуляторе: задержка от нажатия до отчёта, отчётов на действие,
+    время loop() в виртуальном времени ATmega32U4 и отчёты энкодера на args.detents щелчков.
+    """
+    from simulator import action_trace, press_latencies, reports_per_press, simulate
+
+    print(f"{'profile':<18}{'presses':>8}{'lat_avg_us':>11}{'lat_max_us':>11}{'reports':>8}"
+          f"{'loop_us':>9}{'max_us':>8}{'host_ns':>9}{'enc_reports':>12}")
+    results = []
+    for name, modes, num_buttons in sample_profiles():
+        trace = action_trace(modes, num_buttons)
+        rotate_at = trace.end_ms + 300
+        trace.rotate(args.detents, rotate_at, args.detent_us)
+        result = simulate(modes, num_buttons, 1, trace, defines=[TELEMETRY_FLAG] if args.telemetry else (),
+                          keyboard=args.keyboard)
+
+        latencies = [latency for _, latency in press_latencies(result)]
+        reports = reports_per_press(result)
+        row = {
+            "profile": name,
+            "presses": len(latencies),
+            "latency_avg_us": round(sum(latencies) / len(latencies)) if latencies else None,
+            "latency_max_us": max(latencies, default=None),
+            "reports_per_action": round(sum(reports) / len(reports), 2) if reports else None,
+            "loop_us": round(result.loop_us, 1),
+            "loop_max_us": result.loop_max_us,
+            "host_ns_per_loop": result.host_ns_per_loop,
+            "encoder_reports": sum(1 for report in result.reports if report.time_us >= rotate_at * 1000),
+        }
+        results.append(row)
+        print(f"{name:<18}{row['presses']:>8}{str(row['latency_avg_us']):>11}{str(row['latency_max_us']):>11}"
+              f"{str(row['reports_per_action']):>8}{row['loop_us']:>9}{row['loop_max_us']:>8}"
+              f"{row['host_ns_per_loop']:>9}{row['encoder_reports']:>12}")
+    return results
+
+
+def typing_sample(chars):
+    """Текст длиной chars из повторов TYPING_TEMPLATE."""
+    text = ""
+    n = 0
+    while len(text) < chars:
+        text += TYPING_TEMPLATE.format(n=n)
+        n += 1
+    return text[:chars]
+
+
+def bench_typing(args):
+    """
+    Печатает длинный текст кнопкой в симуляторе с каждым профилем из TYPING_PROFILES: символов в секунду
+    от нажатия до последнего отчёта, отчётов на символ, самый долгий проход loop() и совпадение текста,
+    который увидел бы хост, с исходным.
+    """
+    from simulator import Trace, simulate, typed_text
+
+    text = typing_sample(args.chars)
+    modes = {"Typing": {"standard_buttons": {"button1": {"type": "Print Text", "action": text}},
+                        "dropdown_buttons": {"dropdown_button1": "Nothing"}}}
+    print(f"{'profile':<10}{'chars':>7}{'reports':>9}{'per_char':>9}{'time_ms':>9}{'chars_s':>9}"
+          f"{'max_us':>8}{'correct':>9}")
+    results = []
+    for profile in args.profiles:
+        press_ms = 100
+        trace = Trace()
+        trace.press(0, press_ms)
+        # С запасом: не меньше отчёта за период опроса плюс промежуток профиля
+        report_ms = 1 + TYPING_PROFILES[profile]["report_gap_us"] / 1000
+        trace.idle(press_ms + len(typing_reports(text, profile)) * report_ms * 2)
+        result = simulate(modes, 1, 1, trace, keyboard=args.keyboard, typing=profile)
+        reports = [report for report in result.reports if report.time_us >= press_ms * 1000]
+        elapsed_us = reports[-1].time_us - press_ms * 1000 if reports else 0
+        row = {
+            "profile": profile,
+            "chars": len(text),
+            "reports": len(reports),
+            "reports_per_char": round(len(reports) / len(text), 2),
+            "time_ms": round(elapsed_us / 1000, 1),
+            "chars_per_second": round(len(text) * 1_000_000 / elapsed_us) if elapsed_us else None,
+            "loop_max_us": result.loop_max_us,
+            "correct": typed_text(result) == text,
+        }
+        results.append(row)
+        print(f"{profile:<10}{row['chars']:>7}{row['reports']:>9}{row['reports_per_char']:>9}{row['time_ms']:>9}"
+              f"{str(row['chars_per_second']):>9}{row['loop_max_us']:>8}{str(row['correct']):>9}")
+    return results
+
+
+def bench_profiles(args):
+    """
+    Открытие профиля, переключение на режим и сохранение одной правки: весь modes.json, который
+    приложение раньше читало и переписывало целиком, против ProfileStore с файлом на режим.
+    """
+    from profile_store import ProfileStore
+
+    def timed(function, repeat):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            value = function()
+        return (time.perf_counter() - start) / repeat * 1000, value
+
+    print(f"{'modes':>6}{'json_open':>11}{'json_save':>11}{'open_ms':>9}{'switch_ms':>11}{'save_ms':>9}"
+          f"{'files':>7}{'rename_ms':>11}")
+    results = []
+    for num_modes in args.modes:
+        modes = synthetic_modes(num_modes, args.buttons)
+        with tempfile.TemporaryDirectory() as workdir:
+            json_path = os.path.join(workdir, "modes.json")
+            with open(json_path, "w", encoding="utf-8") as f:
+                json.dump(modes, f, indent=4)
+
+            def json_open():
+                with open(json_path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+
+            def json_save():
+                with open(json_path, "w", encoding="utf-8") as f:
+                    json.dump(modes, f, indent=4)
+
+            json_open_ms, _ = timed(json_open, args.repeat)
+            json_save_ms, _ = timed(json_save, args.repeat)
+
+            root = os.path.join(workdir, "profiles")
+            ProfileStore(root).import_json("bench", json_path)
+            open_ms, profile = timed(lambda: ProfileStore(root).open("bench"), args.repeat)
+            names = profile.names
+            switches = iter(range(args.repeat * len(names)))
+            switch_ms, _ = timed(lambda: profile.mode(names[next(switches) % len(names)]), args.repeat)
+
+            def save_one():
+                mode_data = copy.deepcopy(profile.mode(names[0]))
+                mode_data["standard_buttons"]["button1"]["action"] += "!"
+                profile.set_mode(names[0], mode_data)
+                return profile.save()
+
+            save_ms, files = timed(save_one, args.repeat)
+            renames = iter(range(args.repeat))
+
+            def rename_one():
+                profile.rename_mode(profile.names[-1], f"Renamed{next(renames)}")
+                return profile.save()
+
+            rename_ms, _ = timed(rename_one, args.repeat)
+        row = {"modes": num_modes, "json_open_ms": round(json_open_ms, 2), "json_save_ms": round(json_save_ms, 2),
+               "open_ms": round(open_ms, 2), "switch_ms": round(switch_ms, 3), "save_ms": round(save_ms, 2),
+               "files_written": files, "rename_ms": round(rename_ms, 2)}
+        results.append(row)
+        print(f"{num_modes:>6}{row['json_open_ms']:>11}{row['json_save_ms']:>11}{row['open_ms']:>9}"
+              f"{row['switch_ms']:>11}{row['save_ms']:>9}{files:>7}{row['rename_ms']:>11}")
+    return results
+
+
+def bench_bridge(args):
+    """
+    Задержка действий на компьютере: HostBridge из host_bridge.py читает псевдотерминал, а поток на другом
+    его конце изображает плату - отвечает на кадр H и шлёт события по одному, затем пачками по args.burst.
+    Время в мс от отправки кадра до вызова действия и до ответа A, который прошивка ждёт HOST_ACK_TIMEOUT_MS.
+    USB CDC платы добавляет к этому до миллисекунды опроса на каждое направление.
+    """
+    import asyncio
+    import pty
+    import statistics
+    from generate import HOST_ACK_DONE, HOST_ACK_TIMEOUT_MS, HOST_FRAME_ACK, HOST_FRAME_EVENT, HOST_FRAME_HELLO
+    from host_bridge import HostBridge, decode_frame, encode_frame, open_serial
+
+    runs = [("sequential", 1), ("burst", args.burst)]
+    events = [("run", str(i), None) for i in range(args.events * len(runs))]
+    executed = {}
+
+    def executor(kind, argument):
+        executed[int(argument)] = time.perf_counter()
+        return HOST_ACK_DONE
+
+    def device(master, config_id):
+        buffer = b""
+
+        def read_frame():
+            nonlocal buffer
+            while b"\n" not in buffer:
+                buffer += os.read(master, 4096)
+            line, buffer = buffer.split(b"\n", 1)
+            return decode_frame(line.decode("ascii", errors="replace"))
+
+        while (frame := read_frame()) is None or frame[0] != HOST_FRAME_HELLO:
+            pass
+        os.write(master, encode_frame(HOST_FRAME_HELLO, 0, config_id))
+        samples = {}
+        event_id = 0
+        for name, size in runs:
+            samples[name] = []
+            for _ in range(args.events // size):
+                pending = {}
+                for _ in range(size):
+                    pending[event_id & 0xFF] = (event_id, time.perf_counter())
+                    os.write(master, encode_frame(HOST_FRAME_EVENT, event_id, event_id))
+                    event_id += 1
+                while pending:
+                    frame = read_frame()
+                    if frame is not None and frame[0] == HOST_FRAME_ACK and frame[1] in pending:
+                        acked_id, sent = pending.pop(frame[1])
+                        samples[name].append((executed[acked_id] - sent, time.perf_counter() - sent))
+        return samples
+
+    async def run():
+        master, slave = pty.openpty()
+        reader, writer = await open_serial(os.ttyname(slave))
+        os.close(slave)
+        bridge = HostBridge(events, executor=executor, on_log=lambda line: None)
+        task = asyncio.create_task(bridge.run(reader, writer))
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, device, master, bridge.config_id)
+        finally:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+            os.close(master)
+
+    def percentile_ms(values, q):
+        return round(statistics.quantiles(values, n=100)[q - 1] * 1000, 3)
+
+    print(f"{'mode':<12}{'events':>7}{'action_p50':>11}{'action_p99':>11}{'ack_p50':>9}{'ack_p95':>9}"
+          f"{'ack_p99':>9}{'ack_max':>9}{'timeout':>9}")
+    results = []
+    for name, samples in asyncio.run(run()).items():
+        action, ack = [sample[0] for sample in samples], [sample[1] for sample in samples]
+        row = {"mode": name, "events": len(samples), "action_p50_ms": percentile_ms(action, 50),
+               "action_p99_ms": percentile_ms(action, 99), "ack_p50_ms": percentile_ms(ack, 50),
+               "ack_p95_ms": percentile_ms(ack, 95), "ack_p99_ms": percentile_ms(ack, 99),
+               "ack_max_ms": round(max(ack) * 1000, 3), "timeout_ms": HOST_ACK_TIMEOUT_MS}
+        results.append(row)
+        print(f"{name:<12}{row['events']:>7}{row['action_p50_ms']:>11}{row['action_p99_ms']:>11}{row['ack_p50_ms']:>9}"
+              f"{row['ack_p95_ms']:>9}{row['ack_p99_ms']:>9}{row['ack_max_ms']:>9}{HOST_ACK_TIMEOUT_MS:>9}")
+    return results
+
+
+def bench_taphold(args):
+    """
+    Задержка, которую добавляют тап/удержание и слои, в симуляторе: от события до первого отчёта с клавишей
+    действия. plain - обычная кнопка без тап/удержания в прошивке и в прошивке с ним на соседней кнопке,
+    tap - от отпускания, hold - от нажатия (время решения), nested - удержание с нажатием и отпусканием
+    другой кнопки (с permissive решение по её отпусканию), rolling - нажатие другой кнопки до решения,
+    которое ждёт тапа.
+    """
+    from simulator import PRESS_PHASE_MS, Trace, simulate
+
+    def mode(buttons):
+        return {"standard_buttons": buttons, "dropdown_buttons": {"dropdown_button1": "Nothing"}}
+
+    # (сценарий, событие отсчёта, нажатия (кнопка, начало, длительность) в мс, номер нажатия отсчёта, символ)
+    def scenarios(timeout_ms):
+        return [("plain", "press", [(1, 0, 50)], 0, "b"),
+                ("tap", "release", [(0, 0, args.tap_ms)], 0, "a"),
+                ("hold", "press", [(0, 0, timeout_ms + 100)], 0, "h"),
+                ("nested", "release", [(0, 0, timeout_ms + 100), (1, 20, 40)], 1, "h"),
+                ("rolling", "press", [(0, 0, 40), (1, 20, 60)], 1, "b")]
+
+    def measure(modes, timeout_ms, names):
+        trace = Trace()
+        period_ms = 2 * timeout_ms + 300
+        starts = []
+        for scenario in scenarios(timeout_ms):
+            if scenario[0] not in names:
+                continue
+            for i in range(args.repeat):
+                start_ms = round(period_ms * (len(starts) + 1) + (i * PRESS_PHASE_MS) % 1, 3)
+                starts.append((scenario, start_ms))
+                for button, at_ms, hold_ms in scenario[2]:
+                    trace.press(button, start_ms + at_ms, hold_ms)
+        result = simulate(modes, 2, 1, trace)
+        reports = [report for report in result.reports if report.kind == "keyboard" and report.data != "-"]
+        latencies = {}
+        for (name, event, presses, reference, char), start_ms in starts:
+            button, at_ms, hold_ms = presses[reference]
+            from_us = (start_ms + at_ms + (hold_ms if event == "release" else 0)) * 1000
+            code = typing_code(char)
+            report = next(report for report in reports
+                          if report.time_us >= start_ms * 1000 and code in bytes.fromhex(report.data))
+            latencies.setdefault((name, event), []).append((report.time_us - from_us) / 1000)
+        return latencies
+
+    baseline = {"Base": mode({"button1": {"type": "Print Text", "action": "a"},
+                              "button2": {"type": "Print Text", "action": "b"}})}
+    print(f"{'timeout':>8}{'permissive':>11}  {'scenario':<19}{'from':<9}{'avg_ms':>8}{'max_ms':>8}")
+    results = []
+
+    def add_rows(timeout_ms, permissive, latencies):
+        for (name, event), values in latencies.items():
+            row = {"timeout_ms": timeout_ms, "permissive": permissive, "scenario": name, "from": event,
+                   "avg_ms": round(sum(values) / len(values), 2), "max_ms": round(max(values), 2)}
+            results.append(row)
+            print(f"{str(timeout_ms):>8}{str(permissive):>11}  {name:<19}{event:<9}{row['avg_ms']:>8}"
+                  f"{row['max_ms']:>8}")
+
+    baseline_latencies = measure(baseline, TAP_HOLD_MS, {"plain"})
+    add_rows(None, None, {("plain (no tap-hold)", "press"): baseline_latencies["plain", "press"]})
+    for timeout_ms in args.timeouts:
+        for permissive in (True, False):
+            modes = {"Base": mode({"button1": {"type": "Print Text", "action": "a",
+                                               "hold": {"type": "Print Text", "action": "h", "timeout_ms": timeout_ms,
+                                                        "permissive": permissive}},
+                                   "button2": {"type": "Print Text", "action": "b"}}),
+                     "Fn": mode({"button1": {"type": "Toggle Layer", "action": "Fn"}})}
+            add_rows(timeout_ms, permissive, measure(modes, timeout_ms, {name for name, *_ in scenarios(timeout_ms)}))
+    return results
+
+
+def bench_generate(args):
+    """
+    Генерация скетча для профилей от сотен до тысяч действий (args.actions, кнопки матрицей args.rows x args.cols):
+    в память, первая запись файла, повторная генерация без изменений, которую write_sketch не записывает,
+    и прежняя безусловная перезапись. Проверяет, что повторы дают те же байты и не меняют время файла.
+    """
+    matrix = default_matrix(args.rows, args.cols)
+    num_buttons = args.rows * args.cols
+
+    def timed(function):
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            value = function()
+            times.append((time.perf_counter() - start) * 1000)
+        return sorted(times)[len(times) // 2], value
+
+    print(f"{'actions':>8}{'modes':>7}{'bytes':>9}{'memory_ms':>11}{'us/action':>11}{'first_ms':>10}"
+          f"{'same_ms':>9}{'rewrite_ms':>12}{'identical':>11}{'mtime_kept':>12}")
+    results = []
+    for num_actions in args.actions:
+        modes = synthetic_modes(-(-num_actions // num_buttons), num_buttons)
+
+        def generate(output):
+            return generate_ino_file(modes, num_buttons, 1, matrix=matrix, output_filename=output)
+
+        try:
+            memory_ms, info = timed(lambda: generate(io.StringIO()))
+        except ValueError as e:
+            print(f"{num_actions:>8}  {str(e).splitlines()[0]}")
+            continue
+        with tempfile.TemporaryDirectory() as workdir:
+            sketch_path = os.path.join(workdir, "kurs.ino")
+            start = time.perf_counter()
+            first = generate(sketch_path)
+            first_ms = (time.perf_counter() - start) * 1000
+            mtime = os.stat(sketch_path).st_mtime_ns
+            same_ms, same = timed(lambda: generate(sketch_path))
+            mtime_kept = os.stat(sketch_path).st_mtime_ns == mtime
+
+            def rewrite():
+                buffer = io.StringIO()
+                generate(buffer)
+                with open(sketch_path, "w", encoding="utf-8", newline="\n") as f:
+                    f.write(buffer.getvalue())
+
+            rewrite_ms, _ = timed(rewrite)
+        actions = len(modes) * num_buttons
+        row = {"actions": actions, "modes": len(modes), "bytes": info["bytes"], "memory_ms": round(memory_ms, 1),
+               "us_per_action": round(memory_ms * 1000 / actions, 1), "first_ms": round(first_ms, 1),
+               "same_ms": round(same_ms, 1), "rewrite_ms": round(rewrite_ms, 1),
+               "identical": info["sha256"] == first["sha256"] == same["sha256"] and not same["written"],
+               "mtime_kept": mtime_kept, "sections": info["sections"]}
+        results.append(row)
+        print(f"{actions:>8}{len(modes):>7}{info['bytes']:>9}{row['memory_ms']:>11}{row['us_per_action']:>11}"
+              f"{row['first_ms']:>10}{row['same_ms']:>9}{row['rewrite_ms']:>12}{str(row['identical']):>11}"
+              f"{str(mtime_kept):>12}")
+    if args.large:
+        results.extend(bench_large_generation(args.large, args.repeat))
+    return results
+
+
+def bench_large_generation(action_counts, repeat):
+    """
+    Части скетча, которые растут с числом действий (исполнитель с программами и таблица ACTIONS с диспетчером),
+    для профилей больше flash платы: validate_config их отклоняет, поэтому генераторы вызываются напрямую.
+    Сравнивает пик памяти потоковой записи (write_sketch только считает хеш) и сборки текста в одну строку
+    и проверяет, что байты совпадают.
+    """
+    print(f"\n{'actions':>8}{'modes':>7}{'bytes':>10}{'stream_ms':>11}{'us/action':>11}"
+          f"{'stream_kb':>11}{'joined_kb':>11}{'identical':>11}")
+    results = []
+    for num_actions in action_counts:
+        modes = synthetic_modes(min(-(-num_actions // LARGE_BUTTONS), 255), LARGE_BUTTONS)
+        mode_names = list(modes)
+        tables = build_progmem_tables(modes, LARGE_BUTTONS)
+
+        def sections():
+            for name, lines in (('executor', generate_action_executor(tables)),
+                                ('dispatch', generate_table_dispatch(mode_names, tables, LARGE_BUTTONS))):
+                for line in lines:
+                    yield name, line
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            info = write_sketch(sections(), None)
+            times.append((time.perf_counter() - start) * 1000)
+        stream_ms = sorted(times)[len(times) // 2]
+
+        peaks = {}
+        for kind in ("stream", "joined"):
+            tracemalloc.start()
+            if kind == "stream":
+                write_sketch(sections(), None)
+            else:
+                text = "".join(line for _, line in sections())
+            peaks[kind] = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        identical = write_sketch([("joined", text)], None)["sha256"] == info["sha256"]
+
+        actions = len(modes) * LARGE_BUTTONS
+        row = {"actions": actions, "modes": len(modes), "bytes": info["bytes"], "stream_ms": round(stream_ms, 1),
+               "us_per_action": round(stream_ms * 1000 / actions, 1), "stream_peak_kb": peaks["stream"],
+               "joined_peak_kb": peaks["joined"], "identical": identical, "large": True}
+        results.append(row)
+        print(f"{actions:>8}{len(modes):>7}{info['bytes']:>10}{row['stream_ms']:>11}{row['us_per_action']:>11}"
+              f"{peaks['stream']:>11}{peaks['joined']:>11}{str(identical):>11}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки генератора и прошивки")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    dispatch_parser = subparsers.add_parser("dispatch", help="классы на режим против таблицы действий")
+    dispatch_parser.add_argument("--modes", type=lambda v: [int(n) for n in v.split(",")], default=MODE_COUNTS)
+    dispatch_parser.add_argument("--buttons", type=int, default=4)
+    dispatch_parser.add_argument("--fqbn", default=FQBN)
+    dispatch_parser.add_argument("--port", help="порт платы для измерения времени loop()")
+    dispatch_parser.add_argument("--output", help="сохранить результаты в JSON")
+    dispatch_parser.set_defaults(handler=bench_dispatch)
+
+    fleet_parser = subparsers.add_parser("fleet", help="последовательная против параллельной прошивки N плат")
+    fleet_parser.add_argument("--devices", type=lambda v: [int(n) for n in v.split(",")], default=DEVICE_COUNTS)
+    fleet_parser.add_argument("--upload-seconds", type=float, default=1.0,
+                              help="длительность загрузки в заменителе arduino-cli")
+    fleet_parser.add_argument("--real", action="store_true", help="прошить все подключённые платы")
+    fleet_parser.add_argument("--fqbn", default=FQBN)
+    fleet_parser.add_argument("--output", help="сохранить результаты в JSON")
+    fleet_parser.set_defaults(handler=bench_fleet)
+
+    compile_parser = subparsers.add_parser("compile", help="холодная против тёплой компиляции")
+    compile_parser.add_argument("--builds", type=int, default=4)
+    compile_parser.add_argument("--modes", type=int, default=4)
+    compile_parser.add_argument("--buttons", type=int, default=4)
+    compile_parser.add_argument("--fqbn", default=FQBN)
+    compile_parser.add_argument("--stub", action="store_true", help="использовать заменитель arduino-cli")
+    compile_parser.add_argument("--output", help="сохранить результаты в JSON")
+    compile_parser.set_defaults(handler=bench_compile)
+
+    daemon_parser = subparsers.add_parser("daemon", help="процесс arduino-cli на команду против daemon")
+    daemon_parser.add_argument("--repeat", type=int, default=5, help="повторов каждой команды")
+    daemon_parser.add_argument("--startup-seconds", type=float, default=0.5,
+                               help="запуск процесса заменителя arduino-cli")
+    daemon_parser.add_argument("--real", action="store_true", help="настоящий arduino-cli и daemon")
+    daemon_parser.add_argument("--port", help="порт платы для измерения загрузки")
+    daemon_parser.add_argument("--fqbn", default=FQBN)
+    daemon_parser.add_argument("--output", help="сохранить результаты в JSON")
+    daemon_parser.set_defaults(handler=bench_daemon)
+
+    reports_parser = subparsers.add_parser("reports", help="число USB-отчётов на действие")
+    reports_parser.add_argument("--modes", type=int, default=4)
+    reports_parser.add_argument("--buttons", type=int, default=4)
+    reports_parser.add_argument("--poll-interval", type=int, default=1, help="период опроса HID, мс")
+    reports_parser.add_argument("--output", help="сохранить результаты в JSON")
+    reports_parser.set_defaults(handler=bench_reports)
+
+    sim_parser = subparsers.add_parser("sim", help="задержки и время loop() в симуляторе на компьютере")
+    sim_parser.add_argument("--keyboard", default="keyboard", choices=["keyboard", "boot", "nkro"])
+    sim_parser.add_argument("--detents", type=int, default=20, help="щелчков энкодера в сценарии")
+    sim_parser.add_argument("--detent-us", type=int, default=20000, help="время одного щелчка, мкс")
+    sim_parser.add_argument("--telemetry", action="store_true", help="собрать с телеметрией (-DTELEMETRY)")
+    sim_parser.add_argument("--output", help="сохранить результаты в JSON")
+    sim_parser.set_defaults(handler=bench_sim)
+
+    typing_parser = subparsers.add_parser("typing", help="скорость печати длинного текста по профилям")
+    typing_parser.add_argument("--chars", type=int, default=2000, help="длина текста")
+    typing_parser.add_argument("--profiles", type=lambda v: v.split(","), default=list(TYPING_PROFILES))
+    typing_parser.add_argument("--keyboard", default="keyboard", choices=["keyboard", "boot", "nkro"])
+    typing_parser.add_argument("--output", help="сохранить результаты в JSON")
+    typing_parser.set_defaults(handler=bench_typing)
+
+    profiles_parser = subparsers.add_parser("profiles", help="modes.json целиком против профиля с файлом на режим")
+    profiles_parser.add_argument("--modes", type=lambda v: [int(n) for n in v.split(",")], default=[100, 500, 2000])
+    profiles_parser.add_argument("--buttons", type=int, default=16)
+    profiles_parser.add_argument("--repeat", type=int, default=20)
+    profiles_parser.add_argument("--output", help="сохранить результаты в JSON")
+    profiles_parser.set_defaults(handler=bench_profiles)
+
+    bridge_parser = subparsers.add_parser("bridge", help="задержка событий Host Action через псевдотерминал")
+    bridge_parser.add_argument("--events", type=int, default=1000, help="событий в каждом прогоне")
+    bridge_parser.add_argument("--burst", type=int, default=HOST_PENDING, help="событий в пачке без ожидания ответа")
+    bridge_parser.add_argument("--output", help="сохранить результаты в JSON")
+    bridge_parser.set_defaults(handler=bench_bridge)
+
+    taphold_parser = subparsers.add_parser("taphold", help="задержка тапа, удержания и слоёв в симуляторе")
+    taphold_parser.add_argument("--timeouts", type=lambda v: [int(n) for n in v.split(",")], default=[150, 200, 300])
+    taphold_parser.add_argument("--tap-ms", type=int, default=60, help="длительность тапа")
+    taphold_parser.add_argument("--repeat", type=int, default=10)
+    taphold_parser.add_argument("--output", help="сохранить результаты в JSON")
+    taphold_parser.set_defaults(handler=bench_taphold)
+
+    generate_parser = subparsers.add_parser("generate", help="время генерации скетча от числа действий")
+    generate_parser.add_argument("--actions", type=lambda v: [int(n) for n in v.split(",")],
+                                 default=[256, 512, 1024, 2048])
+    generate_parser.add_argument("--rows", type=int, default=4, help="строк матрицы кнопок")
+    generate_parser.add_argument("--cols", type=int, default=4, help="столбцов матрицы кнопок")
+    generate_parser.add_argument("--repeat", type=int, default=5)
+    generate_parser.add_argument("--large", type=lambda v: [int(n) for n in v.split(",") if n], default=LARGE_ACTIONS,
+                                 help="действий в профилях больше flash для потоковой генерации; пусто - без них")
+    generate_parser.add_argument("--output", help="сохранить результаты в JSON")
+    generate_parser.set_defaults(handler=bench_generate)
+
+    args = parser.parse_args()
+    results = args.handler(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+
+# Командная строка для скриптов подготовки плат: без PyQt5, а генератор, arduino-cli и pyserial
+# импортируются только командами, которым они нужны. Настройки и ключ кеша те же, что в main.py
+DIRECT_BUTTONS = 4
+DROPDOWN_BUTTONS = 1
+SETTINGS_PATH = "settings.json"
+SKETCH_PATH = "kurs.ino"
+DEFAULT_FQBN = "arduino:avr:leonardo"
+
+
+class ConfigError(Exception):
+    pass
+
+
+def load_config(modes_path, settings_path=SETTINGS_PATH):
+    """
+    Читает режимы и настройки прошивки (matrix, keyboard, poll_interval_ms, typing, telemetry) в формате,
+    который сохраняет main.py. modes_path - файл режимов или каталог профиля profiles/<профиль>.
+    Без файла настроек - кнопки на отдельных выводах и клавиатура по умолчанию.
+    """
+    try:
+        if os.path.isdir(modes_path):
+            from profile_store import load_profile
+            modes = load_profile(modes_path)
+        else:
+            with open(modes_path, "r", encoding="utf-8") as f:
+                modes = json.load(f)
+    except (OSError, KeyError, json.JSONDecodeError) as e:
+        raise ConfigError(f"{modes_path}: {e}")
+    if not isinstance(modes, dict) or not modes:
+        raise ConfigError(f"{modes_path}: нет ни одного режима")
+    settings = {}
+    if settings_path and os.path.exists(settings_path):
+        try:
+            with open(settings_path, "r", encoding="utf-8") as f:
+                settings = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            raise ConfigError(f"{settings_path}: {e}")
+    settings.setdefault("matrix", None)
+    settings.setdefault("keyboard", "keyboard")
+    settings.setdefault("telemetry", False)
+    if "poll_interval_ms" not in settings or "typing" not in settings:
+        from generate import POLL_INTERVAL_MS, TYPING_PROFILE
+        settings.setdefault("poll_interval_ms", POLL_INTERVAL_MS)
+        settings.setdefault("typing", TYPING_PROFILE)
+    return modes, settings
+
+
+def button_counts(settings):
+    matrix = settings["matrix"]
+    num_standard_buttons = len(matrix["rows"]) * len(matrix["cols"]) if matrix else DIRECT_BUTTONS
+    return num_standard_buttons, DROPDOWN_BUTTONS
+
+
+def firmware_job(modes, settings, sketch_path):
+    """Функция генерации, ключ кеша и свойства сборки - то же, что передаёт в сборку main.py."""
+    from firmware_cache import config_key
+    from generate import TELEMETRY_FLAG, firmware_build_properties
+
+    num_standard_buttons, num_drop_buttons = button_counts(settings)
+    key = config_key(modes, num_standard_buttons, num_drop_buttons, settings)
+    extra_flags = [TELEMETRY_FLAG] if settings["telemetry"] else []
+    build_properties = firmware_build_properties(settings["poll_interval_ms"], extra_flags)
+
+    # Отчёт генерации выводит BuildPipeline через on_output, как в журнал сборки main.py
+    def generate():
+        return generate_firmware(modes, settings, sketch_path, quiet=True)
+
+    return generate, key, build_properties
+
+
+def generate_firmware(modes, settings, output_filename, quiet=False):
+    """Генерирует скетч и возвращает сведения о нём; output_filename=None только проверяет конфигурацию."""
+    from generate import generate_ino_file
+
+    num_standard_buttons, num_drop_buttons = button_counts(settings)
+    try:
+        info = generate_ino_file(modes, num_standard_buttons, num_drop_buttons, matrix=settings["matrix"],
+                                 keyboard=settings["keyboard"], typing=settings["typing"],
+                                 output_filename=output_filename)
+    except (ValueError, KeyError, TypeError) as e:
+        raise ConfigError(str(e))
+    if not quiet:
+        print(info["report"])
+    return info
+
+
+@contextlib.contextmanager
+def _pipeline(args):
+    from pipeline import ARDUINO_CLI_PATH, BuildPipeline
+
+    on_stage = (lambda stage: None) if args.quiet else (lambda stage: print(f"Стадия: {stage}", flush=True))
+    on_output = (lambda line: None) if args.quiet else print
+    cli_path = args.cli or ARDUINO_CLI_PATH
+    # Скрипт Python (например, stub_arduino_cli.py) запускается текущим интерпретатором
+    if cli_path.endswith(".py"):
+        cli_path = [sys.executable, cli_path]
+    backend = None
+    if args.daemon:
+        from arduino_daemon import create_daemon_backend
+        backend = create_daemon_backend(cli_path)
+    try:
+        yield BuildPipeline(cli_path=cli_path, on_stage=on_stage, on_output=on_output, backend=backend)
+    finally:
+        if backend is not None:
+            backend.close()
+
+
+def _print_durations(result):
+    print(", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in result.durations.items()))
+
+
+def _save_trace(args, result):
+    if args.trace:
+        from tracing import save_chrome_trace
+        save_chrome_trace(result.trace.to_entry(), args.trace)
+
+
+def command_validate(args):
+    """Только validate_sketch_config, без генерации кода: все ошибки за миллисекунды."""
+    from generate import validate_sketch_config
+
+    modes, settings = load_config(args.modes, args.settings)
+    num_standard_buttons, num_drop_buttons = button_counts(settings)
+    errors, _ = validate_sketch_config(modes, num_standard_buttons, num_drop_buttons, settings["matrix"],
+                                       settings["keyboard"], settings["typing"])
+    if errors:
+        raise ConfigError("\n".join(errors))
+    if not args.quiet:
+        print(f"{args.modes}: режимов {len(modes)}, ошибок нет")
+    return 0
+
+
+def command_generate(args):
+    modes, settings = load_config(args.modes, args.settings)
+    info = generate_firmware(modes, settings, args.sketch, quiet=args.quiet)
+    if not args.quiet:
+        if info["written"]:
+            print(f"Скетч сохранён в {args.sketch} ({info['bytes']} байт, sha256 {info['sha256'][:12]})")
+        else:
+            print(f"Скетч {args.sketch} не изменился")
+    return 0
+
+
+def command_compile(args):
+    modes, settings = load_config(args.modes, args.settings)
+    generate, key, build_properties = firmware_job(modes, settings, args.sketch)
+    info = generate()
+    if not args.quiet:
+        print(info["report"])
+    with _pipeline(args) as pipeline:
+        result = pipeline.compile(args.sketch, args.fqbn, cache_key=None if args.no_cache else key,
+                                  build_properties=build_properties)
+    _save_trace(args, result)
+    if not result.success:
+        print(f"Ошибка компиляции: {result.error}", file=sys.stderr)
+        return 1
+    if not args.quiet:
+        print("Прошивка взята из кеша" if result.cache_hit else "Прошивка скомпилирована")
+        _print_durations(result)
+    return 0
+
+
+def command_flash(args):
+    modes, settings = load_config(args.modes, args.settings)
+    generate, key, build_properties = firmware_job(modes, settings, args.sketch)
+    cache_key = None if args.no_cache else key
+    with _pipeline(args) as pipeline:
+        if args.all:
+            result = pipeline.run_fleet(args.sketch, generate, cache_key, build_properties=build_properties)
+        else:
+            result = pipeline.run(args.sketch, generate, cache_key, build_properties=build_properties)
+    _save_trace(args, result)
+    if args.all:
+        for device in result.devices:
+            status = "OK" if device.success else f"ошибка: {device.error.splitlines()[-1] if device.error else ''}"
+            print(f"{device.device:<16}{device.serial_number or '':<24}{device.duration:>7.1f} с  {status}")
+    if not result.success:
+        print(f"Ошибка на стадии {result.stage}: {result.error}", file=sys.stderr)
+        return 1
+    if not args.quiet:
+        if not args.all:
+            print(f"Загружено на {result.port}{' (из кеша)' if result.cache_hit else ''}")
+        _print_durations(result)
+    return 0
+
+
+def command_cache(args):
+    """Ключ конфигурации и наличие скомпилированной прошивки в кеше; код возврата 1 - прошивки нет."""
+    from firmware_cache import FirmwareCache
+
+    modes, settings = load_config(args.modes, args.settings)
+    _, key, _ = firmware_job(modes, settings, args.sketch)
+    cache = FirmwareCache()
+    if args.evict:
+        cache.evict()
+    path = cache.lookup(cache.entry_key(key, args.fqbn))
+    print(f"{key} {path or '-'}")
+    return 0 if path else 1
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Генерация, сборка и прошивка без графического интерфейса")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_command(name, handler, help):
+        command_parser = subparsers.add_parser(name, help=help)
+        command_parser.add_argument("modes", help="файл режимов (modes.json) или каталог профиля")
+        command_parser.add_argument("--settings", default=SETTINGS_PATH,
+                                    help="настройки прошивки, как их сохраняет main.py")
+        command_parser.add_argument("--sketch", default=SKETCH_PATH, help="путь сгенерированного скетча")
+        command_parser.add_argument("-q", "--quiet", action="store_true", help="выводить только ошибки")
+        command_parser.set_defaults(handler=handler)
+        return command_parser
+
+    add_command("validate", command_validate, "проверить режимы без записи скетча")
+    add_command("generate", command_generate, "сгенерировать скетч")
+    for name, handler, help in (("compile", command_compile, "сгенерировать и скомпилировать"),
+                                ("flash", command_flash, "сгенерировать, скомпилировать и прошить")):
+        command_parser = add_command(name, handler, help)
+        command_parser.add_argument("--cli", help="путь к arduino-cli или заменителю .py")
+        command_parser.add_argument("--no-cache", action="store_true", help="не использовать кеш прошивок")
+        command_parser.add_argument("--daemon", action="store_true",
+                                    help="одна сессия arduino-cli daemon на все команды запуска")
+        command_parser.add_argument("--trace", help="сохранить трассу Chrome со временем стадий")
+        if name == "compile":
+            command_parser.add_argument("--fqbn", default=DEFAULT_FQBN)
+        else:
+            command_parser.add_argument("--all", action="store_true", help="прошить все подключённые платы")
+    cache_parser = add_command("cache", command_cache, "ключ конфигурации и прошивка в кеше")
+    cache_parser.add_argument("--fqbn", default=DEFAULT_FQBN)
+    cache_parser.add_argument("--evict", action="store_true", help="вытеснить записи сверх лимита кеша")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return args.handler(args)
+    except ConfigError as e:
+        print("Ошибки конфигурации:", file=sys.stderr)
+        for line in str(e).splitlines():
+            print(f"  {line}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from generate import GENERATOR_VERSION
+
+CACHE_DIR = os.path.join(".cache", "firmware")
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Постоянные каталоги сборки: объектные файлы ядра и библиотек переиспользуются между компиляциями
+BUILD_PATH_DIR = os.path.join(".cache", "build")
+CORE_CACHE_DIR = os.path.join(".cache", "core")
+BUILD_PATH_MAX_ENTRIES = 8
+COMPILE_METRICS_PATH = os.path.join(".cache", "compile_metrics.jsonl")
+LIBRARIES_DIR = "libraries"
+
+# Файлы, которые arduino-cli кладёт в --output-dir и которые нужны для upload --input-dir
+ARTIFACT_SUFFIXES = (".hex", ".elf", ".eep", ".bin")
+
+
+def config_key(modes, num_standard_buttons, num_drop_buttons, options=None):
+    """
+    Возвращает хеш нормализованной конфигурации и версии генератора.
+    options - дополнительные параметры generate_ino_file, влияющие на прошивку.
+    """
+    payload = {
+        "generator_version": GENERATOR_VERSION,
+        "modes": modes,
+        "standard_buttons": num_standard_buttons,
+        "dropdown_buttons": num_drop_buttons,
+        "options": options or {},
+    }
+    normalized = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class FirmwareCache:
+    """Кеш скомпилированных прошивок с вытеснением по LRU и ограничением размера."""
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def entry_key(self, key, fqbn):
+        """Ключ записи: одна и та же конфигурация для разных плат даёт разные бинарники."""
+        return hashlib.sha256(f"{key}:{fqbn}".encode("utf-8")).hexdigest()
+
+    def _entry_path(self, entry_key):
+        return os.path.join(self.cache_dir, entry_key)
+
+    def lookup(self, entry_key):
+        """Возвращает каталог с артефактами или None, обновляя время использования."""
+        path = self._entry_path(entry_key)
+        if not os.path.isdir(path) or not any(name.endswith(".hex") for name in os.listdir(path)):
+            return None
+        os.utime(path)
+        return path
+
+    def store(self, entry_key, build_dir):
+        """Копирует артефакты сборки в кеш и вытесняет старые записи."""
+        path = self._entry_path(entry_key)
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name in os.listdir(build_dir):
+            if name.endswith(ARTIFACT_SUFFIXES):
+                shutil.copy2(os.path.join(build_dir, name), tmp_path)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        os.utime(path)
+        self.evict()
+        return path
+
+    def _entry_size(self, path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    def evict(self):
+        """Удаляет давно не использованные записи, пока кеш не уложится в лимит."""
+        if not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = self._entry_path(name)
+            if os.path.isdir(path) and not name.endswith(".tmp"):
+                entries.append((os.path.getmtime(path), self._entry_size(path), path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        # Самая свежая запись не вытесняется, даже если она одна больше лимита
+        while entries[:-1] and total > self.max_bytes:
+            _, size, path = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def toolchain_fingerprint(cli_path, libraries_dir=LIBRARIES_DIR):
+    """
+    Отпечаток всего, кроме скетча, от чего зависят объектные файлы: бинарник arduino-cli
+    и версии вендоренных библиотек. При его смене каталог сборки пересоздаётся с нуля.
+    """
+    parts = []
+    if os.path.exists(cli_path):
+        stat = os.stat(cli_path)
+        parts.append(f"cli:{stat.st_size}:{stat.st_mtime_ns}")
+    if os.path.isdir(libraries_dir):
+        for name in sorted(os.listdir(libraries_dir)):
+            properties = os.path.join(libraries_dir, name, "library.properties")
+            if os.path.exists(properties):
+                with open(properties, "rb") as f:
+                    parts.append(f"{name}:{hashlib.sha256(f.read()).hexdigest()}")
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+class BuildDirectories:
+    """
+    Постоянные --build-path для пар (скетч, плата). arduino-cli сам пересобирает только изменившиеся
+    единицы трансляции; здесь отслеживается смена инструментов, после которой старые объекты непригодны.
+    """
+
+    STAMP_FILE = "build_stamp.json"
+
+    def __init__(self, root=BUILD_PATH_DIR, core_cache_dir=CORE_CACHE_DIR, max_entries=BUILD_PATH_MAX_ENTRIES):
+        self.root = root
+        # --build-cache-path: собранные архивы ядра, общие для всех скетчей
+        self.core_cache_dir = core_cache_dir
+        self.max_entries = max_entries
+
+    def path_for(self, sketch_path, fqbn):
+        sketch = os.path.abspath(sketch_path)
+        digest = hashlib.sha256(f"{sketch}:{fqbn}".encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.root, f"{os.path.splitext(os.path.basename(sketch))[0]}-{digest}")
+
+    def prepare(self, sketch_path, fqbn, fingerprint):
+        """
+        Возвращает каталог сборки и признак тёплой сборки. Каталог с другим отпечатком
+        инструментов очищается, чтобы не слинковать устаревшие объекты.
+        """
+        path = self.path_for(sketch_path, fqbn)
+        stamp_path = os.path.join(path, self.STAMP_FILE)
+        stamp = {"fqbn": fqbn, "fingerprint": fingerprint}
+        try:
+            with open(stamp_path, "r", encoding="utf-8") as f:
+                warm = json.load(f) == stamp
+        except (OSError, ValueError):
+            warm = False
+        if not warm:
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+            with open(stamp_path, "w", encoding="utf-8") as f:
+                json.dump(stamp, f)
+        os.utime(path)
+        self.evict()
+        return path, warm
+
+    def evict(self):
+        """Удаляет давно не использованные каталоги сборки сверх max_entries."""
+        if not os.path.isdir(self.root):
+            return
+        entries = sorted((os.path.getmtime(os.path.join(self.root, name)), os.path.join(self.root, name))
+                         for name in os.listdir(self.root))
+        for _, path in entries[:-self.max_entries]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def record_compile_metrics(fqbn, seconds, warm, metrics_path=COMPILE_METRICS_PATH):
+    """Дописывает время компиляции в журнал, чтобы сравнивать холодные и тёплые сборки."""
+    os.makedirs(os.path.dirname(metrics_path) or ".", exist_ok=True)
+    with open(metrics_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"time": time.time(), "fqbn": fqbn, "seconds": round(seconds, 3), "warm": warm}) + "\n")
+
+
+def load_compile_metrics(metrics_path=COMPILE_METRICS_PATH):
+    try:
+        with open(metrics_path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
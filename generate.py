@@ -1,5 +1,160 @@
+import binascii
+import hashlib
+import json
+import os
 import re
 
+from tracing import span
+
+# Версия генератора входит в ключ кеша прошивок: увеличивать при любом изменении генерируемого кода
+GENERATOR_VERSION = 15
+
+# Тайминги кнопок по умолчанию, мс. REPEAT_MS = 0 отключает автоповтор
+DEBOUNCE_MS = 5
+HOLD_MS = 500
+REPEAT_MS = 0
+
+# Исполнитель действий: время удержания комбинации, символов текста за один проход loop()
+# в прошивке с раскладкой в EEPROM (каждый символ - два USB-отчёта, около 1 мс каждый)
+# и длина очереди сработавших действий
+KEY_PRESS_MS = 50
+TYPE_CHUNK = 2
+ACTION_QUEUE_SIZE = 8
+MAX_WAIT_MS = 0xFFFF
+
+# ATmega32U4: 32 КБ flash, из них 4 КБ занимает загрузчик Caterina, и 2.5 КБ SRAM.
+# База - оценка прошивки без таблиц действий (HID-Project, Adafruit_SSD1306 с буфером кадра,
+# исполнитель, энкодер, стек) с запасом: точный размер сообщает arduino-cli, а переполнение
+# по этой оценке видно до компиляции
+FLASH_SIZE = 28672
+SRAM_SIZE = 2560
+FIRMWARE_BASE_FLASH = 22528
+FIRMWARE_BASE_SRAM = 1536
+# struct Button на каждую кнопку и кнопку энкодера
+BUTTON_STATE_SRAM = 10
+
+# OLED 128x32 на SSD1306: 4 страницы по 8 строк. Экран делится на области, и в кадре передаются
+# только изменившиеся. Кадры не чаще FRAME_MS, за один проход loop() - одна передача Wire не длиннее её буфера
+OLED_WIDTH = 128
+OLED_PAGES = 4
+I2C_CLOCK_HZ = 400000
+FRAME_MS = 50
+# Буфер Wire на AVR - 32 байта, из них один занимает управляющий байт 0x40
+WIRE_CHUNK = 31
+# Имя, первая и последняя страница, первый и последний столбец
+DISPLAY_REGIONS = [
+    ('REGION_MODE', 0, 1, 0, OLED_WIDTH - 1),
+    ('REGION_ENCODER', 3, 3, 0, OLED_WIDTH // 2 - 1),
+    ('REGION_LAST_ACTION', 3, 3, OLED_WIDTH // 2, OLED_WIDTH - 1),
+]
+
+# Клавиатуры HID-Project: составная Keyboard на общем HID-интерфейсе, BootKeyboard (6KRO, работает в BIOS)
+# и SingleNKROKeyboard (NKRO). Две последние получают собственную конечную точку с периодом опроса
+# HID_POLL_INTERVAL, который задаётся флагом сборки (см. firmware_build_properties)
+HID_KEYBOARDS = {'keyboard': 'Keyboard', 'boot': 'BootKeyboard', 'nkro': 'SingleNKROKeyboard'}
+POLL_INTERVAL_MS = 1
+MODIFIER_KEYS = {'KEY_LEFT_CTRL', 'KEY_LEFT_SHIFT', 'KEY_LEFT_ALT', 'KEY_LEFT_GUI'}
+BOOT_REPORT_KEYS = 6
+
+# Профили печати текста: сколько клавиш удерживается в отчёте и наименьший промежуток между отчётами, мкс.
+# Новая клавиша в отчёте всегда одна: порядок нескольких новых клавиш одного отчёта хост не гарантирует.
+# 'standard' - нажатие и отпускание на символ, как Keyboard.write; 'fast' держит предыдущие клавиши
+# и отпускает их только перед повтором клавиши или сменой Shift - около отчёта на символ;
+# 'safe' - для удалённых рабочих столов и виртуальных машин, теряющих нажатия короче двух опросов
+TYPING_PROFILES = {
+    'safe': {'keys_per_report': 1, 'report_gap_us': 2000},
+    'standard': {'keys_per_report': 1, 'report_gap_us': 0},
+    'fast': {'keys_per_report': BOOT_REPORT_KEYS, 'report_gap_us': 0},
+}
+TYPING_PROFILE = 'standard'
+# Текст хранится во flash кодами HID, старший бит кода - Shift
+TYPING_SHIFT = 0x80
+
+# Действия на компьютере (тип 'Host Action'): кнопка отправляет по USB-serial номер события, а host_bridge.py
+# выполняет действие из той же конфигурации. Строка действия - '<вид> <аргумент>', после '||' - макрос,
+# который прошивка выполнит сама, если хост не слушает: от него не было кадра дольше HOST_ALIVE_MS
+# или он не ответил на событие за HOST_ACK_TIMEOUT_MS
+HOST_ACTION_KINDS = ('paste', 'paste-file', 'run', 'open')
+HOST_FALLBACK_SEPARATOR = '||'
+HOST_ACK_TIMEOUT_MS = 250
+HOST_ALIVE_MS = 3000
+HOST_PENDING = 4
+# Кадр в обе стороны: '#', тип, номер (2 hex), аргумент (4 hex) и XOR символов от типа до аргумента (2 hex).
+# Прошивка завершает кадр '\n'; текст без пробелов, поэтому кадры можно передать и сценарием симулятора
+HOST_FRAME_LENGTH = 10
+HOST_FRAME_EVENT = 'E'
+HOST_FRAME_HELLO = 'H'
+HOST_FRAME_ACK = 'A'
+# Ответы хоста на событие: выполнено, вставить из буфера обмена Ctrl+V или Win (Cmd) + V, не выполнено
+# и нужен резервный макрос
+HOST_ACK_DONE = 0
+HOST_ACK_PASTE = 1
+HOST_ACK_PASTE_GUI = 2
+HOST_ACK_REJECTED = 3
+HOST_PASTE_KEYS = [('KEY_LEFT_CTRL', 'KEY_V'), ('KEY_LEFT_GUI', 'KEY_V')]
+# Разбор кадров и ожидание ответов; в SRAM - события, ждущие ответа, и буфер кадра
+HOST_BRIDGE_FLASH = 900
+HOST_BRIDGE_SRAM = 8 * HOST_PENDING + HOST_FRAME_LENGTH + 8
+
+# Тап/удержание и слои. У кнопки с ключом 'hold' ({'type', 'action', 'timeout_ms', 'permissive'}) отпускание
+# до timeout_ms - тап (основное действие), удержание дольше - действие 'hold'; с permissive удержание выбирается
+# и раньше, если за это время нажали и отпустили другую кнопку. Нажатия других кнопок до решения ждут его
+# в буфере на TAP_HOLD_BUFFER нажатий, остальные кнопки срабатывают сразу. Слой - режим, действия которого
+# заменяют действия текущего режима ('Momentary Layer' - пока кнопка нажата, 'Toggle Layer' - до повторного
+# нажатия), пустые кнопки слоя берут действие режима. Режимы с 'layer_only' кнопка энкодера пропускает
+TAP_HOLD_MS = 200
+TAP_HOLD_PERMISSIVE = True
+TAP_HOLD_BUFFER = 8
+LAYER_ACTION_TYPES = {'Momentary Layer': 'layer-momentary', 'Toggle Layer': 'layer-toggle'}
+# Обработка событий кнопок, слои и решение тап/удержание; в SRAM - состояние слоёв, решение и буфер нажатий
+KEY_EVENTS_FLASH = 700
+KEY_EVENTS_SRAM = 16 + TAP_HOLD_BUFFER
+
+# Функции энкодера в порядке их кодов в EEPROM (keymap.py): константа, подпись на экране и коды Consumer
+# для вращения по и против часовой стрелки. Прокрутка идёт колесом мыши, одним отчётом на все шаги
+ENCODER_FUNCTIONS = {
+    'Nothing': ('ENCODER_NOTHING', '', None, None),
+    'Volume': ('ENCODER_VOLUME', 'Vol', 'MEDIA_VOLUME_UP', 'MEDIA_VOLUME_DOWN'),
+    'Scroll': ('ENCODER_SCROLL', 'Scrl', None, None),
+    'Brightness': ('ENCODER_BRIGHTNESS', 'Brt', 'CONSUMER_BRIGHTNESS_UP', 'CONSUMER_BRIGHTNESS_DOWN'),
+    'Seek': ('ENCODER_SEEK', 'Seek', 'MEDIA_FAST_FORWARD', 'MEDIA_REWIND'),
+}
+# Выводы 5 и 6 на ATmega32U4 не дают ни внешнего прерывания, ни PCINT, поэтому энкодер опрашивается
+# в прерывании таймера 3 с частотой ENCODER_SAMPLE_HZ, независимо от длительности loop().
+# Щелчки чаще ENCODER_ACCEL_MS друг за другом ускоряют вращение, вплоть до ENCODER_ACCEL_MAX шагов на щелчок
+ENCODER_SAMPLE_HZ = 2000
+ENCODER_STEPS_PER_DETENT = 4
+ENCODER_ACCEL_MS = 40
+ENCODER_ACCEL_MAX = 4
+
+# Телеметрия (сборка с -DTELEMETRY): счётчики и гистограмма времени прохода loop() по степеням двойки,
+# корзина 0 - проходы короче TELEMETRY_FIRST_BUCKET_US, последняя - все длиннее.
+# Хост запрашивает строку "TLM имя=значение ..." командой TR по USB-serial
+TELEMETRY_FLAG = "-DTELEMETRY"
+TELEMETRY_BUCKETS = 12
+TELEMETRY_FIRST_BUCKET_US = 16
+TELEMETRY_VERSION = 1
+TELEMETRY_COUNTERS = ['loops', 'actionsQueued', 'actionsDropped', 'actionsDone', 'actionMsTotal',
+                      'encoderDetents', 'encoderSteps', 'encoderSkipped', 'encoderDiscarded']
+TELEMETRY_MAXIMA = ['loopMaxUs', 'actionMsMax']
+# Структура Telemetry: счётчики, максимумы, гистограмма, время начала действия и прошлого прохода
+TELEMETRY_SRAM = 4 * (len(TELEMETRY_COUNTERS) + len(TELEMETRY_MAXIMA) + TELEMETRY_BUCKETS + 2)
+
+# Порт и бит ATmega32U4 для выводов Arduino Pro Micro (вариант leonardo)
+PRO_MICRO_PORTS = {
+    0: ('D', 2), 1: ('D', 3), 2: ('D', 1), 3: ('D', 0), 4: ('D', 4), 5: ('C', 6),
+    6: ('D', 7), 7: ('E', 6), 8: ('B', 4), 9: ('B', 5), 10: ('B', 6), 14: ('B', 3),
+    15: ('B', 1), 16: ('B', 2), 18: ('F', 7), 19: ('F', 6), 20: ('F', 5), 21: ('F', 4),
+}
+# SDA/SCL дисплея и выводы энкодера
+RESERVED_PINS = {2, 3, 4, 5, 6}
+# Столбцы по умолчанию целиком на порту B: строка матрицы читается одним чтением PINB
+# Кнопки на отдельных выводах занимают свободные выводы Pro Micro по порядку, 0 и 1 (Serial1) - последними
+DIRECT_BUTTON_PINS = [7, 8, 9, 10, 14, 15, 16, 18, 19, 20, 21, 0, 1]
+MATRIX_COLUMN_PINS = [8, 9, 10, 14, 15, 16]
+MATRIX_ROW_PINS = [18, 19, 20, 21, 7, 0, 1]
+MATRIX_SETTLE_US = 3
+
 # Словарь для сопоставления строковых названий клавиш с константами из HID-Project.h
 KEY_MAP = {
     'ctrl': 'KEY_LEFT_CTRL', 'shift': 'KEY_LEFT_SHIFT', 'alt': 'KEY_LEFT_ALT',
@@ -10,147 +165,2293 @@ KEY_MAP = {
     'f1': 'KEY_F1', 'f2': 'KEY_F2', 'f3': 'KEY_F3', 'f4': 'KEY_F4',
     'f5': 'KEY_F5', 'f6': 'KEY_F6', 'f7': 'KEY_F7', 'f8': 'KEY_F8',
     'f9': 'KEY_F9', 'f10': 'KEY_F10', 'f11': 'KEY_F11', 'f12': 'KEY_F12',
+    # Названия, которые записывает KeyCaptureLineEdit в main.py
+    'escape': 'KEY_ESC', 'space': 'KEY_SPACE', 'return': 'KEY_ENTER', 'control': 'KEY_LEFT_CTRL',
+}
+
+# Названия констант HID-Project.h для одиночных символов (раскладка US, без Shift)
+CHAR_KEY_MAP = {chr(ord('a') + i): f'KEY_{chr(ord("A") + i)}' for i in range(26)}
+CHAR_KEY_MAP.update({str(i): f'KEY_{i}' for i in range(10)})
+CHAR_KEY_MAP.update({
+    ' ': 'KEY_SPACE', '-': 'KEY_MINUS', '=': 'KEY_EQUAL', '[': 'KEY_LEFT_BRACE',
+    ']': 'KEY_RIGHT_BRACE', '\\': 'KEY_BACKSLASH', ';': 'KEY_SEMICOLON', "'": 'KEY_QUOTE',
+    '`': 'KEY_TILDE', ',': 'KEY_COMMA', '.': 'KEY_PERIOD', '/': 'KEY_SLASH',
+})
+
+# Символы, которые печатаются с Shift, и клавиша под ними в раскладке US
+SHIFTED_CHARS = dict(zip('!@#$%^&*()_+{}|:"~<>?', '1234567890-=[]\\;\'`,./'))
+TYPING_KEYS = {**CHAR_KEY_MAP, '\n': 'KEY_ENTER', '\t': 'KEY_TAB'}
+
+# Числовые коды HID (usage id) для констант, нужны для бинарной раскладки в EEPROM
+HID_KEYCODES = {
+    'KEY_LEFT_CTRL': 0xE0, 'KEY_LEFT_SHIFT': 0xE1, 'KEY_LEFT_ALT': 0xE2,
+    'KEY_LEFT_GUI': 0xE3, 'KEY_ESC': 0x29, 'KEY_ENTER': 0x28,
+    'KEY_TAB': 0x2B, 'KEY_BACKSPACE': 0x2A, 'KEY_DELETE': 0x4C,
+    'KEY_INSERT': 0x49, 'KEY_UP_ARROW': 0x52, 'KEY_DOWN_ARROW': 0x51,
+    'KEY_LEFT_ARROW': 0x50, 'KEY_RIGHT_ARROW': 0x4F,
+    'KEY_0': 0x27, 'KEY_SPACE': 0x2C, 'KEY_MINUS': 0x2D, 'KEY_EQUAL': 0x2E,
+    'KEY_LEFT_BRACE': 0x2F, 'KEY_RIGHT_BRACE': 0x30, 'KEY_BACKSLASH': 0x31,
+    'KEY_SEMICOLON': 0x33, 'KEY_QUOTE': 0x34, 'KEY_TILDE': 0x35,
+    'KEY_COMMA': 0x36, 'KEY_PERIOD': 0x37, 'KEY_SLASH': 0x38,
 }
+HID_KEYCODES.update({f'KEY_F{i}': 0x3A + i - 1 for i in range(1, 13)})
+HID_KEYCODES.update({f'KEY_{chr(ord("A") + i)}': 0x04 + i for i in range(26)})
+HID_KEYCODES.update({f'KEY_{i}': 0x1E + i - 1 for i in range(1, 10)})
+
+
+def key_constant(part):
+    """Возвращает имя константы HID-Project.h для названия клавиши или None."""
+    part = part.strip().lower()
+    return KEY_MAP.get(part) or CHAR_KEY_MAP.get(part)
+
+
+def key_to_hid(part):
+    """Возвращает код HID для названия клавиши или None, если клавиша неизвестна."""
+    constant = key_constant(part)
+    return HID_KEYCODES[constant] if constant else None
 
 
-def parse_and_press_keys(action_string):
-    """Генерирует C++ код для нажатия комбинации клавиш."""
-    if not action_string.strip():
-        return "        // No action defined\n"
+def typing_code(char):
+    """Код HID символа для печати (TYPING_SHIFT - с Shift) или None, если символ не напечатать."""
+    if char in TYPING_KEYS:
+        return HID_KEYCODES[TYPING_KEYS[char]]
+    base = SHIFTED_CHARS.get(char) or (char.lower() if 'A' <= char <= 'Z' else None)
+    return HID_KEYCODES[CHAR_KEY_MAP[base]] | TYPING_SHIFT if base else None
 
-    parts = [p.strip().lower() for p in action_string.split('+')]
-    press_calls = []
 
-    for part in parts:
-        if part in KEY_MAP:
-            press_calls.append(f"            Keyboard.press({KEY_MAP[part]});")
-        elif len(part) == 1:
-            press_calls.append(f"            Keyboard.press('{part}');")
+def typing_reports(text, profile=TYPING_PROFILE):
+    """
+    Отчёты клавиатуры, которыми исполнитель печатает text, в порядке отправки: [(shift, клавиши)],
+    пустые клавиши - отпускание. Повторяет typeText() из generate_action_executor.
+    """
+    keys_per_report = TYPING_PROFILES[profile]['keys_per_report']
+    reports = []
+    held = []
+    shift = False
+    for char in text:
+        code = typing_code(char)
+        key, key_shift = code & ~TYPING_SHIFT, bool(code & TYPING_SHIFT)
+        if held and (keys_per_report == 1 or key in held or key_shift != shift):
+            held = []
+            reports.append((False, ()))
+        if len(held) == keys_per_report:
+            held.pop(0)
+        held.append(key)
+        shift = key_shift
+        reports.append((shift, tuple(held)))
+    if held:
+        reports.append((False, ()))
+    return reports
+
+
+def parse_key_sequence(action_string):
+    """Разбирает комбинацию клавиш на константы HID-Project.h и неизвестные части."""
+    keys = []
+    unknown = []
+    for part in action_string.split('+'):
+        if not part.strip():
+            continue
+        constant = key_constant(part)
+        if constant:
+            keys.append(constant)
+        else:
+            unknown.append(part.strip().lower())
+    return tuple(keys), unknown
+
+
+def c_string_literal(text):
+    """Экранирует строку для вставки в C++ код."""
+    escaped = []
+    for char in text:
+        if char in '\\"':
+            escaped.append('\\' + char)
+        elif char == '\n':
+            escaped.append('\\n')
+        elif ' ' <= char <= '~':
+            escaped.append(char)
+        else:
+            # Восьмеричная запись всегда ограничена тремя цифрами и не съедает следующие символы
+            escaped.extend(f'\\{byte:03o}' for byte in char.encode('utf-8'))
+    return '"' + ''.join(escaped) + '"'
+
+
+def parse_macro(action_string):
+    """
+    Разбирает макрос: шаги через ';' - комбинация клавиш, "текст" в кавычках или wait <мс>.
+    Возвращает шаги ('keys', комбинация) / ('text', строка) / ('wait', мс) и неизвестные части.
+    """
+    steps = []
+    unknown = []
+    for part in action_string.split(';'):
+        part = part.strip()
+        if not part:
+            continue
+        words = part.split()
+        if len(part) >= 2 and part[0] == part[-1] == '"':
+            steps.append(('text', part[1:-1]))
+        elif words[0].lower() in ('wait', 'delay') and len(words) == 2 and words[1].isdigit():
+            steps.append(('wait', min(int(words[1]), MAX_WAIT_MS)))
         else:
-            press_calls.append(f"            // Unknown key: {part}")
+            keys, unknown_keys = parse_key_sequence(part)
+            unknown.extend(unknown_keys)
+            if keys:
+                steps.append(('keys', keys))
+    return steps, unknown
+
+
+def parse_host_action(action_string):
+    """
+    Разбирает действие на компьютере '<вид> <аргумент> || <резервный макрос>'.
+    Возвращает (вид, аргумент, шаги резервного макроса, неизвестные клавиши); вид None для пустой строки.
+    """
+    action, _, fallback = action_string.partition(HOST_FALLBACK_SEPARATOR)
+    kind, _, argument = action.strip().partition(' ')
+    steps, unknown = parse_macro(fallback)
+    return kind.lower() or None, argument.strip(), steps, unknown
+
+
+def host_config_id(host_events):
+    """16-битный идентификатор набора действий на компьютере: прошивка сообщает его в кадре H, хост сверяет."""
+    data = json.dumps([[kind, argument] for kind, argument, _ in host_events], ensure_ascii=False)
+    return binascii.crc_hqx(data.encode('utf-8'), 0xFFFF)
+
+
+def build_progmem_tables(modes, num_standard_buttons):
+    """
+    Собирает тексты, комбинации клавиш и программы действий всех режимов в общие таблицы без повторов.
+    Программа - последовательность шагов ('press', комбинация) / ('release', 0) / ('wait', мс) /
+    ('text', строка) с индексами в таблицах текстов и комбинаций. Для каждого режима возвращает
+    (вид действия, индекс программы, неизвестные клавиши) по кнопкам; у действий на компьютере
+    вместо программы - номер события в host_events: (вид, аргумент, резервная программа или None),
+    у слоёв - номер режима слоя, у кнопок тап/удержание - номер в tap_holds:
+    ((вид, индекс) тапа, (вид, индекс) удержания, время решения, permissive).
+    Номера событий зависят только от режимов, поэтому host_bridge.py получает те же, что прошивка.
+    """
+    texts = {}
+    key_sequences = {}
+    programs = {}
+    host_events = {}
+    tap_holds = {}
+    mode_indices = {mode_name: i for i, mode_name in enumerate(modes)}
+    mode_actions = []
+
+    def add_program(macro_steps):
+        program = []
+        for kind, value in macro_steps:
+            if kind == 'keys':
+                program.append(('press', key_sequences.setdefault(value, len(key_sequences))))
+                program.append(('wait', KEY_PRESS_MS))
+                program.append(('release', 0))
+            elif kind == 'text':
+                program.append(('text', texts.setdefault(value, len(texts))))
+            else:
+                program.append((kind, value))
+        return programs.setdefault(tuple(program), len(programs))
 
-    if not press_calls:
-        return ""
+    def add_action(button_data):
+        action_type, action = button_data.get('type'), button_data.get('action', '')
+        if action_type == 'Key Combination':
+            keys, unknown = parse_key_sequence(action)
+            if keys:
+                return 'keys', add_program([('keys', keys)]), unknown
+            return 'none', None, unknown
+        if action_type == 'Print Text' and action:
+            return 'text', add_program([('text', action)]), []
+        if action_type == 'Macro':
+            steps, unknown = parse_macro(action)
+            if steps:
+                return 'macro', add_program(steps), unknown
+            return 'none', None, unknown
+        if action_type == 'Host Action':
+            kind, argument, steps, unknown = parse_host_action(action)
+            if kind:
+                event = (kind, argument, add_program(steps) if steps else None)
+                return 'host', host_events.setdefault(event, len(host_events)), unknown
+            return 'none', None, unknown
+        if action_type in LAYER_ACTION_TYPES and action.strip() in mode_indices:
+            return LAYER_ACTION_TYPES[action_type], mode_indices[action.strip()], []
+        return 'none', None, []
 
-    code = "\n".join(press_calls)
-    code += "\n            delay(50);\n"
-    code += "            Keyboard.releaseAll();\n"
-    return code
+    for mode_name, mode_data in modes.items():
+        actions = []
+        for i in range(num_standard_buttons):
+            button_data = mode_data.get('standard_buttons', {}).get(f"button{i + 1}")
+            if button_data is None:
+                actions.append(None)
+                continue
+            action = add_action(button_data)
+            hold_data = button_data.get('hold')
+            if hold_data:
+                hold = add_action(hold_data)
+                if hold[0] != 'none':
+                    tap_hold = (action[:2], hold[:2], hold_data.get('timeout_ms', TAP_HOLD_MS),
+                                bool(hold_data.get('permissive', TAP_HOLD_PERMISSIVE)))
+                    action = ('taphold', tap_holds.setdefault(tap_hold, len(tap_holds)), action[2] + hold[2])
+            actions.append(action)
+        mode_actions.append(actions)
+
+    # Комбинации вставки, которые хост просит нажать после записи текста в буфер обмена
+    host_paste_programs = [add_program([('keys', keys)]) for keys in HOST_PASTE_KEYS] if host_events else []
+    return {'texts': list(texts), 'key_sequences': list(key_sequences), 'programs': list(programs),
+            'mode_actions': mode_actions, 'host_events': list(host_events),
+            'host_paste_programs': host_paste_programs, 'tap_holds': list(tap_holds),
+            'layer_only': [i for i, mode_data in enumerate(modes.values()) if mode_data.get('layer_only')]}
+
+
+def uses_key_events(tables):
+    """Нужна ли обработка нажатий и отпусканий вместо срабатывания по нажатию: есть тап/удержание или слои."""
+    return bool(tables['tap_holds']) or any(action and action[0] in LAYER_ACTION_TYPES.values()
+                                            for actions in tables['mode_actions'] for action in actions)
+
+
+def action_index_type(tables):
+    """Тип ActionIndex: номер программы, события на компьютере, тап/удержания или режима слоя."""
+    counts = (len(tables['programs']), len(tables['host_events']), len(tables['tap_holds']),
+              len(tables['mode_actions']))
+    return "uint8_t" if max(counts) <= 256 else "uint16_t"
+
+
+def action_programs(tables, action):
+    """
+    Программы, которые может выполнить прошивка по действию: у действия на компьютере - резервная,
+    у тап/удержания - программы обоих действий.
+    """
+    if not action:
+        return []
+    if action[0] == 'taphold':
+        tap, hold, _, _ = tables['tap_holds'][action[1]]
+        return action_programs(tables, tap) + action_programs(tables, hold)
+    if action[0] == 'host':
+        program = tables['host_events'][action[1]][2]
+        return [] if program is None else [program]
+    if action[0] in ('keys', 'text', 'macro'):
+        return [action[1]]
+    return []
+
+
+def _text_size(text):
+    return len(text.encode('utf-8')) + 1
 
 
-def generate_ino_file(modes, num_standard_buttons, num_drop_buttons):
+# Шаг программы во flash: код операции и 16-битный аргумент
+STEP_SIZE = 3
+TAP_HOLD_SIZE = 2 * (1 + 2) + 3
+
+
+def _program_size(tables, index):
+    """Размер программы во flash вместе с текстами и комбинациями, на которые она ссылается."""
+    program = tables['programs'][index]
+    size = STEP_SIZE * (len(program) + 1)
+    for op, arg in program:
+        if op == 'text':
+            size += _text_size(tables['texts'][arg])
+        elif op == 'press':
+            size += len(tables['key_sequences'][arg]) + 1
+    return size
+
+
+def memory_report(modes, tables):
+    """Считает занятость flash и SRAM таблицами строк и программ по каждому режиму."""
+    usage = {}
+    for actions in tables['mode_actions']:
+        for action in actions:
+            for index in action_programs(tables, action):
+                usage[index] = usage.get(index, 0) + 1
+
+    rows = []
+    for mode_name, actions in zip(modes, tables['mode_actions']):
+        row = {'mode': mode_name, 'actions': 0, 'flash': 0, 'shared': 0, 'inline_sram': _text_size(mode_name)}
+        for action in actions:
+            if not action or action[0] == 'none':
+                continue
+            row['actions'] += 1
+            for index in action_programs(tables, action):
+                row['inline_sram'] += sum(_text_size(tables['texts'][arg])
+                                          for op, arg in tables['programs'][index] if op == 'text')
+                if usage[index] > 1:
+                    row['shared'] += 1
+                else:
+                    row['flash'] += _program_size(tables, index)
+        rows.append(row)
+
+    # Каждая запись таблицы дополнительно стоит указатель (2 байта) в таблице указателей
+    flash = sum(_text_size(text) + 2 for text in tables['texts'])
+    flash += sum(len(keys) + 1 + 2 for keys in tables['key_sequences'])
+    flash += sum(STEP_SIZE * (len(program) + 1) + 2 for program in tables['programs'])
+    flash += sum(_text_size(mode_name) for mode_name in modes)
+    # Резервная программа каждого события на компьютере - int16_t
+    flash += 2 * len(tables['host_events'])
+    # Запись TAP_HOLDS: два Action, время решения и permissive
+    flash += TAP_HOLD_SIZE * len(tables['tap_holds'])
+    return {'modes': rows, 'flash': flash, 'sram': 0, 'inline_sram': sum(row['inline_sram'] for row in rows)}
+
+
+def format_memory_report(report):
+    """Форматирует отчёт о памяти в виде таблицы."""
+    lines = [f"{'Режим':<20}{'Действий':>10}{'Flash':>8}{'Общих':>8}{'SRAM без PROGMEM':>18}"]
+    for row in report['modes']:
+        lines.append(f"{row['mode'][:20]:<20}{row['actions']:>10}{row['flash']:>8}{row['shared']:>8}"
+                     f"{row['inline_sram']:>18}")
+    lines.append(f"Таблицы во flash: {report['flash']} байт, в SRAM: {report['sram']} байт "
+                 f"(строки в SRAM заняли бы {report['inline_sram']} байт)")
+    return "\n".join(lines)
+
+
+def count_action_reports(tables, single_report=True, typing=TYPING_PROFILE):
+    """
+    Считает USB-отчёты, которые отправляет каждая программа действий: комбинация - один отчёт
+    на нажатие при single_report или по отчёту на клавишу, отпускание - один, текст - по typing_reports.
+    """
+    counts = []
+    for program in tables['programs']:
+        reports = 0
+        for op, arg in program:
+            if op == 'press':
+                reports += 1 if single_report else len(tables['key_sequences'][arg])
+            elif op == 'release':
+                reports += 1
+            elif op == 'text':
+                reports += len(typing_reports(tables['texts'][arg], typing))
+        counts.append(reports)
+    return counts
+
+
+def format_report_counts(modes, tables, single_report=True, typing=TYPING_PROFILE):
+    """Форматирует наибольшее число USB-отчётов на действие по режимам."""
+    counts = count_action_reports(tables, single_report, typing)
+    parts = []
+    for mode_name, actions in zip(modes, tables['mode_actions']):
+        mode_counts = [counts[index] for action in actions for index in action_programs(tables, action)]
+        parts.append(f"{mode_name} {max(mode_counts, default=0)}")
+    return "USB-отчётов на действие (макс.): " + ", ".join(parts)
+
+
+class ValidationError(ValueError):
+    """Все ошибки конфигурации, найденные validate_config, одним исключением."""
+
+    def __init__(self, errors):
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+
+def _untypeable_chars(text):
+    """Символы, которых нет в раскладке US (см. typing_code)."""
+    return sorted({char for char in text if typing_code(char) is None})
+
+
+def estimate_memory(modes, tables, num_standard_buttons, matrix=None, telemetry=False):
+    """Оценка flash и SRAM всей прошивки: база из FIRMWARE_BASE_* плюс то, что зависит от конфигурации."""
+    index_size = 1 if action_index_type(tables) == "uint8_t" else 2
+    flash = FIRMWARE_BASE_FLASH + memory_report(modes, tables)['flash']
+    # ACTIONS[режим][кнопка], MODE_NAMES и MODE_ENCODER_FUNCTIONS
+    flash += len(modes) * (num_standard_buttons * (1 + index_size) + 2 + 1)
+    sram = FIRMWARE_BASE_SRAM + BUTTON_STATE_SRAM * (num_standard_buttons + 1)
+    if matrix:
+        sram += 2 * len(matrix['rows'])
+    if telemetry:
+        sram += TELEMETRY_SRAM
+    if tables['host_events']:
+        flash += HOST_BRIDGE_FLASH
+        sram += HOST_BRIDGE_SRAM
+    if uses_key_events(tables):
+        flash += KEY_EVENTS_FLASH
+        sram += KEY_EVENTS_SRAM
+    if tables['layer_only']:
+        flash += len(modes)
+    return {'flash': flash, 'sram': sram}
+
+
+def validate_config(modes, num_standard_buttons, num_drop_buttons, matrix=None, keyboard='keyboard',
+                    telemetry=False, typing=TYPING_PROFILE):
+    """
+    Проверяет конфигурацию до генерации и компиляции и сводит действия к таблицам build_progmem_tables
+    с константами клавиш HID-Project. Собирает все ошибки сразу: неизвестные клавиши, функции энкодера
+    и типы действий, слои и время решения тап/удержание, символы, которых нельзя напечатать,
+    совпадающие имена классов режимов, выводы и оценку flash и SRAM. Возвращает (ошибки, таблицы);
+    таблицы None, если их не удалось построить.
+    """
+    errors = []
+    if not modes:
+        errors.append("Нет ни одного режима")
+    elif len(modes) > 255:
+        errors.append(f"Режимов {len(modes)}, поддерживается не больше 255")
+    if keyboard not in HID_KEYBOARDS:
+        errors.append(f"Неизвестная клавиатура: {keyboard}")
+    if typing not in TYPING_PROFILES:
+        errors.append(f"Неизвестный профиль печати: {typing}")
+    if num_standard_buttons > 64:
+        errors.append(f"Кнопок {num_standard_buttons}, поддерживается не больше 64")
+
+    # Выводы кнопок
+    if matrix:
+        try:
+            check_matrix(matrix)
+        except ValueError as e:
+            errors.append(str(e))
+    elif num_standard_buttons > len(DIRECT_BUTTON_PINS):
+        errors.append(f"Кнопок {num_standard_buttons}, на отдельных выводах Pro Micro помещается "
+                      f"{len(DIRECT_BUTTON_PINS)}: используйте матрицу кнопок")
+
+    def check_action(where, button_data):
+        if not isinstance(button_data, dict) or not isinstance(button_data.get('action', ''), str):
+            errors.append(f"{where}: ожидается {{'type': ..., 'action': строка}}")
+            return
+        action_type, action = button_data.get('type'), button_data.get('action', '')
+        if action_type == 'Key Combination':
+            keys, unknown = parse_key_sequence(action)
+            untypeable = []
+            non_modifiers = [key for key in keys if key not in MODIFIER_KEYS]
+            if keyboard != 'nkro' and len(non_modifiers) > BOOT_REPORT_KEYS:
+                errors.append(f"{where}: комбинация длиннее {BOOT_REPORT_KEYS} клавиш, "
+                              f"лишние не дойдут без NKRO")
+        elif action_type == 'Print Text':
+            unknown = []
+            untypeable = _untypeable_chars(action)
+        elif action_type == 'Macro':
+            steps, unknown = parse_macro(action)
+            untypeable = _untypeable_chars("".join(value for kind, value in steps if kind == 'text'))
+            for part in action.split(';'):
+                words = part.split()
+                if len(words) == 2 and words[0].lower() in ('wait', 'delay') and words[1].isdigit() \
+                        and int(words[1]) > MAX_WAIT_MS:
+                    errors.append(f"{where}: пауза {words[1]} мс длиннее {MAX_WAIT_MS} мс")
+        elif action_type == 'Host Action':
+            kind, argument, steps, unknown = parse_host_action(action)
+            untypeable = _untypeable_chars("".join(value for step, value in steps if step == 'text'))
+            if kind is not None and kind not in HOST_ACTION_KINDS:
+                errors.append(f"{where}: неизвестное действие на компьютере '{kind}', "
+                              f"возможны {', '.join(HOST_ACTION_KINDS)}")
+            elif kind is not None and not argument:
+                errors.append(f"{where}: у действия '{kind}' нет аргумента")
+        elif action_type in LAYER_ACTION_TYPES:
+            unknown, untypeable = [], []
+            if action.strip() and action.strip() not in modes:
+                errors.append(f"{where}: слой '{action.strip()}' - не имя режима")
+        else:
+            errors.append(f"{where}: неизвестный тип действия '{action_type}'")
+            return
+        for part in unknown:
+            errors.append(f"{where}: неизвестная клавиша '{part}'")
+        if untypeable:
+            errors.append(f"{where}: символы {''.join(untypeable)!r} нельзя напечатать клавиатурой")
+
+    identifiers = {}
+    for mode_name, mode_data in modes.items():
+        if not mode_name.strip():
+            errors.append("Пустое имя режима")
+        identifiers.setdefault(mode_identifier(mode_name), []).append(mode_name)
+        if not isinstance(mode_data, dict):
+            errors.append(f"{mode_name}: описание режима должно быть объектом")
+            continue
+        try:
+            encoder_function_code(mode_name, mode_data, num_drop_buttons)
+        except ValueError as e:
+            errors.append(str(e))
+
+        standard_buttons = mode_data.get('standard_buttons', {})
+        if not isinstance(standard_buttons, dict):
+            errors.append(f"{mode_name}: standard_buttons должно быть объектом")
+            continue
+        for i in range(num_standard_buttons):
+            button_data = standard_buttons.get(f"button{i + 1}")
+            if button_data is None:
+                continue
+            where = f"{mode_name}, button{i + 1}"
+            check_action(where, button_data)
+            hold_data = button_data.get('hold') if isinstance(button_data, dict) else None
+            if hold_data is None:
+                continue
+            check_action(f"{where}, удержание", hold_data)
+            if not isinstance(hold_data, dict):
+                continue
+            timeout_ms = hold_data.get('timeout_ms', TAP_HOLD_MS)
+            if not isinstance(timeout_ms, int) or not 0 < timeout_ms <= MAX_WAIT_MS:
+                errors.append(f"{where}: время решения тап/удержание {timeout_ms!r}, ожидается от 1 до "
+                              f"{MAX_WAIT_MS} мс")
+            if not isinstance(hold_data.get('permissive', TAP_HOLD_PERMISSIVE), bool):
+                errors.append(f"{where}: permissive должно быть true или false")
+
+    if modes and all(isinstance(mode_data, dict) and mode_data.get('layer_only') for mode_data in modes.values()):
+        errors.append("Все режимы отмечены layer_only: кнопке энкодера не из чего выбирать")
+
+    for identifier, names in identifiers.items():
+        if len(names) > 1:
+            errors.append(f"Режимы {', '.join(repr(name) for name in names)} дают один идентификатор {identifier}")
+
+    tables = None
+    if not errors:
+        tables = build_progmem_tables(modes, num_standard_buttons)
+        estimate = estimate_memory(modes, tables, num_standard_buttons, matrix, telemetry)
+        if estimate['flash'] > FLASH_SIZE:
+            errors.append(f"Прошивка займёт около {estimate['flash']} байт flash из {FLASH_SIZE}: "
+                          f"сократите тексты и макросы")
+        if estimate['sram'] > SRAM_SIZE:
+            errors.append(f"Прошивка займёт около {estimate['sram']} байт SRAM из {SRAM_SIZE}")
+    return errors, tables
+
+
+def validate_sketch_config(modes, num_standard_buttons, num_drop_buttons, matrix=None, keyboard='keyboard',
+                           typing=TYPING_PROFILE):
+    """
+    validate_config так, как его вызывает generate_ino_file: проверка до сборки (cli.py validate, main.py)
+    даёт те же ошибки, что и генерация. Код телеметрии в скетче есть всегда, а включает его флаг сборки
+    (TELEMETRY_FLAG): тот же скетч должен уместиться и со счётчиками, поэтому SRAM оценивается с TELEMETRY_SRAM.
+    """
+    with span("validate_config", modes=len(modes), buttons=num_standard_buttons):
+        return validate_config(modes, num_standard_buttons, num_drop_buttons, matrix, keyboard,
+                               telemetry=True, typing=typing)
+
+
+def _i2c_transfer_us(transmissions, payload_bytes, clock_hz):
+    """Время на шине I2C: 9 тактов на байт (с ACK), адресный байт и старт/стоп на каждую передачу."""
+    clocks = transmissions * (9 + 2) + payload_bytes * 9
+    return clocks * 1_000_000 / clock_hz
+
+
+def display_frame_cost(regions=DISPLAY_REGIONS, clock_hz=I2C_CLOCK_HZ):
+    """
+    Считает передачу на дисплей: байты и время для каждой области, самую долгую передачу
+    (столько занимает дисплей в одном проходе loop()) и полный кадр display() для сравнения.
+    """
+    # PAGEADDR и COLUMNADDR с аргументами - одна передача: 0x00 и шесть байт команд
+    command_bytes = 7
+    cost = {'regions': [], 'pass_us': _i2c_transfer_us(1, command_bytes, clock_hz)}
+    for name, first_page, last_page, first_column, last_column in regions:
+        columns = last_column - first_column + 1
+        chunks = -(-columns // WIRE_CHUNK)
+        pages = last_page - first_page + 1
+        page_us = _i2c_transfer_us(1 + chunks, command_bytes + chunks + columns, clock_hz)
+        cost['regions'].append({'region': name, 'bytes': pages * (command_bytes + chunks + columns),
+                                'us': round(pages * page_us), 'passes': pages * (1 + chunks)})
+        cost['pass_us'] = max(cost['pass_us'], _i2c_transfer_us(1, 1 + min(columns, WIRE_CHUNK), clock_hz))
+    # display() Adafruit_SSD1306 передаёт окно шестью отдельными командами
+    full_bytes = OLED_WIDTH * OLED_PAGES
+    full_chunks = -(-full_bytes // WIRE_CHUNK)
+    cost['full_bytes'] = full_bytes + full_chunks + 12
+    cost['full_us'] = round(_i2c_transfer_us(6 + full_chunks, cost['full_bytes'], clock_hz))
+    cost['pass_us'] = round(cost['pass_us'])
+    return cost
+
+
+def format_display_cost(cost, clock_hz=I2C_CLOCK_HZ):
+    """Форматирует стоимость передачи кадра на дисплей."""
+    regions = ", ".join(f"{row['region'][7:].lower()} {row['bytes']} Б / {row['us']} мкс" for row in cost['regions'])
+    return (f"Дисплей при {clock_hz // 1000} кГц: {regions}; не больше {cost['pass_us']} мкс за проход loop(), "
+            f"полный кадр {cost['full_bytes']} Б / {cost['full_us']} мкс")
+
+
+def generate_display_code(frame_ms=FRAME_MS, regions=DISPLAY_REGIONS):
+    """
+    Генерирует вывод на OLED по областям. Обработчики ввода только помечают область изменённой,
+    renderDisplay() из loop() не чаще frame_ms перерисовывает помеченные области в буфере
+    и передаёт их по одной передаче Wire за проход: окно страницы командами PAGEADDR/COLUMNADDR,
+    затем данные кусками по WIRE_CHUNK байт. Нажатие во время перерисовки ждёт не больше одной такой передачи.
+    Выдаёт строки состояния (до диспетчера действий); отрисовку - generate_display_render_code.
+    """
+    region_names = ", ".join(region[0] for region in regions)
+    yield "\n"
+    yield f"enum DisplayRegion : uint8_t {{ {region_names}, NUM_REGIONS }};\n\n"
+    yield "struct RegionBounds {\n"
+    yield "    uint8_t firstPage;\n"
+    yield "    uint8_t lastPage;\n"
+    yield "    uint8_t firstColumn;\n"
+    yield "    uint8_t lastColumn;\n"
+    yield "};\n\n"
+    bounds = ", ".join(f"{{{first_page}, {last_page}, {first_column}, {last_column}}}"
+                       for _, first_page, last_page, first_column, last_column in regions)
+    yield f"const RegionBounds REGIONS[NUM_REGIONS] PROGMEM = {{{bounds}}};\n"
+    yield f"const unsigned long FRAME_MS = {frame_ms};\n"
+    yield f"const uint8_t WIRE_CHUNK = {WIRE_CHUNK};\n"
+    yield "const uint8_t NO_BUTTON = 0xFF;\n\n"
+    yield "uint8_t dirtyRegions = 0;\n"
+    yield "uint8_t pendingRegions = 0;\n"
+    yield "uint8_t flushPage = 0;\n"
+    yield "// Следующий столбец страницы; PAGE_START - окно адресации страницы ещё не передано\n"
+    yield "const uint8_t PAGE_START = 0xFF;\n"
+    yield "uint8_t flushColumn = PAGE_START;\n"
+    yield "unsigned long lastFrameAt = 0;\n"
+    yield "uint8_t lastButton = NO_BUTTON;\n\n"
+    yield "void markDirty(DisplayRegion region) {\n"
+    yield "    dirtyRegions |= 1 << region;\n"
+    yield "}\n\n"
+    yield "void showLastAction(uint8_t button) {\n"
+    yield "    lastButton = button;\n"
+    yield "    markDirty(REGION_LAST_ACTION);\n"
+    yield "}\n"
+
+
+def generate_display_render_code():
+    """Выдаёт строки отрисовки областей и передачи их на дисплей (после диспетчера и кода энкодера)."""
+    yield "\n"
+    yield "void drawRegion(uint8_t region) {\n"
+    yield "    RegionBounds bounds;\n"
+    yield "    memcpy_P(&bounds, &REGIONS[region], sizeof(RegionBounds));\n"
+    yield "    display.fillRect(bounds.firstColumn, bounds.firstPage * 8, bounds.lastColumn - bounds.firstColumn + 1,\n"
+    yield "                     (bounds.lastPage - bounds.firstPage + 1) * 8, SSD1306_BLACK);\n"
+    yield "    display.setCursor(bounds.firstColumn, bounds.firstPage * 8);\n"
+    yield "    switch (region) {\n"
+    yield "        case REGION_MODE: {\n"
+    yield "            display.setTextSize(2);\n"
+    yield "            const char* name = currentModeName();\n"
+    yield "            char c;\n"
+    yield "            while ((c = pgm_read_byte(name++)) != 0) {\n"
+    yield "                display.write(c);\n"
+    yield "            }\n"
+    yield "            break;\n"
+    yield "        }\n"
+    yield "        case REGION_ENCODER: {\n"
+    yield "            display.setTextSize(1);\n"
+    yield "            const char* label = (const char*)pgm_read_ptr(&ENCODER_LABELS[encoderFunctionInUse]);\n"
+    yield "            if (pgm_read_byte(label) != 0) {\n"
+    yield "                display.print((const __FlashStringHelper*)label);\n"
+    yield "                display.print(' ');\n"
+    yield "                display.print(encoderLevel);\n"
+    yield "            }\n"
+    yield "            break;\n"
+    yield "        }\n"
+    yield "        case REGION_LAST_ACTION:\n"
+    yield "            display.setTextSize(1);\n"
+    yield "            if (lastButton != NO_BUTTON) {\n"
+    yield "                display.print(F(\"Btn \"));\n"
+    yield "                display.print(lastButton + 1);\n"
+    yield "            }\n"
+    yield "            break;\n"
+    yield "    }\n"
+    yield "}\n\n"
+
+    yield "// Одна передача Wire за проход loop(): окно адресации страницы или следующий кусок её данных\n"
+    yield "void flushChunkOf(uint8_t region) {\n"
+    yield "    RegionBounds bounds;\n"
+    yield "    memcpy_P(&bounds, &REGIONS[region], sizeof(RegionBounds));\n"
+    yield "    if (flushPage < bounds.firstPage) {\n"
+    yield "        flushPage = bounds.firstPage;\n"
+    yield "    }\n"
+    yield "    Wire.beginTransmission(OLED_ADDRESS);\n"
+    yield "    if (flushColumn == PAGE_START) {\n"
+    yield "        Wire.write((uint8_t)0x00);\n"
+    yield "        Wire.write((uint8_t)SSD1306_PAGEADDR);\n"
+    yield "        Wire.write(flushPage);\n"
+    yield "        Wire.write(flushPage);\n"
+    yield "        Wire.write((uint8_t)SSD1306_COLUMNADDR);\n"
+    yield "        Wire.write(bounds.firstColumn);\n"
+    yield "        Wire.write(bounds.lastColumn);\n"
+    yield "        Wire.endTransmission();\n"
+    yield "        flushColumn = bounds.firstColumn;\n"
+    yield "        return;\n"
+    yield "    }\n"
+    yield "    const uint8_t* row = display.getBuffer() + flushPage * SCREEN_WIDTH;\n"
+    yield "    Wire.write((uint8_t)0x40);\n"
+    yield "    for (uint8_t i = 0; i < WIRE_CHUNK && flushColumn <= bounds.lastColumn; ++i, ++flushColumn) {\n"
+    yield "        Wire.write(row[flushColumn]);\n"
+    yield "    }\n"
+    yield "    Wire.endTransmission();\n"
+    yield "    if (flushColumn <= bounds.lastColumn) {\n"
+    yield "        return;\n"
+    yield "    }\n"
+    yield "    flushColumn = PAGE_START;\n"
+    yield "    if (++flushPage > bounds.lastPage) {\n"
+    yield "        pendingRegions &= ~(1 << region);\n"
+    yield "        flushPage = 0;\n"
+    yield "    }\n"
+    yield "}\n\n"
+
+    yield "void renderDisplay(unsigned long now) {\n"
+    yield "    if (pendingRegions) {\n"
+    yield "        for (uint8_t region = 0; region < NUM_REGIONS; ++region) {\n"
+    yield "            if (pendingRegions & (1 << region)) {\n"
+    yield "                flushChunkOf(region);\n"
+    yield "                return;\n"
+    yield "            }\n"
+    yield "        }\n"
+    yield "    }\n"
+    yield "    if (!dirtyRegions || now - lastFrameAt < FRAME_MS) {\n"
+    yield "        return;\n"
+    yield "    }\n"
+    yield "    lastFrameAt = now;\n"
+    yield "    for (uint8_t region = 0; region < NUM_REGIONS; ++region) {\n"
+    yield "        if (dirtyRegions & (1 << region)) {\n"
+    yield "            drawRegion(region);\n"
+    yield "        }\n"
+    yield "    }\n"
+    yield "    pendingRegions = dirtyRegions;\n"
+    yield "    dirtyRegions = 0;\n"
+    yield "}\n"
+
+
+def firmware_build_properties(poll_interval_ms=POLL_INTERVAL_MS, extra_flags=()):
+    """
+    Свойства сборки arduino-cli для прошивки: период опроса HID в мс (bInterval конечной точки
+    клавиатуры, 1-255) и дополнительные -D флаги. Флаги попадают и в скетч, и в библиотеки.
+    """
+    if not 1 <= poll_interval_ms <= 255:
+        raise ValueError("Период опроса HID должен быть от 1 до 255 мс")
+    flags = [f"-DHID_POLL_INTERVAL={poll_interval_ms}"] + list(extra_flags)
+    return [f"compiler.cpp.extra_flags={' '.join(flags)}"]
+
+
+def generate_telemetry_code():
+    """
+    Генерирует телеметрию, которая компилируется только с -DTELEMETRY. Остальной код вызывает
+    TELEMETRY_ADD и TELEMETRY_ACTION_*; без флага эти макросы пустые, и прошивка не меняется.
+    Выдаёт строки объявлений (до исполнителя действий); обработку в loop() - generate_telemetry_service_code.
+    Счётчики накапливаются с запуска, максимумы сбрасываются после каждой передачи.
+    """
+    first_bucket_bits = TELEMETRY_FIRST_BUCKET_US.bit_length() - 1
+    yield "\n#ifdef TELEMETRY\n"
+    yield f"const uint8_t TELEMETRY_VERSION = {TELEMETRY_VERSION};\n"
+    yield f"const uint8_t TELEMETRY_BUCKETS = {TELEMETRY_BUCKETS};\n"
+    yield f"const uint8_t TELEMETRY_FIRST_BUCKET_BITS = {first_bucket_bits};\n\n"
+    yield "struct Telemetry {\n"
+    for counter in TELEMETRY_COUNTERS:
+        yield f"    uint32_t {counter};\n"
+    for maximum in TELEMETRY_MAXIMA:
+        yield f"    uint32_t {maximum};\n"
+    yield "    uint32_t loopHistogram[TELEMETRY_BUCKETS];\n"
+    yield "    unsigned long actionStartedAt;\n"
+    yield "    unsigned long lastLoopUs;\n"
+    yield "};\n\n"
+    yield "Telemetry telemetry;\n\n"
+    yield "void recordActionTelemetry(unsigned long now) {\n"
+    yield "    uint32_t elapsed = now - telemetry.actionStartedAt;\n"
+    yield "    ++telemetry.actionsDone;\n"
+    yield "    telemetry.actionMsTotal += elapsed;\n"
+    yield "    if (elapsed > telemetry.actionMsMax) {\n"
+    yield "        telemetry.actionMsMax = elapsed;\n"
+    yield "    }\n"
+    yield "}\n\n"
+    yield "#define TELEMETRY_ADD(field, n) (telemetry.field += (n))\n"
+    yield "#define TELEMETRY_ACTION_START(now) (telemetry.actionStartedAt = (now))\n"
+    yield "#define TELEMETRY_ACTION_DONE(now) recordActionTelemetry(now)\n"
+    yield "#else\n"
+    yield "#define TELEMETRY_ADD(field, n)\n"
+    yield "#define TELEMETRY_ACTION_START(now)\n"
+    yield "#define TELEMETRY_ACTION_DONE(now)\n"
+    yield "#endif\n"
+
+
+def generate_telemetry_service_code(read_commands=True):
+    """
+    Выдаёт строки обработки телеметрии в loop() (после исполнителя действий и диспетчера).
+    read_commands=False оставляет чтение команды TR разбору кадров хоста (generate_host_bridge_code).
+    """
+    yield "\n#ifdef TELEMETRY\n"
+    yield "// Корзина гистограммы - число значащих битов времени прохода сверх TELEMETRY_FIRST_BUCKET_BITS\n"
+    yield "void recordLoopTelemetry() {\n"
+    yield "    unsigned long now = micros();\n"
+    yield "    uint32_t elapsed = now - telemetry.lastLoopUs;\n"
+    yield "    telemetry.lastLoopUs = now;\n"
+    yield "    if (telemetry.loops++ == 0) {\n"
+    yield "        return;\n"
+    yield "    }\n"
+    yield "    uint8_t bucket = 0;\n"
+    yield "    for (uint32_t rest = elapsed >> TELEMETRY_FIRST_BUCKET_BITS; rest && bucket < TELEMETRY_BUCKETS - 1; "
+    yield "rest >>= 1) {\n"
+    yield "        ++bucket;\n"
+    yield "    }\n"
+    yield "    ++telemetry.loopHistogram[bucket];\n"
+    yield "    if (elapsed > telemetry.loopMaxUs) {\n"
+    yield "        telemetry.loopMaxUs = elapsed;\n"
+    yield "    }\n"
+    yield "}\n\n"
+    yield "void printTelemetryField(const __FlashStringHelper* name, uint32_t value) {\n"
+    yield "    Serial.print(name);\n"
+    yield "    Serial.print(value);\n"
+    yield "}\n\n"
+    yield "void sendTelemetry() {\n"
+    yield "    printTelemetryField(F(\"TLM version=\"), TELEMETRY_VERSION);\n"
+    yield "    printTelemetryField(F(\" uptimeMs=\"), millis());\n"
+    for field in TELEMETRY_COUNTERS + TELEMETRY_MAXIMA:
+        yield f"    printTelemetryField(F(\" {field}=\"), telemetry.{field});\n"
+    yield "    Serial.print(F(\" loopHistogram=\"));\n"
+    yield "    for (uint8_t i = 0; i < TELEMETRY_BUCKETS; ++i) {\n"
+    yield "        if (i > 0) {\n"
+    yield "            Serial.print(',');\n"
+    yield "        }\n"
+    yield "        Serial.print(telemetry.loopHistogram[i]);\n"
+    yield "    }\n"
+    yield "    Serial.println();\n"
+    for maximum in TELEMETRY_MAXIMA:
+        yield f"    telemetry.{maximum} = 0;\n"
+    yield "}\n\n"
+    yield "// Команда TR: строка телеметрии. Пока хост не спрашивает, в Serial ничего не пишется\n"
+    yield "void handleTelemetry() {\n"
+    yield "    recordLoopTelemetry();\n"
+    if read_commands:
+        yield "    if (Serial.available() >= 2 && Serial.read() == 'T' && Serial.read() == 'R') {\n"
+        yield "        sendTelemetry();\n"
+        yield "    }\n"
+    yield "}\n"
+    yield "#endif\n"
+
+
+def default_matrix(rows, cols, diodes=True):
+    """Возвращает описание матрицы rows x cols на выводах по умолчанию."""
+    if rows > len(MATRIX_ROW_PINS) or cols > len(MATRIX_COLUMN_PINS):
+        raise ValueError(f"Матрица по умолчанию не больше {len(MATRIX_ROW_PINS)}x{len(MATRIX_COLUMN_PINS)}")
+    return {'rows': MATRIX_ROW_PINS[:rows], 'cols': MATRIX_COLUMN_PINS[:cols], 'diodes': diodes}
+
+
+def check_matrix(matrix):
+    """ValueError, если матрицу нельзя собрать на выводах Pro Micro."""
+    rows, cols = matrix['rows'], matrix['cols']
+    pins = rows + cols
+    if not rows or not cols or len(cols) > 16:
+        raise ValueError("Матрица должна содержать от 1 строки и от 1 до 16 столбцов")
+    if len(set(pins)) != len(pins):
+        raise ValueError("Выводы строк и столбцов матрицы повторяются")
+    for pin in pins:
+        if pin not in PRO_MICRO_PORTS or pin in RESERVED_PINS:
+            raise ValueError(f"Вывод {pin} нельзя использовать для матрицы")
+
+
+def generate_matrix_code(matrix):
+    """
+    Генерирует сканирование матрицы кнопок через регистры портов.
+    Каждый нужный регистр PINx читается один раз на строку.
+    """
+    check_matrix(matrix)
+    rows, cols = matrix['rows'], matrix['cols']
+    pins = rows + cols
+
+    yield "\n"
+    yield f"const uint8_t MATRIX_ROWS = {len(rows)};\n"
+    yield f"const uint8_t MATRIX_COLS = {len(cols)};\n"
+    yield f"const uint8_t MATRIX_SETTLE_US = {MATRIX_SETTLE_US};\n"
+    yield f"const uint8_t matrixPins[] = {{{', '.join(str(pin) for pin in pins)}}};\n"
+    yield "uint16_t matrixState[MATRIX_ROWS];\n\n"
+
+    # Выбранная строка притягивается к земле, остальные остаются входами с подтяжкой
+    yield "void selectRow(uint8_t row) {\n    switch (row) {\n"
+    for i, pin in enumerate(rows):
+        port, bit = PRO_MICRO_PORTS[pin]
+        yield f"        case {i}: DDR{port} |= _BV({bit}); PORT{port} &= ~_BV({bit}); break;\n"
+    yield "    }\n}\n\n"
+    yield "void unselectRow(uint8_t row) {\n    switch (row) {\n"
+    for i, pin in enumerate(rows):
+        port, bit = PRO_MICRO_PORTS[pin]
+        yield f"        case {i}: DDR{port} &= ~_BV({bit}); PORT{port} |= _BV({bit}); break;\n"
+    yield "    }\n}\n\n"
+
+    yield "uint16_t readColumns() {\n"
+    ports = sorted({PRO_MICRO_PORTS[pin][0] for pin in cols})
+    for port in ports:
+        yield f"    uint8_t pin{port} = PIN{port};\n"
+    yield "    uint16_t columns = 0;\n"
+    for i, pin in enumerate(cols):
+        port, bit = PRO_MICRO_PORTS[pin]
+        yield f"    if (!(pin{port} & _BV({bit}))) columns |= 1U << {i};\n"
+    yield "    return columns;\n}\n\n"
+
+    yield "void scanMatrix() {\n"
+    if not matrix.get('diodes', True):
+        yield "    uint16_t previousState[MATRIX_ROWS];\n"
+        yield "    memcpy(previousState, matrixState, sizeof(matrixState));\n"
+    yield "    for (uint8_t row = 0; row < MATRIX_ROWS; ++row) {\n"
+    yield "        selectRow(row);\n"
+    yield "        delayMicroseconds(MATRIX_SETTLE_US);\n"
+    yield "        matrixState[row] = readColumns();\n"
+    yield "        unselectRow(row);\n"
+    yield "    }\n"
+    if not matrix.get('diodes', True):
+        # Без диодов три нажатые клавиши в углах прямоугольника дают ложную четвёртую:
+        # если две строки делят два и более столбцов, новые нажатия в этих столбцах не принимаются
+        yield "    for (uint8_t a = 0; a < MATRIX_ROWS; ++a) {\n"
+        yield "        for (uint8_t b = a + 1; b < MATRIX_ROWS; ++b) {\n"
+        yield "            uint16_t common = matrixState[a] & matrixState[b];\n"
+        yield "            if (common & (common - 1)) {\n"
+        yield "                matrixState[a] &= ~common | previousState[a];\n"
+        yield "                matrixState[b] &= ~common | previousState[b];\n"
+        yield "            }\n"
+        yield "        }\n"
+        yield "    }\n"
+    yield "}\n\n"
+
+    yield "bool readButton(uint8_t index) {\n"
+    yield "    return matrixState[index / MATRIX_COLS] & (1U << (index % MATRIX_COLS));\n"
+    yield "}\n"
+
+
+def button_mask_type(num_buttons):
+    """Возвращает наименьший целый тип C++, в котором помещается бит на каждую кнопку."""
+    for bits in (8, 16, 32, 64):
+        if num_buttons <= bits:
+            return f"uint{bits}_t"
+    raise ValueError("Поддерживается не больше 64 кнопок")
+
+
+ACTION_TYPE_CONSTANTS = {'none': 'ACTION_NONE', 'keys': 'ACTION_KEYS', 'text': 'ACTION_TEXT', 'macro': 'ACTION_MACRO',
+                         'host': 'ACTION_HOST', 'layer-momentary': 'ACTION_LAYER_MOMENTARY',
+                         'layer-toggle': 'ACTION_LAYER_TOGGLE', 'taphold': 'ACTION_TAP_HOLD'}
+
+
+def _action_cell(kind, index):
+    return "{ACTION_NONE, 0}" if kind == 'none' else f"{{{ACTION_TYPE_CONSTANTS[kind]}, {index}}}"
+
+
+def generate_table_dispatch(mode_names, tables, num_standard_buttons):
+    """
+    Генерирует таблицу действий ACTIONS[режим][кнопка] во flash и один диспетчер,
+    принимающий битовую маску сработавших кнопок. С тап/удержанием или слоями вместо маски
+    нажатия и отпускания обрабатывает handleButtonEvent (см. generate_key_events_code).
+    Выдаёт строки кода; опрос кнопок в loop() к нему - table_dispatch_loop_code.
+    """
+    mask_type = button_mask_type(num_standard_buttons)
+    key_events = uses_key_events(tables)
+
+    yield "\n"
+    yield f"const uint8_t NUM_MODES = {len(mode_names)};\n"
+    yield f"typedef {mask_type} ButtonMask;\n\n"
+    yield "enum ActionType : uint8_t { ACTION_NONE, ACTION_KEYS, ACTION_TEXT, ACTION_MACRO, ACTION_HOST,\n"
+    yield "                            ACTION_LAYER_MOMENTARY, ACTION_LAYER_TOGGLE, ACTION_TAP_HOLD };\n\n"
+    yield "struct Action {\n"
+    yield "    uint8_t type;\n"
+    yield "    ActionIndex index;\n"
+    yield "};\n\n"
+
+    yield "const Action ACTIONS[NUM_MODES][NUM_BUTTONS] PROGMEM = {\n"
+    for mode_name, actions in zip(mode_names, tables['mode_actions']):
+        yield f"    // {mode_name}\n"
+        cells = []
+        for i, action in enumerate(actions):
+            cells.append(_action_cell(*action[:2]) if action else "{ACTION_NONE, 0}")
+            for part in (action[2] if action else []):
+                yield f"    // button{i + 1}: Unknown key: {part}\n"
+        yield f"    {{{', '.join(cells)}}},\n"
+    yield "};\n\n"
+
+    mode_name_list = ", ".join(f"MODE_NAME_{i}" for i in range(len(mode_names)))
+    yield f"const char* const MODE_NAMES[NUM_MODES] PROGMEM = {{{mode_name_list}}};\n\n"
+    cycle = [i for i in range(len(mode_names)) if i not in tables['layer_only']]
+    if tables['layer_only']:
+        # Следующий режим для кнопки энкодера в обход режимов, которые бывают только слоями
+        next_modes = [next((j for j in cycle if j > i), cycle[0]) for i in range(len(mode_names))]
+        yield f"const uint8_t NEXT_MODE[NUM_MODES] PROGMEM = {{{', '.join(map(str, next_modes))}}};\n"
+    yield f"uint8_t currentMode = {cycle[0]};\n\n"
+    if key_events:
+        yield "// Слой - режим, действия которого заменяют действия currentMode. Временный слой действует,\n"
+        yield "// пока нажата momentaryButton, после её отпускания возвращается layerBeforeMomentary\n"
+        yield "const uint8_t NO_LAYER = 0xFF;\n"
+        yield "uint8_t activeLayer = NO_LAYER;\n"
+        yield "uint8_t momentaryButton = NO_BUTTON;\n"
+        yield "uint8_t layerBeforeMomentary = NO_LAYER;\n\n"
+    yield "void switchMode() {\n"
+    if tables['layer_only']:
+        yield "    currentMode = pgm_read_byte(&NEXT_MODE[currentMode]);\n"
+    else:
+        yield "    currentMode = (currentMode + 1) % NUM_MODES;\n"
+    if key_events:
+        yield "    activeLayer = NO_LAYER;\n"
+        yield "    momentaryButton = NO_BUTTON;\n"
+    yield "}\n\n"
+    yield "// Имя режима хранится во flash (PROGMEM)\n"
+    yield "const char* currentModeName() {\n"
+    if key_events:
+        yield "    uint8_t mode = activeLayer != NO_LAYER ? activeLayer : currentMode;\n"
+        yield "    return (const char*)pgm_read_ptr(&MODE_NAMES[mode]);\n"
+    else:
+        yield "    return (const char*)pgm_read_ptr(&MODE_NAMES[currentMode]);\n"
+    yield "}\n\n"
+    yield "uint8_t currentModeIndex() {\n"
+    yield "    return currentMode;\n"
+    yield "}\n\n"
+
+    if key_events:
+        yield from generate_key_events_code(tables)
+        return
+
+    yield "void executeAction(uint8_t mode, uint8_t button) {\n"
+    yield "    Action action;\n"
+    yield "    memcpy_P(&action, &ACTIONS[mode][button], sizeof(Action));\n"
+    if tables['host_events']:
+        yield "    if (action.type == ACTION_HOST) {\n"
+        yield "        sendHostEvent(action.index);\n"
+        yield "        showLastAction(button);\n"
+        yield "    } else if (action.type != ACTION_NONE) {\n"
+    else:
+        yield "    if (action.type != ACTION_NONE) {\n"
+    yield "        queueAction(action.index);\n"
+    yield "        showLastAction(button);\n"
+    yield "    }\n"
+    yield "}\n\n"
+
+    yield "// Бит i маски - сработавшая кнопка i\n"
+    yield "void dispatch(uint8_t mode, ButtonMask triggered) {\n"
+    yield "    for (uint8_t button = 0; triggered; ++button, triggered >>= 1) {\n"
+    yield "        if (triggered & 1) {\n"
+    yield "            executeAction(mode, button);\n"
+    yield "        }\n"
+    yield "    }\n"
+    yield "}\n"
+
+
+def table_dispatch_loop_code(tables):
+    """Опрос кнопок в loop() для generate_table_dispatch: маска сработавших кнопок или события нажатий."""
+    if uses_key_events(tables):
+        loop_code = "for (uint8_t i = 0; i < NUM_BUTTONS; ++i) {\n"
+        loop_code += "        ButtonEvent event = updateButton(buttons[i], readButton(i), now);\n"
+        loop_code += "        if (event != EVENT_NONE) {\n"
+        loop_code += "            handleButtonEvent(i, event);\n"
+        loop_code += "        }\n"
+        loop_code += "    }"
+        if tables['tap_holds']:
+            loop_code += "\n    checkTapHold(now);"
+        return loop_code
+
+    loop_code = "ButtonMask triggered = 0;\n"
+    loop_code += "    for (uint8_t i = 0; i < NUM_BUTTONS; ++i) {\n"
+    loop_code += "        if (isTriggered(updateButton(buttons[i], readButton(i), now))) {\n"
+    loop_code += "            triggered |= (ButtonMask)1 << i;\n"
+    loop_code += "        }\n"
+    loop_code += "    }\n"
+    loop_code += "    if (triggered) {\n"
+    loop_code += "        dispatch(currentMode, triggered);\n"
+    loop_code += "    }"
+    return loop_code
+
+
+def generate_key_events_code(tables):
+    """
+    Генерирует обработку нажатий и отпусканий для слоёв и тап/удержания. Действие кнопки берётся
+    из ACTIONS[activeLayer], а если там пусто - из ACTIONS[currentMode]: не больше двух чтений таблицы
+    при любом числе слоёв. Кнопки без тап/удержания срабатывают по нажатию без задержки. Решение
+    тап/удержание принимается по отпусканию кнопки, по истечении её времени решения или, с permissive,
+    по отпусканию другой кнопки, нажатой после неё; нажатия других кнопок до решения откладываются
+    и выполняются после него в порядке нажатия, уже в слое удержания, если выбрано удержание.
+    """
+    tap_holds = tables['tap_holds']
+
+    yield "Action lookupAction(uint8_t button) {\n"
+    yield "    Action action;\n"
+    yield "    if (activeLayer != NO_LAYER) {\n"
+    yield "        memcpy_P(&action, &ACTIONS[activeLayer][button], sizeof(Action));\n"
+    yield "        if (action.type != ACTION_NONE) {\n"
+    yield "            return action;\n"
+    yield "        }\n"
+    yield "    }\n"
+    yield "    memcpy_P(&action, &ACTIONS[currentMode][button], sizeof(Action));\n"
+    yield "    return action;\n"
+    yield "}\n\n"
+
+    yield "void setLayer(uint8_t layer) {\n"
+    yield "    if (layer != activeLayer) {\n"
+    yield "        activeLayer = layer;\n"
+    yield "        markDirty(REGION_MODE);\n"
+    yield "    }\n"
+    yield "}\n\n"
+
+    yield "void startAction(Action action, uint8_t button) {\n"
+    yield "    switch (action.type) {\n"
+    yield "        case ACTION_NONE:\n"
+    yield "            return;\n"
+    yield "        case ACTION_LAYER_MOMENTARY:\n"
+    yield "            // Вторая кнопка временного слоя сменяет первую, после отпускания возвращается прежний\n"
+    yield "            if (momentaryButton == NO_BUTTON) {\n"
+    yield "                layerBeforeMomentary = activeLayer;\n"
+    yield "            }\n"
+    yield "            momentaryButton = button;\n"
+    yield "            setLayer(action.index);\n"
+    yield "            return;\n"
+    yield "        case ACTION_LAYER_TOGGLE:\n"
+    yield "            // Во временном слое переключается слой, который вернётся после отпускания его кнопки\n"
+    yield "            if (momentaryButton != NO_BUTTON) {\n"
+    yield "                layerBeforeMomentary = layerBeforeMomentary == action.index ? NO_LAYER : action.index;\n"
+    yield "            } else {\n"
+    yield "                setLayer(activeLayer == action.index ? NO_LAYER : action.index);\n"
+    yield "            }\n"
+    yield "            return;\n"
+    if tables['host_events']:
+        yield "        case ACTION_HOST:\n"
+        yield "            sendHostEvent(action.index);\n"
+        yield "            break;\n"
+    yield "        default:\n"
+    yield "            queueAction(action.index);\n"
+    yield "            break;\n"
+    yield "    }\n"
+    yield "    showLastAction(button);\n"
+    yield "}\n\n"
+
+    yield "void releaseButton(uint8_t button) {\n"
+    yield "    if (button == momentaryButton) {\n"
+    yield "        momentaryButton = NO_BUTTON;\n"
+    yield "        setLayer(layerBeforeMomentary);\n"
+    yield "    }\n"
+    yield "}\n\n"
+
+    if tap_holds:
+        yield "struct TapHold {\n"
+        yield "    Action tap;\n"
+        yield "    Action hold;\n"
+        yield "    uint16_t timeoutMs;\n"
+        yield "    uint8_t permissive;\n"
+        yield "};\n\n"
+        yield "const TapHold TAP_HOLDS[] PROGMEM = {\n"
+        for tap, hold, timeout_ms, permissive in tap_holds:
+            yield f"    {{{_action_cell(*tap)}, {_action_cell(*hold)}, {timeout_ms}, {int(permissive)}}},\n"
+        yield "};\n\n"
+        yield f"const uint8_t TAP_HOLD_BUFFER = {TAP_HOLD_BUFFER};\n"
+        yield "TapHold pendingTapHold;\n"
+        yield "uint8_t pendingButton = NO_BUTTON;\n"
+        yield "unsigned long pendingSince = 0;\n"
+        yield "uint8_t deferredButtons[TAP_HOLD_BUFFER];\n"
+        yield "uint8_t deferredCount = 0;\n\n"
+        yield "void handleButtonEvent(uint8_t button, ButtonEvent event);\n\n"
+
+        yield "// Выполняет тап или удержание и затем отложенные нажатия; отпущенные к этому моменту кнопки\n"
+        yield "// получают и отпускание, чтобы отложенный временный слой или тап/удержание не зависли\n"
+        yield "void resolveTapHold(bool hold) {\n"
+        yield "    uint8_t button = pendingButton;\n"
+        yield "    uint8_t count = deferredCount;\n"
+        yield "    uint8_t deferred[TAP_HOLD_BUFFER];\n"
+        yield "    memcpy(deferred, deferredButtons, count);\n"
+        yield "    pendingButton = NO_BUTTON;\n"
+        yield "    deferredCount = 0;\n"
+        yield "    if (hold) {\n"
+        yield "        startAction(pendingTapHold.hold, button);\n"
+        yield "    } else {\n"
+        yield "        startAction(pendingTapHold.tap, button);\n"
+        yield "        releaseButton(button);\n"
+        yield "    }\n"
+        yield "    for (uint8_t i = 0; i < count; ++i) {\n"
+        yield "        handleButtonEvent(deferred[i], EVENT_PRESS);\n"
+        yield "        if (!buttons[deferred[i]].pressed) {\n"
+        yield "            handleButtonEvent(deferred[i], EVENT_RELEASE);\n"
+        yield "        }\n"
+        yield "    }\n"
+        yield "}\n\n"
+
+        yield "void pressButton(uint8_t button) {\n"
+        yield "    Action action = lookupAction(button);\n"
+        yield "    if (action.type == ACTION_TAP_HOLD) {\n"
+        yield "        memcpy_P(&pendingTapHold, &TAP_HOLDS[action.index], sizeof(TapHold));\n"
+        yield "        pendingButton = button;\n"
+        yield "        // Время решения - от нажатия: отложенная кнопка могла ждать предыдущего решения\n"
+        yield "        pendingSince = buttons[button].changedAt;\n"
+        yield "        return;\n"
+        yield "    }\n"
+        yield "    startAction(action, button);\n"
+        yield "}\n\n"
+
+        yield "void checkTapHold(unsigned long now) {\n"
+        yield "    if (pendingButton != NO_BUTTON && now - pendingSince >= pendingTapHold.timeoutMs) {\n"
+        yield "        resolveTapHold(true);\n"
+        yield "    }\n"
+        yield "}\n\n"
+    else:
+        yield "void pressButton(uint8_t button) {\n"
+        yield "    startAction(lookupAction(button), button);\n"
+        yield "}\n\n"
+
+    yield "void handleButtonEvent(uint8_t button, ButtonEvent event) {\n"
+    if tap_holds:
+        yield "    if (pendingButton != NO_BUTTON) {\n"
+        yield "        if (button == pendingButton) {\n"
+        yield "            if (event == EVENT_RELEASE) {\n"
+        yield "                resolveTapHold(false);\n"
+        yield "            }\n"
+        yield "            return;\n"
+        yield "        }\n"
+        yield "        if (event == EVENT_PRESS) {\n"
+        yield "            if (deferredCount < TAP_HOLD_BUFFER) {\n"
+        yield "                deferredButtons[deferredCount++] = button;\n"
+        yield "                return;\n"
+        yield "            }\n"
+        yield "            // Столько нажатий до решения бывает только при удержании\n"
+        yield "            resolveTapHold(true);\n"
+        yield "            handleButtonEvent(button, event);\n"
+        yield "            return;\n"
+        yield "        }\n"
+        yield "        for (uint8_t i = 0; i < deferredCount; ++i) {\n"
+        yield "            if (deferredButtons[i] == button) {\n"
+        yield "                if (event == EVENT_RELEASE && pendingTapHold.permissive) {\n"
+        yield "                    resolveTapHold(true);\n"
+        yield "                }\n"
+        yield "                return;\n"
+        yield "            }\n"
+        yield "        }\n"
+        yield "    }\n"
+    yield "    if (event == EVENT_PRESS) {\n"
+    yield "        pressButton(button);\n"
+    yield "    } else if (event == EVENT_RELEASE) {\n"
+    yield "        releaseButton(button);\n"
+    yield "    } else if (REPEAT_MS > 0 && event == EVENT_REPEAT) {\n"
+    yield "        // Автоповтор только у действий, не у слоёв и тап/удержания\n"
+    yield "        Action action = lookupAction(button);\n"
+    yield "        if (action.type <= ACTION_HOST) {\n"
+    yield "            startAction(action, button);\n"
+    yield "        }\n"
+    yield "    }\n"
+    yield "}\n"
+
+
+def mode_identifier(mode_name):
+    """Имя класса режима в C++: только ASCII-буквы, цифры и '_', avr-gcc не принимает другие символы."""
+    return "Mode_" + re.sub(r'[^0-9A-Za-z_]+', '_', mode_name)
+
+
+def generate_class_dispatch(mode_names, tables, num_standard_buttons):
+    """
+    Генерирует прежнюю схему: класс ModeStrategy на режим и bool-параметр на кнопку.
+    Опрос кнопок в loop() к ней - class_dispatch_loop_code.
+    """
+    button_state_params = ", ".join(
+        [f"bool button{i + 1}State" for i in range(num_standard_buttons)]) if num_standard_buttons > 0 else ""
+
+    yield "\n"
+    yield "class ModeStrategy {\n"
+    yield "public:\n"
+    yield "    // Имя режима хранится во flash (PROGMEM)\n"
+    yield "    virtual const char* getModeName() const = 0;\n"
+    yield f"    virtual void execute({button_state_params}) = 0;\n"
+    yield "    virtual ~ModeStrategy() = default;\n"
+    yield "};\n\n"
+
+    for mode_index, mode_name in enumerate(mode_names):
+        class_name = mode_identifier(mode_name)
+
+        yield f"class {class_name} : public ModeStrategy {{\n"
+        yield "public:\n"
+        yield f'    const char* getModeName() const override {{ return MODE_NAME_{mode_index}; }}\n'
+        yield f"    void execute({button_state_params}) override {{\n"
+
+        for i, action in enumerate(tables['mode_actions'][mode_index]):
+            if action is None:
+                continue
+            kind, index, unknown = action
+            yield f"        if (button{i + 1}State) {{\n"
+            for part in unknown:
+                yield f"            // Unknown key: {part}\n"
+            if kind == 'none':
+                yield "            // No action defined\n"
+            elif kind == 'host':
+                yield f"            sendHostEvent({index});\n"
+            else:
+                yield f"            queueAction({index});\n"
+            yield "        }\n"
+
+        yield "    }\n};\n\n"
+
+    yield "class ModeContext {\n"
+    yield f"    ModeStrategy* strategies[{len(mode_names)}];\n"
+    yield "    int currentMode = 0;\n"
+    yield "public:\n"
+    yield "    ModeContext() {\n"
+    for i, mode_name in enumerate(mode_names):
+        class_name = mode_identifier(mode_name)
+        yield f"        strategies[{i}] = new {class_name}();\n"
+    yield "    }\n"
+    yield "    ~ModeContext() {\n"
+    yield f"        for (int i = 0; i < {len(mode_names)}; ++i) {{ delete strategies[i]; }}\n"
+    yield "    }\n"
+    yield "    void switchMode() {\n"
+    yield f"        currentMode = (currentMode + 1) % {len(mode_names)};\n"
+    yield "    }\n"
+
+    execute_params = ', '.join([f'button{i + 1}State' for i in range(num_standard_buttons)])
+    yield f"    void executeCurrentMode({button_state_params}) {{\n"
+    yield f"        strategies[currentMode]->execute({execute_params});\n"
+    yield "    }\n"
+    yield "    const char* getCurrentModeName() const {\n"
+    yield "        return strategies[currentMode]->getModeName();\n"
+    yield "    }\n"
+    yield "    uint8_t getCurrentMode() const {\n"
+    yield "        return currentMode;\n"
+    yield "    }\n"
+    yield "};\n\n"
+
+    yield "ModeContext modeContext;\n\n"
+    yield "void switchMode() {\n"
+    yield "    modeContext.switchMode();\n"
+    yield "}\n\n"
+    yield "const char* currentModeName() {\n"
+    yield "    return modeContext.getCurrentModeName();\n"
+    yield "}\n\n"
+    yield "uint8_t currentModeIndex() {\n"
+    yield "    return modeContext.getCurrentMode();\n"
+    yield "}\n"
+
+
+def class_dispatch_loop_code(num_standard_buttons):
+    """Опрос кнопок в loop() для generate_class_dispatch: состояние каждой кнопки отдельным параметром."""
+    execute_params = ', '.join([f'button{i + 1}State' for i in range(num_standard_buttons)])
+    loop_code = "\n    ".join(
+        [f"bool button{i + 1}State = isTriggered(updateButton(buttons[{i}], readButton({i}), now));"
+         for i in range(num_standard_buttons)])
+    loop_code += f"\n\n    modeContext.executeCurrentMode({execute_params});"
+    return loop_code
+
+
+def encoder_function_code(mode_name, mode_data, num_drop_buttons):
+    """Возвращает константу функции энкодера, выбранной для режима в выпадающем списке."""
+    function = "Nothing"
+    if num_drop_buttons > 0:
+        function = mode_data.get('dropdown_buttons', {}).get('dropdown_button1', "Nothing")
+    if function not in ENCODER_FUNCTIONS:
+        raise ValueError(f"{mode_name}: неизвестная функция энкодера '{function}'")
+    return ENCODER_FUNCTIONS[function][0]
+
+
+def generate_encoder_code(function_expr, functions=tuple(ENCODER_FUNCTIONS), on_change="", labels=False,
+                          mode_functions=None, telemetry=False):
+    """
+    Генерирует чтение энкодера в прерывании таймера 3 и отправку накопленных шагов из loop().
+    Прерывание только считает переходы квадратурного сигнала, поэтому щелчки не теряются при любой
+    скорости вращения и длительности loop(). handleEncoderRotation(now) забирает целые щелчки,
+    умножает их на ускорение и отправляет по одному нажатию Consumer за проход (прокрутку - одним
+    отчётом мыши), остаток переносится на следующие проходы.
+    function_expr - выражение C с кодом текущей функции энкодера; functions - имена функций, для которых
+    генерируется отправка (Mouse подключается, только если среди них есть прокрутка);
+    on_change - код после изменения encoderLevel; labels добавляет подписи ENCODER_LABELS для экрана;
+    mode_functions - константы функций по режимам для таблицы MODE_ENCODER_FUNCTIONS во flash;
+    telemetry добавляет вызовы TELEMETRY_ADD (см. generate_telemetry_code).
+    """
+    s1_port, s1_bit = PRO_MICRO_PORTS[5]
+    s2_port, s2_bit = PRO_MICRO_PORTS[6]
+    on_change = f"    {on_change}\n" if on_change else ""
+
+    constants = ", ".join(constant for constant, _, _, _ in ENCODER_FUNCTIONS.values())
+    yield "\n"
+    yield f"enum EncoderFunction : uint8_t {{ {constants} }};\n\n"
+    if mode_functions is not None:
+        yield (f"const uint8_t MODE_ENCODER_FUNCTIONS[{len(mode_functions)}] PROGMEM = "
+               f"{{{', '.join(mode_functions)}}};\n\n")
+    if labels:
+        for constant, label, _, _ in ENCODER_FUNCTIONS.values():
+            yield f"const char {constant}_LABEL[] PROGMEM = {c_string_literal(label)};\n"
+        label_names = ", ".join(f"{constant}_LABEL" for constant, _, _, _ in ENCODER_FUNCTIONS.values())
+        yield f"const char* const ENCODER_LABELS[] PROGMEM = {{{label_names}}};\n\n"
+    yield f"const uint16_t ENCODER_SAMPLE_HZ = {ENCODER_SAMPLE_HZ};\n"
+    yield f"const int16_t ENCODER_STEPS_PER_DETENT = {ENCODER_STEPS_PER_DETENT};\n"
+    yield f"const unsigned long ENCODER_ACCEL_MS = {ENCODER_ACCEL_MS};\n"
+    yield f"const uint8_t ENCODER_ACCEL_MAX = {ENCODER_ACCEL_MAX};\n\n"
+    yield "// Изменение позиции по индексу (прежнее состояние S1 S2) | (новое << 2), как в библиотеке Encoder;\n"
+    yield "// +-2 - переход, между отсчётами которого сигнал сменился дважды\n"
+    yield "const int8_t QUADRATURE_DELTA[16] PROGMEM = {0, 1, -1, 2, -1, 0, -2, 1, 1, -2, 0, -1, 2, -1, 1, 0};\n\n"
+    yield "volatile int16_t encoderTransitions = 0;\n"
+    yield "uint8_t encoderPinState = 0;\n"
+    yield "int16_t pendingEncoderSteps = 0;\n"
+    yield "int16_t encoderLevel = 0;\n"
+    yield "uint8_t encoderFunctionInUse = ENCODER_NOTHING;\n"
+    yield "uint8_t encoderAcceleration = 1;\n"
+    yield "unsigned long lastDetentAt = 0;\n\n"
+
+    yield "uint8_t readEncoderPins() {\n"
+    yield f"    return ((PIN{s1_port} >> {s1_bit}) & 1) | (((PIN{s2_port} >> {s2_bit}) & 1) << 1);\n"
+    yield "}\n\n"
+    yield "ISR(TIMER3_COMPA_vect) {\n"
+    yield "    uint8_t state = readEncoderPins();\n"
+    if telemetry:
+        yield "    int8_t delta = (int8_t)pgm_read_byte(&QUADRATURE_DELTA[encoderPinState | (state << 2)]);\n"
+        yield "    encoderTransitions += delta;\n"
+        yield "    // Двойной переход - между отсчётами пропущено состояние\n"
+        yield "    TELEMETRY_ADD(encoderSkipped, delta == 2 || delta == -2);\n"
+    else:
+        yield "    encoderTransitions += (int8_t)pgm_read_byte(&QUADRATURE_DELTA[encoderPinState | (state << 2)]);\n"
+    yield "    encoderPinState = state;\n"
+    yield "}\n\n"
+
+    yield "void setupEncoder() {\n"
+    yield "    pinMode(ENCODER_S1_PIN, INPUT_PULLUP);\n"
+    yield "    pinMode(ENCODER_S2_PIN, INPUT_PULLUP);\n"
+    yield "    encoderPinState = readEncoderPins();\n"
+    yield "    // Таймер 3: режим CTC, делитель 64\n"
+    yield "    noInterrupts();\n"
+    yield "    TCCR3A = 0;\n"
+    yield "    TCCR3B = _BV(WGM32) | _BV(CS31) | _BV(CS30);\n"
+    yield "    OCR3A = F_CPU / 64 / ENCODER_SAMPLE_HZ - 1;\n"
+    yield "    TIMSK3 = _BV(OCIE3A);\n"
+    yield "    interrupts();\n"
+    yield "}\n\n"
+
+    yield "// Забирает целые щелчки, накопленные прерыванием; неполный щелчок остаётся до следующего прохода\n"
+    yield "int16_t takeEncoderDetents() {\n"
+    yield "    noInterrupts();\n"
+    yield "    int16_t detents = encoderTransitions / ENCODER_STEPS_PER_DETENT;\n"
+    yield "    encoderTransitions -= detents * ENCODER_STEPS_PER_DETENT;\n"
+    yield "    interrupts();\n"
+    yield "    return detents;\n"
+    yield "}\n\n"
+
+    yield "void sendEncoderSteps() {\n"
+    yield "    int16_t sent = pendingEncoderSteps > 0 ? 1 : -1;\n"
+    yield "    switch (encoderFunctionInUse) {\n"
+    for name in functions:
+        constant, _, increase, decrease = ENCODER_FUNCTIONS[name]
+        if increase:
+            yield f"        case {constant}:\n"
+            yield f"            Consumer.write(sent > 0 ? {increase} : {decrease});\n"
+            yield "            break;\n"
+        elif constant == 'ENCODER_SCROLL':
+            yield f"        case {constant}:\n"
+            yield "            // По часовой стрелке страница прокручивается вниз\n"
+            yield "            sent = constrain(pendingEncoderSteps, -127, 127);\n"
+            yield "            Mouse.move(0, 0, -sent);\n"
+            yield "            break;\n"
+    yield "        default:\n"
+    yield "            pendingEncoderSteps = 0;\n"
+    yield "            return;\n"
+    yield "    }\n"
+    yield "    pendingEncoderSteps -= sent;\n"
+    yield "    encoderLevel += sent;\n"
+    if telemetry:
+        yield "    TELEMETRY_ADD(encoderSteps, abs(sent));\n"
+    yield on_change
+    yield "}\n\n"
+
+    yield "void handleEncoderRotation(unsigned long now) {\n"
+    yield f"    uint8_t function = {function_expr};\n"
+    yield "    if (function != encoderFunctionInUse) {\n"
+    yield "        // Шаги, накопленные для прежней функции, новой не передаются\n"
+    if telemetry:
+        yield "        TELEMETRY_ADD(encoderDiscarded, abs(pendingEncoderSteps));\n"
+    yield "        encoderFunctionInUse = function;\n"
+    yield "        pendingEncoderSteps = 0;\n"
+    yield "        encoderLevel = 0;\n"
+    if on_change:
+        yield f"    {on_change}"
+    yield "    }\n"
+    yield "    int16_t detents = takeEncoderDetents();\n"
+    yield "    if (detents != 0) {\n"
+    if telemetry:
+        yield "        TELEMETRY_ADD(encoderDetents, abs(detents));\n"
+    yield "        // Смена направления отменяет ещё не отправленный хвост ускоренных шагов\n"
+    yield "        if ((detents > 0) != (pendingEncoderSteps > 0)) {\n"
+    if telemetry:
+        yield "            TELEMETRY_ADD(encoderDiscarded, abs(pendingEncoderSteps));\n"
+    yield "            pendingEncoderSteps = 0;\n"
+    yield "        }\n"
+    yield "        if (now - lastDetentAt < ENCODER_ACCEL_MS) {\n"
+    yield "            if (encoderAcceleration < ENCODER_ACCEL_MAX) {\n"
+    yield "                ++encoderAcceleration;\n"
+    yield "            }\n"
+    yield "        } else {\n"
+    yield "            encoderAcceleration = 1;\n"
+    yield "        }\n"
+    yield "        lastDetentAt = now;\n"
+    yield "        pendingEncoderSteps += detents * encoderAcceleration;\n"
+    yield "    }\n"
+    yield "    if (pendingEncoderSteps != 0) {\n"
+    yield "        sendEncoderSteps();\n"
+    yield "    }\n"
+    yield "}\n"
+
+
+def generate_action_executor(tables, typing=TYPING_PROFILE, queue_size=ACTION_QUEUE_SIZE,
+                             keyboard='Keyboard', single_report=True, telemetry=False):
+    """
+    Генерирует программы действий во flash и исполнитель, который выполняет их из loop()
+    по шагу за вызов: ожидание сверяется с millis(), текст печатается по отчёту за вызов
+    с профилем typing (см. TYPING_PROFILES), поэтому энкодер и кнопки опрашиваются
+    и во время длинного текста или макроса.
+    keyboard - объект клавиатуры HID-Project. При single_report комбинация собирается
+    через add() и уходит одним отчётом send(), иначе press() отправляет отчёт на каждую клавишу.
+    telemetry добавляет учёт очереди и времени выполнения действий (см. generate_telemetry_code).
+    """
+    step_ops = {'press': 'STEP_PRESS', 'release': 'STEP_RELEASE', 'wait': 'STEP_WAIT', 'text': 'STEP_TEXT'}
+    index_type = action_index_type(tables)
+
+    yield f"typedef {index_type} ActionIndex;\n\n"
+    yield "enum StepOp : uint8_t { STEP_END, STEP_PRESS, STEP_RELEASE, STEP_WAIT, STEP_TEXT };\n\n"
+    yield "struct Step {\n"
+    yield "    uint8_t op;\n"
+    yield "    uint16_t arg;\n"
+    yield "};\n\n"
+    for i, program in enumerate(tables['programs']):
+        steps = "".join(f"{{{step_ops[op]}, {arg}}}, " for op, arg in program)
+        yield f"const Step PROGRAM_{i}[] PROGMEM = {{{steps}{{STEP_END, 0}}}};\n"
+    program_names = ", ".join(f"PROGRAM_{i}" for i in range(len(tables['programs']))) or "nullptr"
+    yield f"const Step* const PROGRAMS[] PROGMEM = {{{program_names}}};\n\n"
+
+    yield f"const uint8_t ACTION_QUEUE_SIZE = {queue_size};\n"
+    yield "ActionIndex actionQueue[ACTION_QUEUE_SIZE];\n"
+    yield "uint8_t actionQueueHead = 0;\n"
+    yield "uint8_t actionQueueLength = 0;\n"
+    yield "const Step* currentStep = nullptr;\n"
+    yield "unsigned long stepStartedAt = 0;\n\n"
+
+    if tables['texts']:
+        profile = TYPING_PROFILES[typing]
+        yield f"const uint8_t TYPING_KEYS_PER_REPORT = {profile['keys_per_report']};\n"
+        yield f"const unsigned long TYPING_REPORT_GAP_US = {profile['report_gap_us']};\n"
+        yield f"const uint8_t TYPING_SHIFT = 0x{TYPING_SHIFT:02X};\n"
+        yield "const uint8_t* typingPosition = nullptr;\n"
+        yield "uint8_t typingKeys[TYPING_KEYS_PER_REPORT];\n"
+        yield "uint8_t typingHeld = 0;\n"
+        yield "bool typingShift = false;\n"
+        yield "unsigned long typingReportAt = 0;\n\n"
+
+        yield "// Отправляет не больше одного отчёта за вызов; true, когда текст напечатан и клавиши отпущены.\n"
+        yield "// Повтор клавиши и смена Shift - через отпускание отдельным отчётом, иначе хост не увидит нажатия\n"
+        yield "bool typeText() {\n"
+        yield "    unsigned long nowUs = micros();\n"
+        yield "    if (nowUs - typingReportAt < TYPING_REPORT_GAP_US) {\n"
+        yield "        return false;\n"
+        yield "    }\n"
+        yield "    uint8_t code = pgm_read_byte(typingPosition);\n"
+        yield "    uint8_t key = code & ~TYPING_SHIFT;\n"
+        yield "    bool shift = code & TYPING_SHIFT;\n"
+        yield "    bool repeated = false;\n"
+        yield "    for (uint8_t i = 0; i < typingHeld; ++i) {\n"
+        yield "        repeated |= typingKeys[i] == key;\n"
+        yield "    }\n"
+        yield "    bool release = code == 0 || TYPING_KEYS_PER_REPORT == 1 || repeated || shift != typingShift;\n"
+        yield "    if (typingHeld > 0 && release) {\n"
+        yield f"        {keyboard}.removeAll();\n"
+        yield f"        {keyboard}.send();\n"
+        yield "        typingHeld = 0;\n"
+        yield "        typingReportAt = nowUs;\n"
+        yield "        return false;\n"
+        yield "    }\n"
+        yield "    if (code == 0) {\n"
+        yield "        return true;\n"
+        yield "    }\n"
+        yield "    if (typingHeld == TYPING_KEYS_PER_REPORT) {\n"
+        yield f"        {keyboard}.remove(KeyboardKeycode(typingKeys[0]));\n"
+        yield "        memmove(typingKeys, typingKeys + 1, --typingHeld);\n"
+        yield "    }\n"
+        yield "    if (shift) {\n"
+        yield f"        {keyboard}.add(KEY_LEFT_SHIFT);\n"
+        yield "    }\n"
+        yield f"    {keyboard}.add(KeyboardKeycode(key));\n"
+        yield f"    {keyboard}.send();\n"
+        yield "    typingKeys[typingHeld++] = key;\n"
+        yield "    typingShift = shift;\n"
+        yield "    ++typingPosition;\n"
+        yield "    typingReportAt = nowUs;\n"
+        yield "    return false;\n"
+        yield "}\n\n"
+
+    yield "// Если очередь заполнена, нажатие отбрасывается\n"
+    yield "bool queueAction(ActionIndex index) {\n"
+    yield "    if (actionQueueLength == ACTION_QUEUE_SIZE) {\n"
+    if telemetry:
+        yield "        TELEMETRY_ADD(actionsDropped, 1);\n"
+    yield "        return false;\n"
+    yield "    }\n"
+    if telemetry:
+        yield "    TELEMETRY_ADD(actionsQueued, 1);\n"
+    yield "    actionQueue[(actionQueueHead + actionQueueLength) % ACTION_QUEUE_SIZE] = index;\n"
+    yield "    ++actionQueueLength;\n"
+    yield "    return true;\n"
+    yield "}\n\n"
+
+    yield "// Выполняет не больше одного шага за вызов и сразу возвращается, если шаг ещё не закончен\n"
+    yield "void runActions(unsigned long now) {\n"
+    yield "    if (currentStep == nullptr) {\n"
+    yield "        if (actionQueueLength == 0) {\n"
+    yield "            return;\n"
+    yield "        }\n"
+    yield "        currentStep = (const Step*)pgm_read_ptr(&PROGRAMS[actionQueue[actionQueueHead]]);\n"
+    yield "        actionQueueHead = (actionQueueHead + 1) % ACTION_QUEUE_SIZE;\n"
+    yield "        --actionQueueLength;\n"
+    yield "        stepStartedAt = now;\n"
+    if telemetry:
+        yield "        TELEMETRY_ACTION_START(now);\n"
+    yield "    }\n\n"
+    yield "    Step step;\n"
+    yield "    memcpy_P(&step, currentStep, sizeof(Step));\n"
+    yield "    switch (step.op) {\n"
+    yield "        case STEP_END:\n"
+    if telemetry:
+        yield "            TELEMETRY_ACTION_DONE(now);\n"
+    yield "            currentStep = nullptr;\n"
+    yield "            return;\n"
+    if tables['key_sequences']:
+        yield "        case STEP_PRESS: {\n"
+        yield "            const uint8_t* keys = (const uint8_t*)pgm_read_ptr(&KEY_SEQUENCES[step.arg]);\n"
+        yield "            uint8_t count = pgm_read_byte(keys++);\n"
+        yield "            for (uint8_t i = 0; i < count; ++i) {\n"
+        if single_report:
+            yield f"                {keyboard}.add(KeyboardKeycode(pgm_read_byte(keys + i)));\n"
+            yield "            }\n"
+            yield f"            {keyboard}.send();\n"
+        else:
+            yield f"                {keyboard}.press(KeyboardKeycode(pgm_read_byte(keys + i)));\n"
+            yield "            }\n"
+        yield "            break;\n"
+        yield "        }\n"
+    yield "        case STEP_RELEASE:\n"
+    yield f"            {keyboard}.releaseAll();\n"
+    yield "            break;\n"
+    yield "        case STEP_WAIT:\n"
+    yield "            if (now - stepStartedAt < step.arg) {\n"
+    yield "                return;\n"
+    yield "            }\n"
+    yield "            break;\n"
+    if tables['texts']:
+        yield "        case STEP_TEXT:\n"
+        yield "            if (typingPosition == nullptr) {\n"
+        yield "                typingPosition = (const uint8_t*)pgm_read_ptr(&TEXTS[step.arg]);\n"
+        yield "                typingReportAt = micros() - TYPING_REPORT_GAP_US;\n"
+        yield "            }\n"
+        yield "            if (!typeText()) {\n"
+        yield "                return;\n"
+        yield "            }\n"
+        yield "            typingPosition = nullptr;\n"
+        yield "            break;\n"
+    yield "    }\n"
+    yield "    ++currentStep;\n"
+    yield "    stepStartedAt = now;\n"
+    yield "}\n\n"
+
+
+def generate_host_bridge_code(tables):
+    """
+    Генерирует обмен кадрами с host_bridge.py по USB-serial (см. HOST_FRAME_*). Кнопка с действием
+    на компьютере отправляет кадр E с номером события, если хост присылал кадры за последние HOST_ALIVE_MS
+    и есть место среди HOST_PENDING событий, ждущих ответа; иначе сразу ставит в очередь резервный макрос.
+    Ответ A снимает ожидание и может попросить нажать комбинацию вставки, событие без ответа
+    за HOST_ACK_TIMEOUT_MS выполняется резервным макросом, и хост считается отключённым до следующего кадра.
+    На кадр H прошивка отвечает кадром H с идентификатором набора действий (host_config_id).
+    С -DTELEMETRY здесь же читается команда TR.
+    """
+    fallbacks = ", ".join(str(-1 if fallback is None else fallback) for _, _, fallback in tables['host_events'])
+    paste_programs = ", ".join(str(index) for index in tables['host_paste_programs'])
+
+    yield f"const uint8_t HOST_FRAME_LENGTH = {HOST_FRAME_LENGTH};\n"
+    yield f"const uint8_t HOST_PENDING = {HOST_PENDING};\n"
+    yield f"const unsigned long HOST_ACK_TIMEOUT_MS = {HOST_ACK_TIMEOUT_MS};\n"
+    yield f"const unsigned long HOST_ALIVE_MS = {HOST_ALIVE_MS};\n"
+    yield f"const uint16_t HOST_CONFIG_ID = 0x{host_config_id(tables['host_events']):04X};\n"
+    yield f"const uint8_t HOST_ACK_PASTE = {HOST_ACK_PASTE};\n"
+    yield f"const uint8_t HOST_ACK_REJECTED = {HOST_ACK_REJECTED};\n"
+    yield "// Резервная программа события, -1 - нет\n"
+    yield f"const int16_t HOST_FALLBACKS[] PROGMEM = {{{fallbacks}}};\n"
+    yield f"const ActionIndex HOST_PASTE_PROGRAMS[] = {{{paste_programs}}};\n\n"
+    yield "struct HostEvent {\n"
+    yield "    uint16_t id;\n"
+    yield "    uint8_t seq;\n"
+    yield "    bool pending;\n"
+    yield "    unsigned long sentAt;\n"
+    yield "};\n\n"
+    yield "HostEvent hostEvents[HOST_PENDING];\n"
+    yield "uint8_t hostSeq = 0;\n"
+    yield "bool hostListening = false;\n"
+    yield "unsigned long hostSeenAt = 0;\n"
+    yield "char hostFrame[HOST_FRAME_LENGTH];\n"
+    yield "uint8_t hostFrameLength = 0;\n"
+    yield "#ifdef TELEMETRY\n"
+    yield "char hostPreviousChar = 0;\n"
+    yield "void sendTelemetry();\n"
+    yield "#endif\n\n"
+
+    yield "char hexDigit(uint8_t value) {\n"
+    yield "    return value < 10 ? '0' + value : 'A' + value - 10;\n"
+    yield "}\n\n"
+    yield "// Если в буфере USB нет места на весь кадр, кадр не отправляется и loop() не ждёт хост\n"
+    yield "bool sendHostFrame(char type, uint8_t seq, uint16_t arg) {\n"
+    yield "    if (Serial.availableForWrite() < HOST_FRAME_LENGTH + 1) {\n"
+    yield "        return false;\n"
+    yield "    }\n"
+    yield "    char frame[HOST_FRAME_LENGTH + 1] = {'#', type, hexDigit(seq >> 4), hexDigit(seq & 0xF)};\n"
+    yield "    for (uint8_t i = 0; i < 4; ++i) {\n"
+    yield "        frame[4 + i] = hexDigit((arg >> (12 - 4 * i)) & 0xF);\n"
+    yield "    }\n"
+    yield "    uint8_t check = 0;\n"
+    yield "    for (uint8_t i = 1; i < 8; ++i) {\n"
+    yield "        check ^= frame[i];\n"
+    yield "    }\n"
+    yield "    frame[8] = hexDigit(check >> 4);\n"
+    yield "    frame[9] = hexDigit(check & 0xF);\n"
+    yield "    frame[10] = '\\n';\n"
+    yield "    Serial.write((const uint8_t*)frame, sizeof(frame));\n"
+    yield "    return true;\n"
+    yield "}\n\n"
+    yield "void runHostFallback(uint16_t id) {\n"
+    yield "    int16_t program = pgm_read_word(&HOST_FALLBACKS[id]);\n"
+    yield "    if (program >= 0) {\n"
+    yield "        queueAction(program);\n"
+    yield "    }\n"
+    yield "}\n\n"
+    yield "void sendHostEvent(uint16_t id) {\n"
+    yield "    unsigned long now = millis();\n"
+    yield "    if (hostListening && now - hostSeenAt < HOST_ALIVE_MS) {\n"
+    yield "        for (uint8_t i = 0; i < HOST_PENDING; ++i) {\n"
+    yield "            if (!hostEvents[i].pending) {\n"
+    yield f"                if (sendHostFrame('{HOST_FRAME_EVENT}', hostSeq, id)) {{\n"
+    yield "                    hostEvents[i] = {id, hostSeq++, true, now};\n"
+    yield "                    return;\n"
+    yield "                }\n"
+    yield "                break;\n"
+    yield "            }\n"
+    yield "        }\n"
+    yield "    }\n"
+    yield "    runHostFallback(id);\n"
+    yield "}\n\n"
+    yield "// Значение hex-цифр кадра с from по to (не включая) или -1\n"
+    yield "long hostFrameHex(uint8_t from, uint8_t to) {\n"
+    yield "    long value = 0;\n"
+    yield "    for (uint8_t i = from; i < to; ++i) {\n"
+    yield "        char c = hostFrame[i];\n"
+    yield "        int8_t digit = c >= '0' && c <= '9' ? c - '0' : (c >= 'A' && c <= 'F' ? c - 'A' + 10 : -1);\n"
+    yield "        if (digit < 0) {\n"
+    yield "            return -1;\n"
+    yield "        }\n"
+    yield "        value = (value << 4) | digit;\n"
+    yield "    }\n"
+    yield "    return value;\n"
+    yield "}\n\n"
+    yield "void handleHostFrame(unsigned long now) {\n"
+    yield "    long seq = hostFrameHex(2, 4);\n"
+    yield "    long arg = hostFrameHex(4, 8);\n"
+    yield "    uint8_t check = 0;\n"
+    yield "    for (uint8_t i = 1; i < 8; ++i) {\n"
+    yield "        check ^= hostFrame[i];\n"
+    yield "    }\n"
+    yield "    if (seq < 0 || arg < 0 || hostFrameHex(8, 10) != check) {\n"
+    yield "        return;\n"
+    yield "    }\n"
+    yield "    hostListening = true;\n"
+    yield "    hostSeenAt = now;\n"
+    yield f"    if (hostFrame[1] == '{HOST_FRAME_HELLO}') {{\n"
+    yield f"        sendHostFrame('{HOST_FRAME_HELLO}', 0, HOST_CONFIG_ID);\n"
+    yield f"    }} else if (hostFrame[1] == '{HOST_FRAME_ACK}') {{\n"
+    yield "        for (uint8_t i = 0; i < HOST_PENDING; ++i) {\n"
+    yield "            HostEvent& event = hostEvents[i];\n"
+    yield "            if (!event.pending || event.seq != seq) {\n"
+    yield "                continue;\n"
+    yield "            }\n"
+    yield "            event.pending = false;\n"
+    yield f"            if (arg == HOST_ACK_REJECTED) {{\n"
+    yield "                runHostFallback(event.id);\n"
+    yield f"            }} else if (arg >= HOST_ACK_PASTE && arg < HOST_ACK_PASTE + {len(HOST_PASTE_KEYS)}) {{\n"
+    yield "                queueAction(HOST_PASTE_PROGRAMS[arg - HOST_ACK_PASTE]);\n"
+    yield "            }\n"
+    yield "        }\n"
+    yield "    }\n"
+    yield "}\n\n"
+    yield "// Не больше HOST_FRAME_LENGTH входящих байт за проход loop(); байты вне кадра пропускаются\n"
+    yield "void handleHostBridge(unsigned long now) {\n"
+    yield "    for (uint8_t n = 0; n < HOST_FRAME_LENGTH && Serial.available() > 0; ++n) {\n"
+    yield "        char c = Serial.read();\n"
+    yield "        if (c == '#') {\n"
+    yield "            hostFrameLength = 0;\n"
+    yield "        } else if (hostFrameLength == 0) {\n"
+    yield "#ifdef TELEMETRY\n"
+    yield "            if (hostPreviousChar == 'T' && c == 'R') {\n"
+    yield "                sendTelemetry();\n"
+    yield "            }\n"
+    yield "            hostPreviousChar = c;\n"
+    yield "#endif\n"
+    yield "            continue;\n"
+    yield "        }\n"
+    yield "        hostFrame[hostFrameLength++] = c;\n"
+    yield "        if (hostFrameLength == HOST_FRAME_LENGTH) {\n"
+    yield "            handleHostFrame(now);\n"
+    yield "            hostFrameLength = 0;\n"
+    yield "        }\n"
+    yield "    }\n"
+    yield "    for (uint8_t i = 0; i < HOST_PENDING; ++i) {\n"
+    yield "        if (hostEvents[i].pending && now - hostEvents[i].sentAt >= HOST_ACK_TIMEOUT_MS) {\n"
+    yield "            hostEvents[i].pending = false;\n"
+    yield "            hostListening = false;\n"
+    yield "            runHostFallback(hostEvents[i].id);\n"
+    yield "        }\n"
+    yield "    }\n"
+    yield "}\n\n"
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _section(name, lines):
+    """Строки генератора кода как части name для write_sketch."""
+    return ((name, line) for line in lines)
+
+
+def write_sketch(sections, output):
+    """
+    Пишет части скетча (имя, текст) в путь или текстовый поток output по мере того, как sections их выдаёт;
+    при output=None только считает размер и хеш. Файл пишется во временный рядом и заменяет прежний,
+    только если содержимое изменилось: время изменения скетча не сдвигается, и сборка не начинается заново.
+    Переводы строк всегда \\n, поэтому одна и та же конфигурация даёт одни и те же байты на любой ОС.
+    Возвращает {'path', 'written', 'bytes', 'sha256', 'sections'} - размеры частей в байтах по именам.
+    """
+    digest = hashlib.sha256()
+    section_bytes = {}
+
+    def encoded():
+        for name, text in sections:
+            data = text.encode("utf-8")
+            digest.update(data)
+            section_bytes[name] = section_bytes.get(name, 0) + len(data)
+            yield text, data
+
+    path = None
+    if output is None:
+        for _ in encoded():
+            pass
+        written = False
+    elif hasattr(output, "write"):
+        for text, _ in encoded():
+            output.write(text)
+        written = True
+    else:
+        path = os.fspath(output)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                for _, data in encoded():
+                    f.write(data)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        size = sum(section_bytes.values())
+        written = not (os.path.isfile(path) and os.path.getsize(path) == size
+                       and _file_sha256(path) == digest.hexdigest())
+        if written:
+            os.replace(tmp_path, path)
+        else:
+            os.remove(tmp_path)
+    return {'path': path, 'written': written, 'bytes': sum(section_bytes.values()), 'sha256': digest.hexdigest(),
+            'sections': section_bytes}
+
+
+def generate_ino_file(modes, num_standard_buttons, num_drop_buttons,
+                      debounce_ms=DEBOUNCE_MS, hold_ms=HOLD_MS, repeat_ms=REPEAT_MS, matrix=None,
+                      dispatch='table', keyboard='keyboard', single_report=True, typing=TYPING_PROFILE,
+                      output_filename="kurs.ino"):
     """
     Главная функция, генерирующая .ino код для устройства
     с энкодером и дополнительными кнопками.
+    debounce_ms - окно подавления дребезга, hold_ms - время до события удержания,
+    repeat_ms - период автоповтора действия при удержании (0 - без автоповтора).
+    matrix - {'rows': [...], 'cols': [...], 'diodes': bool} для матрицы кнопок
+    вместо отдельного вывода на каждую кнопку, кнопки нумеруются по строкам.
+    dispatch - 'table' (таблица действий [режим][кнопка]) или 'classes'
+    (прежний класс на режим, оставлен для сравнения в benchmark.py).
+    Действия не блокируют loop(): они ставятся в очередь и выполняются по шагу за проход.
+    keyboard - 'keyboard', 'boot' или 'nkro' (см. HID_KEYBOARDS); single_report=False
+    возвращает прежнюю отправку комбинации отчётом на каждую клавишу.
+    typing - профиль печати текстов из TYPING_PROFILES.
+    Кнопки с действием на компьютере обмениваются кадрами с host_bridge.py (см. generate_host_bridge_code).
+    Тап/удержание и слои описаны у TAP_HOLD_MS; время решения считается отдельно от hold_ms.
+    Энкодер выполняет функцию из dropdown_button1 текущего режима (см. ENCODER_FUNCTIONS).
+    Сборка с -DLOOP_BENCHMARK печатает в Serial среднее время loop() в наносекундах
+    и самый долгий проход в микросекундах, сборка с -DTELEMETRY отвечает на запрос телеметрии
+    (см. generate_telemetry_code и telemetry.py).
+    output_filename - путь скетча или текстовый поток (например, io.StringIO), куда части скетча пишутся
+    по мере генерации; None только проверяет конфигурацию, не записывая скетч. Файл не перезаписывается,
+    если содержимое не изменилось. Возвращает сведения о скетче из write_sketch, GENERATOR_VERSION
+    и отчёт для вывода (report): память по режимам, USB-отчёты на действие и время кадра дисплея.
+    Ошибки конфигурации (см. validate_config) выбрасываются все сразу как ValidationError.
     """
+    if matrix:
+        num_standard_buttons = len(matrix['rows']) * len(matrix['cols'])
+    errors, tables = validate_sketch_config(modes, num_standard_buttons, num_drop_buttons, matrix, keyboard, typing)
+    if errors:
+        raise ValidationError(errors)
 
     pin_definitions = "\n"
     pin_definitions += "const int ENCODER_S1_PIN = 5;\n"
     pin_definitions += "const int ENCODER_S2_PIN = 6;\n"
-    pin_definitions += "const int ENCODER_KEY_PIN = 4;\n\n"
+    pin_definitions += "const int ENCODER_KEY_PIN = 4;\n"
 
-    standard_button_pins = list(range(7, 7 + num_standard_buttons))
-    for i in range(num_standard_buttons):
-        pin_definitions += f"const int button{i + 1}Pin = {standard_button_pins[i]};\n"
+    if matrix:
+        button_input_lines = generate_matrix_code(matrix)
+        button_setup_code = "for (uint8_t i = 0; i < sizeof(matrixPins); ++i) {\n"
+        button_setup_code += "        pinMode(matrixPins[i], INPUT_PULLUP);\n"
+        button_setup_code += "    }"
+        button_scan_code = "scanMatrix();\n"
+    else:
+        standard_button_pins = DIRECT_BUTTON_PINS[:num_standard_buttons]
+        pin_definitions += "\n"
+        for i in range(num_standard_buttons):
+            pin_definitions += f"const int button{i + 1}Pin = {standard_button_pins[i]};\n"
+        pin_list = ", ".join(f"button{i + 1}Pin" for i in range(num_standard_buttons))
+        button_input_lines = ["\n",
+                              f"const uint8_t buttonPins[] = {{{pin_list}}};\n\n",
+                              "bool readButton(uint8_t index) {\n",
+                              "    return digitalRead(buttonPins[index]) == LOW;\n",
+                              "}\n"]
+        button_setup_code = "for (uint8_t i = 0; i < NUM_BUTTONS; ++i) {\n"
+        button_setup_code += "        pinMode(buttonPins[i], INPUT_PULLUP);\n"
+        button_setup_code += "    }"
+        button_scan_code = ""
 
-    strategy_classes = "\n"
+    report = "\n".join([format_memory_report(memory_report(modes, tables)),
+                        format_report_counts(modes, tables, single_report, typing),
+                        format_display_cost(display_frame_cost())])
+    keyboard_object = HID_KEYBOARDS[keyboard]
+    host_bridge = bool(tables['host_events'])
     mode_names = list(modes.keys())
-    button_state_params = ", ".join(
-        [f"bool button{i + 1}State" for i in range(num_standard_buttons)]) if num_standard_buttons > 0 else ""
-
-    for mode_name in mode_names:
-        class_name = "Mode_" + re.sub(r'\W+', '_', mode_name)
-        mode_data = modes[mode_name]
+    if dispatch == 'classes' and (uses_key_events(tables) or tables['layer_only']):
+        raise ValueError("Тап/удержание и слои поддерживает только диспетчеризация таблицей")
+    if dispatch not in ('table', 'classes'):
+        raise ValueError(f"Неизвестный способ диспетчеризации: {dispatch}")
 
-        strategy_classes += f"class {class_name} : public ModeStrategy {{\n"
-        strategy_classes += "public:\n"
-        strategy_classes += f'    const char* getModeName() const override {{ return "{mode_name}"; }}\n'
-        strategy_classes += f"    void execute({button_state_params}) override {{\n"
+    encoder_functions = [encoder_function_code(mode_name, mode_data, num_drop_buttons)
+                         for mode_name, mode_data in modes.items()]
+    used_functions = [name for name, (constant, _, _, _) in ENCODER_FUNCTIONS.items() if constant in encoder_functions]
+    mouse_begin_code = "Mouse.begin();\n    " if 'Scroll' in used_functions else ""
+    if dispatch == 'table':
+        loop_dispatch_code = table_dispatch_loop_code(tables)
+    else:
+        loop_dispatch_code = class_dispatch_loop_code(num_standard_buttons)
 
-        for i in range(num_standard_buttons):
-            btn_key = f"button{i + 1}"
-            if btn_key in mode_data.get('standard_buttons', {}):
-                button_data = mode_data['standard_buttons'][btn_key]
-                strategy_classes += f"        if (button{i + 1}State) {{\n"
-                if button_data['type'] == 'Key Combination':
-                    strategy_classes += parse_and_press_keys(button_data['action'])
-                elif button_data['type'] == 'Print Text':
-                    action_text = button_data['action'].replace('\\', '\\\\').replace('"', '\\"')
-                    if action_text:
-                        strategy_classes += f'            Keyboard.print("{action_text}");\n'
-                    else:
-                        strategy_classes += '            // No text to print\n'
-                strategy_classes += "        }\n"
-
-        strategy_classes += "    }\n};\n\n"
-
-    # --- 3. Генерация ModeContext ---
-    context_class = "\n"
-    context_class += "class ModeContext {\n"
-    context_class += f"    ModeStrategy* strategies[{len(mode_names)}];\n"
-    context_class += "    int currentMode = 0;\n"
-    context_class += "public:\n"
-    context_class += "    ModeContext() {\n"
-    for i, mode_name in enumerate(mode_names):
-        class_name = "Mode_" + re.sub(r'\W+', '_', mode_name)
-        context_class += f"        strategies[{i}] = new {class_name}();\n"
-    context_class += "    }\n"
-    context_class += "    ~ModeContext() {\n"
-    context_class += f"        for (int i = 0; i < {len(mode_names)}; ++i) {{ delete strategies[i]; }}\n"
-    context_class += "    }\n"
-    context_class += "    void switchMode() {\n"
-    context_class += f"        currentMode = (currentMode + 1) % {len(mode_names)};\n"
-    context_class += "    }\n"
+    if host_bridge:
+        serial_begin_code = "    Serial.begin(115200);\n"
+        host_bridge_loop_code = "    handleHostBridge(now);\n"
+    else:
+        serial_begin_code = "#if defined(LOOP_BENCHMARK) || defined(TELEMETRY)\n"
+        serial_begin_code += "    Serial.begin(115200);\n"
+        serial_begin_code += "#endif\n"
+        host_bridge_loop_code = ""
 
-    execute_params = ', '.join([f'button{i + 1}State' for i in range(num_standard_buttons)])
-    context_class += f"    void executeCurrentMode({button_state_params}) {{\n"
-    context_class += f"        strategies[currentMode]->execute({execute_params});\n"
-    context_class += "    }\n"
-    context_class += "    const char* getCurrentModeName() const {\n"
-    context_class += "        return strategies[currentMode]->getModeName();\n"
-    context_class += "    }\n"
-    context_class += "};\n"
-
-    # --- 4. Генерация кода для setup() и loop() ---
-    pin_setup_code = "\n    ".join([f"pinMode(button{i + 1}Pin, INPUT_PULLUP);" for i in range(num_standard_buttons)])
-    button_read_code = "\n    ".join(
-        [f"bool button{i + 1}State = (digitalRead(button{i + 1}Pin) == LOW);" for i in range(num_standard_buttons)])
-
-    # --- 5. Собираем финальный .ino файл ---
-    ino_template = f"""
-#include <Wire.h>
+    def sketch_sections():
+        """Части скетча по порядку; таблицы и диспетчеризация генерируются, когда до них доходит запись."""
+        yield 'header', f"""#include <Wire.h>
 #include <Adafruit_GFX.h>
 #include <Adafruit_SSD1306.h>
 #include <HID-Project.h>
-#include <Encoder.h>
 
 #define SCREEN_WIDTH 128
 #define SCREEN_HEIGHT 32
 #define OLED_RESET -1
-Adafruit_SSD1306 display(SCREEN_WIDTH, SCREEN_HEIGHT, &Wire, OLED_RESET);
+const uint8_t OLED_ADDRESS = 0x3C;
+const uint32_t I2C_CLOCK_HZ = {I2C_CLOCK_HZ};
+// Частота I2C и во время передач Adafruit_SSD1306, и после них
+Adafruit_SSD1306 display(SCREEN_WIDTH, SCREEN_HEIGHT, &Wire, OLED_RESET, I2C_CLOCK_HZ, I2C_CLOCK_HZ);
 
 {pin_definitions}
 
-Encoder myEnc(ENCODER_S1_PIN, ENCODER_S2_PIN);
+const unsigned long DEBOUNCE_MS = {debounce_ms};
+const unsigned long HOLD_MS = {hold_ms};
+const unsigned long REPEAT_MS = {repeat_ms};
 
-class ModeStrategy {{
-public:
-    virtual const char* getModeName() const = 0;
-    virtual void execute({button_state_params}) = 0;
-    virtual ~ModeStrategy() = default;
+enum ButtonEvent : uint8_t {{ EVENT_NONE, EVENT_PRESS, EVENT_RELEASE, EVENT_HOLD, EVENT_REPEAT }};
+
+struct Button {{
+    bool pressed;
+    bool held;
+    unsigned long changedAt;
+    unsigned long repeatAt;
 }};
 
-{strategy_classes}
-{context_class}
+const uint8_t NUM_BUTTONS = {num_standard_buttons};
+Button buttons[NUM_BUTTONS];
+Button encoderButton;
+"""
+        yield from _section('header', button_input_lines)
+        yield 'header', f"""
+
+// Первый фронт обрабатывается сразу, а смены состояния в течение DEBOUNCE_MS после него
+// считаются дребезгом: нажатие доходит до USB без задержки на фильтрацию
+ButtonEvent updateButton(Button& button, bool pressed, unsigned long now) {{
+    if (pressed != button.pressed) {{
+        if (now - button.changedAt < DEBOUNCE_MS) {{
+            return EVENT_NONE;
+        }}
+        button.pressed = pressed;
+        button.changedAt = now;
+        if (!pressed) {{
+            return EVENT_RELEASE;
+        }}
+        button.held = false;
+        return EVENT_PRESS;
+    }}
+    if (pressed && !button.held && now - button.changedAt >= HOLD_MS) {{
+        button.held = true;
+        button.repeatAt = now;
+        return EVENT_HOLD;
+    }}
+    if (pressed && button.held && REPEAT_MS > 0 && now - button.repeatAt >= REPEAT_MS) {{
+        button.repeatAt = now;
+        return EVENT_REPEAT;
+    }}
+    return EVENT_NONE;
+}}
+
+bool isTriggered(ButtonEvent event) {{
+    return event == EVENT_PRESS || (REPEAT_MS > 0 && event == EVENT_REPEAT);
+}}
+"""
+        yield from _section('display', generate_display_code())
+        yield 'display', "\n"
+        yield from _section('telemetry', generate_telemetry_code())
+        yield 'telemetry', "\n"
+
+        # --- 2. Таблицы строк и комбинаций во flash, общие для всех режимов ---
+        yield 'tables', "\n"
+        # Тексты - коды HID для typeText(), уже переведённые из символов раскладки US
+        for i, text in enumerate(tables['texts']):
+            codes = "".join(f"0x{typing_code(char):02X}, " for char in text)
+            yield 'tables', f"const uint8_t TEXT_{i}[] PROGMEM = {{{codes}0}};\n"
+        if tables['texts']:
+            text_names = ", ".join(f"TEXT_{i}" for i in range(len(tables['texts'])))
+            yield 'tables', f"const uint8_t* const TEXTS[] PROGMEM = {{{text_names}}};\n\n"
+
+        # Первый байт записи - число клавиш в комбинации
+        for i, keys in enumerate(tables['key_sequences']):
+            yield 'tables', f"const uint8_t KEYS_{i}[] PROGMEM = {{{len(keys)}, {', '.join(keys)}}};\n"
+        if tables['key_sequences']:
+            key_names = ", ".join(f"KEYS_{i}" for i in range(len(tables['key_sequences'])))
+            yield 'tables', f"const uint8_t* const KEY_SEQUENCES[] PROGMEM = {{{key_names}}};\n\n"
+
+        yield from _section('executor', generate_action_executor(tables, typing, keyboard=keyboard_object,
+                                                                 single_report=single_report, telemetry=True))
+        if host_bridge:
+            yield from _section('host_bridge', generate_host_bridge_code(tables))
+        for i, mode_name in enumerate(mode_names):
+            yield 'tables', f"const char MODE_NAME_{i}[] PROGMEM = {c_string_literal(mode_name)};\n"
+        yield 'tables', "\n"
+
+        # --- 3. Диспетчеризация действий по режимам ---
+        if dispatch == 'table':
+            yield from _section('dispatch', generate_table_dispatch(mode_names, tables, num_standard_buttons))
+        else:
+            yield from _section('dispatch', generate_class_dispatch(mode_names, tables, num_standard_buttons))
+        yield 'dispatch', "\n"
+        yield from _section('encoder', generate_encoder_code(
+            "pgm_read_byte(&MODE_ENCODER_FUNCTIONS[currentModeIndex()])", used_functions,
+            on_change="markDirty(REGION_ENCODER);", labels=True, mode_functions=encoder_functions, telemetry=True))
+        yield 'encoder', "\n"
+        yield from _section('display', generate_display_render_code())
+        yield 'display', "\n"
+        yield from _section('telemetry', generate_telemetry_service_code(read_commands=not host_bridge))
+        yield 'telemetry', "\n"
+
+        # --- 4. setup() и loop() ---
+        button_read_code = button_scan_code + loop_dispatch_code
+        yield 'loop', f"""
+#ifdef LOOP_BENCHMARK
+// За 1000 итераций прошедшее время в микросекундах равно времени одной итерации в наносекундах
+const uint16_t BENCHMARK_LOOPS = 1000;
+uint16_t benchmarkLoops = 0;
+unsigned long benchmarkStart = 0;
+unsigned long lastLoopAt = 0;
+unsigned long maxLoopUs = 0;
+
+void reportLoopTime() {{
+    unsigned long now = micros();
+    if (now - lastLoopAt > maxLoopUs && benchmarkLoops > 0) {{
+        maxLoopUs = now - lastLoopAt;
+    }}
+    lastLoopAt = now;
+    if (++benchmarkLoops == BENCHMARK_LOOPS) {{
+        Serial.print(F("LOOP_NS "));
+        Serial.println((long)(now - benchmarkStart));
+        Serial.print(F("LOOP_MAX_US "));
+        Serial.println(maxLoopUs);
+        benchmarkLoops = 0;
+        maxLoopUs = 0;
+        benchmarkStart = micros();
+        lastLoopAt = benchmarkStart;
+    }}
+}}
+#endif
+
+// Первый кадр передаётся целиком, дальше только изменившиеся области из renderDisplay()
+void setupDisplay() {{
+    if(!display.begin(SSD1306_SWITCHCAPVCC, OLED_ADDRESS)) {{
+        for(;;); 
+    }}
+    display.clearDisplay();
+    display.setTextColor(SSD1306_WHITE);
+    display.setTextWrap(false);
+    for (uint8_t region = 0; region < NUM_REGIONS; ++region) {{
+        drawRegion(region);
+    }}
+    display.display();
+}}
+
+void handleEncoderButton(unsigned long now) {{
+    if (updateButton(encoderButton, digitalRead(ENCODER_KEY_PIN) == LOW, now) == EVENT_PRESS) {{
+        switchMode();
+        markDirty(REGION_MODE);
+    }}
+}}
+
+void setup() {{
+    pinMode(ENCODER_KEY_PIN, INPUT_PULLUP);
+    {button_setup_code}
+
+    setupEncoder();
+
+    {keyboard_object}.begin();
+    Consumer.begin();
+    {mouse_begin_code}setupDisplay();
+{serial_begin_code}}}
+
+void loop() {{
+#ifdef TELEMETRY
+    handleTelemetry();
+#endif
+    unsigned long now = millis();
+    handleEncoderRotation(now);
+    handleEncoderButton(now);
+{host_bridge_loop_code}
+    {button_read_code}
+    runActions(now);
+    renderDisplay(now);
+#ifdef LOOP_BENCHMARK
+    reportLoopTime();
+#endif
+}}"""
+
+    with span("write sketch", path=output_filename if isinstance(output_filename, str) else None) as current:
+        info = write_sketch(sketch_sections(), output_filename)
+        current.args.update(written=info['written'], bytes=info['bytes'])
+    info['generator_version'] = GENERATOR_VERSION
+    info['report'] = report
+    return info
+
+
+def generate_keymap_firmware(num_standard_buttons, output_filename="keymap_firmware/keymap_firmware.ino"):
+    """
+    Генерирует универсальную прошивку, которая читает раскладку из EEPROM.
+    Прошивка зависит только от числа кнопок, режимы загружаются по serial через keymap.py.
+    Скетч пишется через write_sketch, как у generate_ino_file, и возвращаются его сведения.
+    """
+    button_pins = ", ".join(str(pin) for pin in DIRECT_BUTTON_PINS[:num_standard_buttons])
+
+    def sketch_sections():
+        yield 'header', f"""#include <Wire.h>
+#include <EEPROM.h>
+#include <Adafruit_GFX.h>
+#include <Adafruit_SSD1306.h>
+#include <HID-Project.h>
+
+#define SCREEN_WIDTH 128
+#define SCREEN_HEIGHT 32
+#define OLED_RESET -1
+const uint32_t I2C_CLOCK_HZ = {I2C_CLOCK_HZ};
+Adafruit_SSD1306 display(SCREEN_WIDTH, SCREEN_HEIGHT, &Wire, OLED_RESET, I2C_CLOCK_HZ, I2C_CLOCK_HZ);
+
+const int ENCODER_S1_PIN = 5;
+const int ENCODER_S2_PIN = 6;
+const int ENCODER_KEY_PIN = 4;
+
+const uint8_t NUM_BUTTONS = {num_standard_buttons};
+const uint8_t buttonPins[NUM_BUTTONS] = {{{button_pins}}};
 
-ModeContext modeContext;
+// Формат раскладки: 'K' 'M' version len_lo len_hi num_modes num_buttons, режимы, crc16
+const uint8_t KEYMAP_VERSION = 1;
+const uint8_t KEYMAP_HEADER_SIZE = 7;
+const uint8_t ACTION_KEYS = 1;
+const uint8_t ACTION_TEXT = 2;
+const unsigned long SERIAL_TIMEOUT = 500;
+
+uint8_t numModes = 0;
+uint8_t currentMode = 0;
+uint8_t encoderFunction = 0;
+bool lastButtonState[NUM_BUTTONS];
+unsigned long lastChangeTime[NUM_BUTTONS];
+const unsigned long buttonDebounce = 20;
 unsigned long lastDebounceTime = 0;
 const int debounceDelay = 250;
-long oldEncoderPosition = -999;
+
+const unsigned long KEY_PRESS_MS = {KEY_PRESS_MS};
+const uint8_t TYPE_CHUNK = {TYPE_CHUNK};
+uint8_t pendingType = 0;
+uint16_t pendingOffset = 0;
+uint8_t pendingRemaining = 0;
+unsigned long pressedAt = 0;
+
+// Экран перерисуется из loop(), а не в обработчике кнопки
+const unsigned long FRAME_MS = {FRAME_MS};
+bool displayDirty = false;
+unsigned long lastFrameAt = 0;
+
+uint16_t crc16Update(uint16_t crc, uint8_t data) {{
+    crc ^= (uint16_t)data << 8;
+    for (uint8_t i = 0; i < 8; ++i) {{
+        crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }}
+    return crc;
+}}
+
+uint16_t keymapLength() {{
+    return EEPROM.read(3) | ((uint16_t)EEPROM.read(4) << 8);
+}}
+
+bool keymapValid() {{
+    return EEPROM.read(0) == 'K' && EEPROM.read(1) == 'M' && EEPROM.read(2) == KEYMAP_VERSION
+        && EEPROM.read(6) == NUM_BUTTONS;
+}}
+
+uint16_t buttonsOffset(uint16_t offset) {{
+    // Пропускаем имя режима и функцию энкодера
+    return offset + 1 + EEPROM.read(offset) + 1;
+}}
+
+uint16_t modeOffset(uint8_t mode) {{
+    uint16_t offset = KEYMAP_HEADER_SIZE;
+    for (uint8_t m = 0; m < mode; ++m) {{
+        offset = buttonsOffset(offset);
+        for (uint8_t b = 0; b < NUM_BUTTONS; ++b) {{
+            offset += 2 + EEPROM.read(offset + 1);
+        }}
+    }}
+    return offset;
+}}
+
+void selectMode(uint8_t mode) {{
+    currentMode = mode;
+    if (numModes > 0) {{
+        encoderFunction = EEPROM.read(buttonsOffset(modeOffset(mode)) - 1);
+    }}
+}}
+
+void loadKeymap() {{
+    // Смещения незавершённого действия указывают в старую раскладку
+    if (pendingType != 0) {{
+        Keyboard.releaseAll();
+        pendingType = 0;
+    }}
+    numModes = keymapValid() ? EEPROM.read(5) : 0;
+    selectMode(0);
+}}
+
+// Пока выполняется предыдущее действие, новые нажатия отбрасываются
+void executeButton(uint8_t button) {{
+    if (numModes == 0 || pendingType != 0) {{
+        return;
+    }}
+    uint16_t offset = buttonsOffset(modeOffset(currentMode));
+    for (uint8_t b = 0; b < button; ++b) {{
+        offset += 2 + EEPROM.read(offset + 1);
+    }}
+    uint8_t type = EEPROM.read(offset);
+    uint8_t length = EEPROM.read(offset + 1);
+    offset += 2;
+    if (type == ACTION_KEYS) {{
+        // Вся комбинация уходит одним отчётом
+        for (uint8_t i = 0; i < length; ++i) {{
+            Keyboard.add(KeyboardKeycode(EEPROM.read(offset + i)));
+        }}
+        Keyboard.send();
+        pendingType = ACTION_KEYS;
+        pressedAt = millis();
+    }} else if (type == ACTION_TEXT) {{
+        pendingType = ACTION_TEXT;
+        pendingOffset = offset;
+        pendingRemaining = length;
+    }}
+}}
+
+// Отпускает комбинацию по millis() и печатает текст порциями, не останавливая loop()
+void runAction(unsigned long now) {{
+    if (pendingType == ACTION_KEYS && now - pressedAt >= KEY_PRESS_MS) {{
+        Keyboard.releaseAll();
+        pendingType = 0;
+    }} else if (pendingType == ACTION_TEXT) {{
+        for (uint8_t i = 0; i < TYPE_CHUNK && pendingRemaining > 0; ++i, --pendingRemaining) {{
+            Keyboard.write(EEPROM.read(pendingOffset++));
+        }}
+        if (pendingRemaining == 0) {{
+            pendingType = 0;
+        }}
+    }}
+}}
 
 void setupDisplay() {{
-    if(!display.begin(SSD1306_SWITCHCAPVCC, 0x3C)) {{ 
-        for(;;); 
+    if(!display.begin(SSD1306_SWITCHCAPVCC, 0x3C)) {{
+        for(;;);
     }}
     display.clearDisplay();
     display.setTextSize(2);
@@ -158,60 +2459,185 @@ void setupDisplay() {{
     display.display();
 }}
 
-void updateDisplay(const char* modeName) {{
+void updateDisplay() {{
     display.clearDisplay();
     display.setCursor(0, 0);
-    display.println(modeName);
+    if (numModes == 0) {{
+        display.println(F("No keymap"));
+    }} else {{
+        uint16_t offset = modeOffset(currentMode);
+        uint8_t nameLength = EEPROM.read(offset);
+        for (uint8_t i = 0; i < nameLength; ++i) {{
+            display.write(EEPROM.read(offset + 1 + i));
+        }}
+    }}
     display.display();
 }}
 
-void handleEncoderRotation() {{
-    long newEncoderPosition = myEnc.read() / 4;
-    if (newEncoderPosition != oldEncoderPosition) {{
-        if (newEncoderPosition > oldEncoderPosition) {{
-            Consumer.write(MEDIA_VOLUME_UP);
-        }} else {{
-            Consumer.write(MEDIA_VOLUME_DOWN);
+int readByte() {{
+    unsigned long start = millis();
+    while (!Serial.available()) {{
+        if (millis() - start > SERIAL_TIMEOUT) {{
+            return -1;
         }}
-        oldEncoderPosition = newEncoderPosition;
+    }}
+    return Serial.read();
+}}
+
+void drainSerial() {{
+    while (readByte() >= 0) {{}}
+}}
+
+void receiveKeymap() {{
+    uint8_t header[KEYMAP_HEADER_SIZE];
+    for (uint8_t i = 0; i < KEYMAP_HEADER_SIZE; ++i) {{
+        int c = readByte();
+        if (c < 0) {{
+            Serial.println(F("ERR TIMEOUT"));
+            return;
+        }}
+        header[i] = c;
+    }}
+    uint16_t length = header[3] | ((uint16_t)header[4] << 8);
+    if (header[0] != 'K' || header[1] != 'M' || header[2] != KEYMAP_VERSION) {{
+        drainSerial();
+        Serial.println(F("ERR FORMAT"));
+        return;
+    }}
+    if (length < KEYMAP_HEADER_SIZE + 2 || length > EEPROM.length()) {{
+        drainSerial();
+        Serial.println(F("ERR SIZE"));
+        return;
+    }}
+    if (header[6] != NUM_BUTTONS) {{
+        drainSerial();
+        Serial.println(F("ERR LAYOUT"));
+        return;
+    }}
+
+    // Сигнатура пишется последней: оборванная загрузка не оставит битую раскладку
+    EEPROM.update(0, 0xFF);
+    uint16_t crc = 0xFFFF;
+    for (uint8_t i = 2; i < KEYMAP_HEADER_SIZE; ++i) {{
+        crc = crc16Update(crc, header[i]);
+        EEPROM.update(i, header[i]);
+    }}
+    for (uint16_t i = KEYMAP_HEADER_SIZE; i < length - 2; ++i) {{
+        int c = readByte();
+        if (c < 0) {{
+            Serial.println(F("ERR TIMEOUT"));
+            loadKeymap();
+            return;
+        }}
+        crc = crc16Update(crc, c);
+        EEPROM.update(i, c);
+    }}
+    int crcLow = readByte();
+    int crcHigh = readByte();
+    if (crcLow < 0 || crcHigh < 0 || (uint16_t)(crcLow | (crcHigh << 8)) != crc) {{
+        Serial.println(F("ERR CRC"));
+        loadKeymap();
+        return;
+    }}
+    EEPROM.update(length - 2, crcLow);
+    EEPROM.update(length - 1, crcHigh);
+    EEPROM.update(1, 'M');
+    EEPROM.update(0, 'K');
+
+    loadKeymap();
+    updateDisplay();
+    Serial.println(F("OK"));
+}}
+
+void sendKeymap() {{
+    if (!keymapValid()) {{
+        Serial.println(F("ERR EMPTY"));
+        return;
+    }}
+    uint16_t length = keymapLength();
+    for (uint16_t i = 0; i < length; ++i) {{
+        Serial.write(EEPROM.read(i));
+    }}
+}}
+
+void handleSerial() {{
+    if (Serial.available() < 2) {{
+        return;
+    }}
+    if (Serial.read() != 'K') {{
+        return;
+    }}
+    int command = Serial.read();
+    if (command == 'W') {{
+        receiveKeymap();
+    }} else if (command == 'R') {{
+        sendKeymap();
     }}
 }}
 
+"""
+        # Функция энкодера приходит с раскладкой, поэтому в прошивке есть отправка для всех функций
+        yield from _section('encoder', generate_encoder_code("encoderFunction"))
+        yield 'loop', f"""
 void handleEncoderButton() {{
     if (digitalRead(ENCODER_KEY_PIN) == LOW) {{
-        if ((millis() - lastDebounceTime) > debounceDelay) {{
-            modeContext.switchMode();
-            updateDisplay(modeContext.getCurrentModeName());
+        if ((millis() - lastDebounceTime) > debounceDelay && numModes > 0) {{
+            selectMode((currentMode + 1) % numModes);
+            displayDirty = true;
             lastDebounceTime = millis();
         }}
     }}
 }}
 
+void handleButtons() {{
+    unsigned long now = millis();
+    for (uint8_t b = 0; b < NUM_BUTTONS; ++b) {{
+        bool pressed = digitalRead(buttonPins[b]) == LOW;
+        if (pressed != lastButtonState[b] && now - lastChangeTime[b] > buttonDebounce) {{
+            lastButtonState[b] = pressed;
+            lastChangeTime[b] = now;
+            if (pressed) {{
+                executeButton(b);
+            }}
+        }}
+    }}
+}}
+
 void setup() {{
+    Serial.begin(115200);
     pinMode(ENCODER_KEY_PIN, INPUT_PULLUP);
-    {pin_setup_code}
+    for (uint8_t b = 0; b < NUM_BUTTONS; ++b) {{
+        pinMode(buttonPins[b], INPUT_PULLUP);
+    }}
+
+    setupEncoder();
 
     Keyboard.begin();
     Consumer.begin();
+    Mouse.begin();
     setupDisplay();
-    updateDisplay(modeContext.getCurrentModeName());
+    loadKeymap();
+    updateDisplay();
 }}
 
 void loop() {{
-    handleEncoderRotation();
+    handleSerial();
+    handleEncoderRotation(millis());
     handleEncoderButton();
+    handleButtons();
+    runAction(millis());
+    if (displayDirty && millis() - lastFrameAt >= FRAME_MS) {{
+        updateDisplay();
+        displayDirty = false;
+        lastFrameAt = millis();
+    }}
+}}"""
 
-    {button_read_code}
-
-    modeContext.executeCurrentMode({execute_params});
-
-    delay(10); // Small delay for stability
-}}
-"""
-    output_filename = "kurs.ino"
-    with open(output_filename, "w", encoding="utf-8") as f:
-        f.write(ino_template.strip())
-    return 1
+    os.makedirs(os.path.dirname(output_filename) or ".", exist_ok=True)
+    with span("write sketch", path=output_filename) as current:
+        info = write_sketch(sketch_sections(), output_filename)
+        current.args.update(written=info['written'], bytes=info['bytes'])
+    return info
 
 
 if __name__ == "__main__":
@@ -256,14 +2682,13 @@ if __name__ == "__main__":
     }
 
     # Генерируем код
-    generated_code = generate_ino_file(
+    info = generate_ino_file(
         config['modes'],
         config['standard_buttons'],
         config['dropdown_buttons']
     )
+    print(info['report'])
 
-
-
-    print(f"Arduino sketch successfully generated and saved to '{1}'")
+    print(f"Arduino sketch successfully generated and saved to '{info['path']}'")
     # print("\n--- Generated Code ---\n")
     # print(generated_code)
\ No newline at end of file
@@ -0,0 +1,298 @@
+import argparse
+import asyncio
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+import webbrowser
+
+from generate import (HOST_ACK_DONE, HOST_ACK_PASTE, HOST_ACK_PASTE_GUI, HOST_ACK_REJECTED, HOST_FRAME_ACK,
+                      HOST_FRAME_EVENT, HOST_FRAME_HELLO, HOST_FRAME_LENGTH, HOST_ALIVE_MS, build_progmem_tables,
+                      host_config_id)
+
+# Действия на компьютере для кнопок типа Host Action: прошивка присылает по USB-serial кадр с номером события,
+# демон выполняет действие из той же конфигурации, что main.py, и отвечает кадром A. Кадр H демон
+# отправляет раз в HEARTBEAT_SECONDS: пока они приходят, прошивка считает, что хост слушает
+BAUDRATE = 115200
+HEARTBEAT_SECONDS = 1.0
+RECONNECT_SECONDS = 1.0
+MODES_PATH = "modes.json"
+SETTINGS_PATH = "settings.json"
+# Программы записи в буфер обмена по платформам, первая найденная
+CLIPBOARD_COMMANDS = {
+    "win32": [["clip"]],
+    "darwin": [["pbcopy"]],
+    "linux": [["wl-copy"], ["xclip", "-selection", "clipboard"], ["xsel", "--clipboard", "--input"]],
+}
+CLIPBOARD_TIMEOUT = 2
+
+assert HEARTBEAT_SECONDS * 1000 * 2 < HOST_ALIVE_MS
+
+
+class HostActionError(Exception):
+    pass
+
+
+def encode_frame(kind, seq, arg):
+    """Кадр '#', тип, номер, аргумент и контрольная сумма, как их разбирает прошивка, с переводом строки."""
+    body = f"{kind}{seq & 0xFF:02X}{arg & 0xFFFF:04X}"
+    check = 0
+    for char in body:
+        check ^= ord(char)
+    return f"#{body}{check:02X}\n".encode("ascii")
+
+
+def decode_frame(line):
+    """(тип, номер, аргумент) или None для строк, которые не являются кадром (например, телеметрия)."""
+    line = line.strip()
+    if len(line) != HOST_FRAME_LENGTH or not line.startswith("#"):
+        return None
+    try:
+        seq, arg, check = int(line[2:4], 16), int(line[4:8], 16), int(line[8:10], 16)
+    except ValueError:
+        return None
+    expected = 0
+    for char in line[1:8]:
+        expected ^= ord(char)
+    return (line[1], seq, arg) if check == expected else None
+
+
+def copy_to_clipboard(text):
+    for command in CLIPBOARD_COMMANDS.get(sys.platform, CLIPBOARD_COMMANDS["linux"]):
+        if shutil.which(command[0]) is None:
+            continue
+        # clip.exe понимает Unicode только в UTF-16 с BOM
+        data = text.encode("utf-16" if command[0] == "clip" else "utf-8")
+        try:
+            subprocess.run(command, input=data, check=True, timeout=CLIPBOARD_TIMEOUT)
+        except (OSError, subprocess.SubprocessError) as e:
+            raise HostActionError(f"{command[0]}: {e}")
+        return
+    raise HostActionError("Не найдена программа для буфера обмена (wl-copy, xclip или xsel)")
+
+
+def execute_host_action(kind, argument):
+    """
+    Выполняет действие и возвращает ответ прошивке (HOST_ACK_*). paste и paste-file кладут текст
+    в буфер обмена, а вставку нажимает плата: Ctrl+V, на macOS - Cmd+V. В тексте paste \\n и \\t - перевод
+    строки и табуляция. run запускает команду, не дожидаясь её завершения, open открывает адрес или файл.
+    """
+    if kind == "paste":
+        copy_to_clipboard(argument.replace("\\n", "\n").replace("\\t", "\t"))
+    elif kind == "paste-file":
+        with open(os.path.expanduser(argument), "r", encoding="utf-8") as f:
+            copy_to_clipboard(f.read())
+    elif kind == "run":
+        options = {"start_new_session": True} if os.name == "posix" else {"creationflags": subprocess.DETACHED_PROCESS}
+        subprocess.Popen(shlex.split(argument) if os.name == "posix" else argument, stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **options)
+        return HOST_ACK_DONE
+    elif kind == "open":
+        if not webbrowser.open(argument):
+            raise HostActionError(f"Не удалось открыть {argument}")
+        return HOST_ACK_DONE
+    else:
+        raise HostActionError(f"Неизвестное действие: {kind}")
+    return HOST_ACK_PASTE_GUI if sys.platform == "darwin" else HOST_ACK_PASTE
+
+
+class HostBridge:
+    """
+    Обслуживает подключение к плате: отвечает на события, сверяет идентификатор набора действий
+    из кадра H прошивки с конфигурацией и присылает кадры H. Действия выполняются в потоках,
+    чтобы долгая запись в буфер обмена не задерживала чтение следующих событий.
+    events - host_events из build_progmem_tables, executor(вид, аргумент) возвращает HOST_ACK_*.
+    """
+
+    def __init__(self, events, executor=execute_host_action, on_log=print, heartbeat=HEARTBEAT_SECONDS):
+        self.events = events
+        self.config_id = host_config_id(events)
+        self.executor = executor
+        self.on_log = on_log
+        self.heartbeat = heartbeat
+        self.device_config_id = None
+        self.handled = 0
+
+    async def run(self, reader, writer):
+        """Обслуживает одно подключение до его закрытия или ошибки порта."""
+        self.device_config_id = None
+        heartbeat = asyncio.create_task(self._send_heartbeats(writer))
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                text = line.decode("ascii", errors="replace")
+                frame = decode_frame(text)
+                if frame is None:
+                    if text.strip():
+                        self.on_log(text.strip())
+                    continue
+                kind, seq, arg = frame
+                if kind == HOST_FRAME_HELLO:
+                    self._check_config(arg)
+                elif kind == HOST_FRAME_EVENT:
+                    task = asyncio.create_task(self._handle_event(writer, seq, arg))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        except OSError as e:
+            self.on_log(f"Ошибка порта: {e}")
+        finally:
+            heartbeat.cancel()
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    def _check_config(self, device_config_id):
+        if device_config_id != self.device_config_id and device_config_id != self.config_id:
+            self.on_log(f"Прошивка собрана с другими действиями на компьютере (0x{device_config_id:04X}, "
+                        f"в конфигурации 0x{self.config_id:04X}): события выполняются резервными макросами")
+        self.device_config_id = device_config_id
+
+    async def _send_heartbeats(self, writer):
+        while True:
+            writer.write(encode_frame(HOST_FRAME_HELLO, 0, 0))
+            await writer.drain()
+            await asyncio.sleep(self.heartbeat)
+
+    async def _handle_event(self, writer, seq, event_id):
+        status = HOST_ACK_REJECTED
+        if self.device_config_id == self.config_id and event_id < len(self.events):
+            kind, argument, _ = self.events[event_id]
+            start = time.perf_counter()
+            try:
+                status = await asyncio.get_running_loop().run_in_executor(None, self.executor, kind, argument)
+                self.handled += 1
+            except (HostActionError, OSError) as e:
+                self.on_log(f"Событие {event_id} ({kind}): {e}")
+            else:
+                self.on_log(f"Событие {event_id}: {kind} за {(time.perf_counter() - start) * 1000:.1f} мс")
+        writer.write(encode_frame(HOST_FRAME_ACK, seq, status))
+        await writer.drain()
+
+
+class _TtyWriter(asyncio.StreamWriter):
+    """Запись в tty без pyserial-asyncio; close() закрывает и транспорт чтения того же устройства."""
+
+    def __init__(self, read_transport, *args):
+        super().__init__(*args)
+        self._read_transport = read_transport
+
+    def close(self):
+        self._read_transport.close()
+        super().close()
+
+
+def _open_tty(port, baudrate):
+    import termios
+    import tty
+
+    fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    tty.setraw(fd)
+    attributes = termios.tcgetattr(fd)
+    attributes[4] = attributes[5] = getattr(termios, f"B{baudrate}")
+    termios.tcsetattr(fd, termios.TCSANOW, attributes)
+    return fd
+
+
+async def open_serial(port, baudrate=BAUDRATE):
+    """
+    (StreamReader, StreamWriter) порта: через pyserial-asyncio, если он установлен, иначе в Linux и macOS
+    напрямую через tty. Скорость не 1200 бод: на ней Pro Micro уходит в загрузчик.
+    """
+    try:
+        import serial_asyncio
+    except ImportError:
+        serial_asyncio = None
+    if serial_asyncio is not None:
+        return await serial_asyncio.open_serial_connection(url=port, baudrate=baudrate)
+    if os.name != "posix":
+        raise HostActionError("Для работы с портом в Windows установите pyserial-asyncio")
+    fd = _open_tty(port, baudrate)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    read_transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                                     os.fdopen(fd, "rb", buffering=0))
+    write_transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin,
+                                                              os.fdopen(os.dup(fd), "wb", buffering=0))
+    return reader, _TtyWriter(read_transport, write_transport, protocol, reader, loop)
+
+
+async def serve(port, bridge, baudrate=BAUDRATE, reconnect_seconds=RECONNECT_SECONDS):
+    """Держит подключение к плате: после отключения или перезагрузки платы подключается снова."""
+    while True:
+        try:
+            reader, writer = await open_serial(port, baudrate)
+        except OSError as e:
+            bridge.on_log(f"{port}: {e}")
+        else:
+            bridge.on_log(f"Подключено к {port}, действий на компьютере: {len(bridge.events)}")
+            await bridge.run(reader, writer)
+            bridge.on_log(f"{port}: соединение закрыто")
+        await asyncio.sleep(reconnect_seconds)
+
+
+def default_modes_path():
+    """Профиль, открытый в main.py последним, или modes.json, если профилей ещё нет."""
+    from profile_store import ProfileStore
+
+    store = ProfileStore()
+    active = store.active
+    if active and active in store.profile_names():
+        return os.path.join(store.root, active)
+    return MODES_PATH
+
+
+def load_host_events(modes_path, settings_path=SETTINGS_PATH):
+    """Действия на компьютере в порядке номеров событий прошивки, собранной из тех же режимов и настроек."""
+    from cli import button_counts, load_config
+
+    modes, settings = load_config(modes_path, settings_path)
+    num_standard_buttons, _ = button_counts(settings)
+    return build_progmem_tables(modes, num_standard_buttons)['host_events']
+
+
+def main(argv=None):
+    from cli import ConfigError
+
+    parser = argparse.ArgumentParser(description="Выполнение действий на компьютере по событиям кнопок")
+    parser.add_argument("modes", nargs="?", help="файл режимов или каталог профиля, по умолчанию профиль main.py")
+    parser.add_argument("--settings", default=SETTINGS_PATH)
+    parser.add_argument("--port", help="порт платы, по умолчанию найденный по VID/PID")
+    parser.add_argument("-q", "--quiet", action="store_true", help="выводить только ошибки")
+    args = parser.parse_args(argv)
+
+    try:
+        events = load_host_events(args.modes or default_modes_path(), args.settings)
+    except ConfigError as e:
+        print(f"Ошибка конфигурации: {e}", file=sys.stderr)
+        return 1
+    port = args.port
+    if port is None:
+        from upload import find_pro_micro_port
+        try:
+            port = find_pro_micro_port()
+        except ValueError as e:
+            # Несколько плат: find_board не выбирает сам, какую из них слушать
+            print(f"{e}\nУкажите порт платы: --port.", file=sys.stderr)
+            return 1
+    if port is None:
+        print("Плата не найдена. Укажите --port.", file=sys.stderr)
+        return 1
+
+    def log(line):
+        if not args.quiet or line.startswith(("Ошибка", "Прошивка")):
+            print(line, flush=True)
+
+    try:
+        asyncio.run(serve(port, HostBridge(events, on_log=log)))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
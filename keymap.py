@@ -0,0 +1,253 @@
+import binascii
+import json
+import os
+import struct
+import sys
+import time
+
+from generate import ENCODER_FUNCTIONS as FIRMWARE_ENCODER_FUNCTIONS, LAYER_ACTION_TYPES, key_to_hid
+
+# Формат совпадает с прошивкой из generate_keymap_firmware
+KEYMAP_MAGIC = b"KM"
+KEYMAP_VERSION = 1
+KEYMAP_HEADER = struct.Struct("<2sBHBB")
+EEPROM_SIZE = 1024
+MAX_NAME_LENGTH = 20
+BAUDRATE = 115200
+
+ACTION_TYPES = {"Key Combination": 1, "Print Text": 2}
+# Код функции энкодера в EEPROM - её номер в этом списке
+ENCODER_FUNCTIONS = list(FIRMWARE_ENCODER_FUNCTIONS)
+
+
+def _crc16(data):
+    """CRC-16/CCITT-FALSE, та же функция, что crc16Update в прошивке."""
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def serialize_modes(modes, num_standard_buttons, num_drop_buttons):
+    """Собирает компактный бинарный образ раскладки для записи в EEPROM."""
+    body = bytearray()
+    for mode_name, mode_data in modes.items():
+        name = mode_name.encode("ascii", errors="replace")[:MAX_NAME_LENGTH]
+        body += bytes([len(name)]) + name
+
+        encoder_function = "Nothing"
+        if num_drop_buttons > 0:
+            encoder_function = mode_data.get("dropdown_buttons", {}).get("dropdown_button1", "Nothing")
+        if encoder_function not in ENCODER_FUNCTIONS:
+            raise ValueError(f"{mode_name}: неизвестная функция энкодера '{encoder_function}'")
+        body.append(ENCODER_FUNCTIONS.index(encoder_function))
+
+        for i in range(num_standard_buttons):
+            button_data = mode_data.get("standard_buttons", {}).get(f"button{i + 1}", {})
+            action = button_data.get("action", "")
+            payload = b""
+            action_type = 0
+            if button_data.get("hold") or (button_data.get("type") in LAYER_ACTION_TYPES and action.strip()):
+                raise ValueError(f"{mode_name}, button{i + 1}: тап/удержание и слои не поддерживаются "
+                                 f"прошивкой с раскладкой в EEPROM")
+            if button_data.get("type") == "Key Combination" and action.strip():
+                keycodes = []
+                for part in action.split("+"):
+                    keycode = key_to_hid(part)
+                    if keycode is None:
+                        raise ValueError(f"{mode_name}, button{i + 1}: неизвестная клавиша '{part.strip()}'")
+                    keycodes.append(keycode)
+                payload = bytes(keycodes)
+                action_type = ACTION_TYPES["Key Combination"]
+            elif button_data.get("type") == "Print Text" and action:
+                try:
+                    payload = action.encode("ascii")
+                except UnicodeEncodeError:
+                    raise ValueError(f"{mode_name}, button{i + 1}: текст должен содержать только ASCII")
+                action_type = ACTION_TYPES["Print Text"]
+            elif button_data.get("type") == "Macro" and action.strip():
+                raise ValueError(f"{mode_name}, button{i + 1}: макросы не поддерживаются прошивкой с раскладкой в EEPROM")
+            elif button_data.get("type") == "Host Action" and action.strip():
+                raise ValueError(f"{mode_name}, button{i + 1}: действия на компьютере не поддерживаются "
+                                 f"прошивкой с раскладкой в EEPROM")
+            if len(payload) > 255:
+                raise ValueError(f"{mode_name}, button{i + 1}: действие длиннее 255 байт")
+            body += bytes([action_type, len(payload)]) + payload
+
+    length = KEYMAP_HEADER.size + len(body) + 2
+    if length > EEPROM_SIZE:
+        raise ValueError(f"Раскладка занимает {length} байт, в EEPROM помещается {EEPROM_SIZE}")
+    if len(modes) > 255:
+        raise ValueError("Слишком много режимов")
+
+    blob = KEYMAP_HEADER.pack(KEYMAP_MAGIC, KEYMAP_VERSION, length, len(modes), num_standard_buttons) + body
+    return blob + struct.pack("<H", _crc16(blob[2:]))
+
+
+def deserialize_keymap(blob):
+    """Разбирает образ раскладки обратно в словарь режимов в формате modes.json."""
+    magic, version, length, num_modes, num_buttons = KEYMAP_HEADER.unpack_from(blob)
+    if magic != KEYMAP_MAGIC or version != KEYMAP_VERSION:
+        raise ValueError("Неверная сигнатура раскладки")
+    if length != len(blob) or struct.unpack_from("<H", blob, length - 2)[0] != _crc16(blob[2:length - 2]):
+        raise ValueError("Повреждённая раскладка")
+
+    action_names = {code: name for name, code in ACTION_TYPES.items()}
+    hid_names = {}
+    for part in ["ctrl", "shift", "alt", "win", "esc", "enter", "tab", "backspace", "delete", "insert",
+                 "up", "down", "left", "right"] + [f"f{i}" for i in range(1, 13)]:
+        hid_names[key_to_hid(part)] = part.capitalize()
+    for code in range(0x04, 0x39):
+        for char in map(chr, range(32, 127)):
+            if key_to_hid(char) == code:
+                hid_names.setdefault(code, char.upper())
+
+    modes = {}
+    offset = KEYMAP_HEADER.size
+    for _ in range(num_modes):
+        name_length = blob[offset]
+        mode_name = blob[offset + 1:offset + 1 + name_length].decode("ascii")
+        offset += 1 + name_length
+        encoder_function = ENCODER_FUNCTIONS[blob[offset]]
+        offset += 1
+        standard_buttons = {}
+        for i in range(num_buttons):
+            action_type, action_length = blob[offset], blob[offset + 1]
+            payload = blob[offset + 2:offset + 2 + action_length]
+            offset += 2 + action_length
+            if action_type == ACTION_TYPES["Key Combination"]:
+                action = "+".join(hid_names[code] for code in payload)
+            else:
+                action = payload.decode("ascii")
+            standard_buttons[f"button{i + 1}"] = {"type": action_names.get(action_type, "Print Text"),
+                                                  "action": action}
+        modes[mode_name] = {
+            "standard_buttons": standard_buttons,
+            "dropdown_buttons": {"dropdown_button1": encoder_function},
+        }
+    return modes
+
+
+def _read_exact(connection, size):
+    data = connection.read(size)
+    if len(data) != size:
+        raise TimeoutError("Устройство не ответило")
+    return data
+
+
+def open_connection(port=None):
+    """Serial-соединение с платой для обмена с прошивкой (раскладка, телеметрия); без port - найденная плата."""
+    import serial
+    from upload import find_pro_micro_port
+
+    port = port or find_pro_micro_port()
+    if port is None:
+        raise ConnectionError("Плата не найдена. Проверьте подключение.")
+    # Не 1200 бод: на этой скорости Pro Micro уходит в загрузчик
+    return serial.Serial(port, baudrate=BAUDRATE, timeout=1)
+
+
+def push_keymap(blob, port=None, connection=None):
+    """Записывает раскладку в EEPROM устройства. Возвращает 1 или текст ошибки."""
+    try:
+        connection = connection or open_connection(port)
+        try:
+            connection.reset_input_buffer()
+            connection.write(b"KW" + blob)
+            connection.flush()
+            reply = connection.readline().decode("ascii", errors="replace").strip()
+        finally:
+            connection.close()
+        if reply != "OK":
+            return reply or "Устройство не ответило"
+        return 1
+    except Exception as e:
+        return e
+
+
+def read_keymap(port=None, connection=None):
+    """Читает образ раскладки из EEPROM устройства."""
+    connection = connection or open_connection(port)
+    try:
+        connection.reset_input_buffer()
+        connection.write(b"KR")
+        connection.flush()
+        header = _read_exact(connection, 2)
+        if header != KEYMAP_MAGIC:
+            reply = (header + connection.readline()).decode("ascii", errors="replace").strip()
+            raise ValueError(reply)
+        header += _read_exact(connection, KEYMAP_HEADER.size - 2)
+        length = KEYMAP_HEADER.unpack(header)[2]
+        return header + _read_exact(connection, length - len(header))
+    finally:
+        connection.close()
+
+
+class SimulatedKeymapDevice:
+    """Эмуляция serial-протокола прошивки с EEPROM в памяти, для проверки без платы."""
+
+    def __init__(self, num_buttons=4):
+        self.num_buttons = num_buttons
+        self.eeprom = bytearray(b"\xff" * EEPROM_SIZE)
+        self._output = bytearray()
+
+    def reset_input_buffer(self):
+        self._output.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, data):
+        command, payload = bytes(data[:2]), bytes(data[2:])
+        if command == b"KW":
+            self._output += self._receive(payload) + b"\r\n"
+        elif command == b"KR":
+            if self.eeprom[:2] != KEYMAP_MAGIC:
+                self._output += b"ERR EMPTY\r\n"
+            else:
+                length = KEYMAP_HEADER.unpack_from(self.eeprom)[2]
+                self._output += self.eeprom[:length]
+        return len(data)
+
+    def _receive(self, blob):
+        if len(blob) < KEYMAP_HEADER.size:
+            return b"ERR TIMEOUT"
+        magic, version, length, _, num_buttons = KEYMAP_HEADER.unpack_from(blob)
+        if magic != KEYMAP_MAGIC or version != KEYMAP_VERSION:
+            return b"ERR FORMAT"
+        if length < KEYMAP_HEADER.size + 2 or length > EEPROM_SIZE:
+            return b"ERR SIZE"
+        if num_buttons != self.num_buttons:
+            return b"ERR LAYOUT"
+        if len(blob) < length:
+            return b"ERR TIMEOUT"
+        if struct.unpack_from("<H", blob, length - 2)[0] != _crc16(blob[2:length - 2]):
+            return b"ERR CRC"
+        self.eeprom[:length] = blob[:length]
+        return b"OK"
+
+    def read(self, size):
+        data, self._output = bytes(self._output[:size]), self._output[size:]
+        return data
+
+    def readline(self):
+        end = self._output.find(b"\n") + 1 or len(self._output)
+        return self.read(end)
+
+
+if __name__ == "__main__":
+    modes_path = sys.argv[1] if len(sys.argv) > 1 else "modes.json"
+    if os.path.isdir(modes_path):
+        from profile_store import load_profile
+        modes = load_profile(modes_path)
+    else:
+        with open(modes_path, "r", encoding="utf-8") as f:
+            modes = json.load(f)
+
+    start = time.perf_counter()
+    keymap_blob = serialize_modes(modes, 4, 1)
+    result = push_keymap(keymap_blob)
+    if result != 1:
+        print("Ошибка:", result)
+    else:
+        print(f"Раскладка ({len(keymap_blob)} байт) загружена за {time.perf_counter() - start:.2f} с")
@@ -0,0 +1,424 @@
+#include <Wire.h>
+#include <EEPROM.h>
+#include <Adafruit_GFX.h>
+#include <Adafruit_SSD1306.h>
+#include <HID-Project.h>
+
+#define SCREEN_WIDTH 128
+#define SCREEN_HEIGHT 32
+#define OLED_RESET -1
+const uint32_t I2C_CLOCK_HZ = 400000;
+Adafruit_SSD1306 display(SCREEN_WIDTH, SCREEN_HEIGHT, &Wire, OLED_RESET, I2C_CLOCK_HZ, I2C_CLOCK_HZ);
+
+const int ENCODER_S1_PIN = 5;
+const int ENCODER_S2_PIN = 6;
+const int ENCODER_KEY_PIN = 4;
+
+const uint8_t NUM_BUTTONS = 4;
+const uint8_t buttonPins[NUM_BUTTONS] = {7, 8, 9, 10};
+
+// Формат раскладки: 'K' 'M' version len_lo len_hi num_modes num_buttons, режимы, crc16
+const uint8_t KEYMAP_VERSION = 1;
+const uint8_t KEYMAP_HEADER_SIZE = 7;
+const uint8_t ACTION_KEYS = 1;
+const uint8_t ACTION_TEXT = 2;
+const unsigned long SERIAL_TIMEOUT = 500;
+
+uint8_t numModes = 0;
+uint8_t currentMode = 0;
+uint8_t encoderFunction = 0;
+bool lastButtonState[NUM_BUTTONS];
+unsigned long lastChangeTime[NUM_BUTTONS];
+const unsigned long buttonDebounce = 20;
+unsigned long lastDebounceTime = 0;
+const int debounceDelay = 250;
+
+const unsigned long KEY_PRESS_MS = 50;
+const uint8_t TYPE_CHUNK = 2;
+uint8_t pendingType = 0;
+uint16_t pendingOffset = 0;
+uint8_t pendingRemaining = 0;
+unsigned long pressedAt = 0;
+
+// Экран перерисуется из loop(), а не в обработчике кнопки
+const unsigned long FRAME_MS = 50;
+bool displayDirty = false;
+unsigned long lastFrameAt = 0;
+
+uint16_t crc16Update(uint16_t crc, uint8_t data) {
+    crc ^= (uint16_t)data << 8;
+    for (uint8_t i = 0; i < 8; ++i) {
+        crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+    return crc;
+}
+
+uint16_t keymapLength() {
+    return EEPROM.read(3) | ((uint16_t)EEPROM.read(4) << 8);
+}
+
+bool keymapValid() {
+    return EEPROM.read(0) == 'K' && EEPROM.read(1) == 'M' && EEPROM.read(2) == KEYMAP_VERSION
+        && EEPROM.read(6) == NUM_BUTTONS;
+}
+
+uint16_t buttonsOffset(uint16_t offset) {
+    // Пропускаем имя режима и функцию энкодера
+    return offset + 1 + EEPROM.read(offset) + 1;
+}
+
+uint16_t modeOffset(uint8_t mode) {
+    uint16_t offset = KEYMAP_HEADER_SIZE;
+    for (uint8_t m = 0; m < mode; ++m) {
+        offset = buttonsOffset(offset);
+        for (uint8_t b = 0; b < NUM_BUTTONS; ++b) {
+            offset += 2 + EEPROM.read(offset + 1);
+        }
+    }
+    return offset;
+}
+
+void selectMode(uint8_t mode) {
+    currentMode = mode;
+    if (numModes > 0) {
+        encoderFunction = EEPROM.read(buttonsOffset(modeOffset(mode)) - 1);
+    }
+}
+
+void loadKeymap() {
+    // Смещения незавершённого действия указывают в старую раскладку
+    if (pendingType != 0) {
+        Keyboard.releaseAll();
+        pendingType = 0;
+    }
+    numModes = keymapValid() ? EEPROM.read(5) : 0;
+    selectMode(0);
+}
+
+// Пока выполняется предыдущее действие, новые нажатия отбрасываются
+void executeButton(uint8_t button) {
+    if (numModes == 0 || pendingType != 0) {
+        return;
+    }
+    uint16_t offset = buttonsOffset(modeOffset(currentMode));
+    for (uint8_t b = 0; b < button; ++b) {
+        offset += 2 + EEPROM.read(offset + 1);
+    }
+    uint8_t type = EEPROM.read(offset);
+    uint8_t length = EEPROM.read(offset + 1);
+    offset += 2;
+    if (type == ACTION_KEYS) {
+        // Вся комбинация уходит одним отчётом
+        for (uint8_t i = 0; i < length; ++i) {
+            Keyboard.add(KeyboardKeycode(EEPROM.read(offset + i)));
+        }
+        Keyboard.send();
+        pendingType = ACTION_KEYS;
+        pressedAt = millis();
+    } else if (type == ACTION_TEXT) {
+        pendingType = ACTION_TEXT;
+        pendingOffset = offset;
+        pendingRemaining = length;
+    }
+}
+
+// Отпускает комбинацию по millis() и печатает текст порциями, не останавливая loop()
+void runAction(unsigned long now) {
+    if (pendingType == ACTION_KEYS && now - pressedAt >= KEY_PRESS_MS) {
+        Keyboard.releaseAll();
+        pendingType = 0;
+    } else if (pendingType == ACTION_TEXT) {
+        for (uint8_t i = 0; i < TYPE_CHUNK && pendingRemaining > 0; ++i, --pendingRemaining) {
+            Keyboard.write(EEPROM.read(pendingOffset++));
+        }
+        if (pendingRemaining == 0) {
+            pendingType = 0;
+        }
+    }
+}
+
+void setupDisplay() {
+    if(!display.begin(SSD1306_SWITCHCAPVCC, 0x3C)) {
+        for(;;);
+    }
+    display.clearDisplay();
+    display.setTextSize(2);
+    display.setTextColor(SSD1306_WHITE);
+    display.display();
+}
+
+void updateDisplay() {
+    display.clearDisplay();
+    display.setCursor(0, 0);
+    if (numModes == 0) {
+        display.println(F("No keymap"));
+    } else {
+        uint16_t offset = modeOffset(currentMode);
+        uint8_t nameLength = EEPROM.read(offset);
+        for (uint8_t i = 0; i < nameLength; ++i) {
+            display.write(EEPROM.read(offset + 1 + i));
+        }
+    }
+    display.display();
+}
+
+int readByte() {
+    unsigned long start = millis();
+    while (!Serial.available()) {
+        if (millis() - start > SERIAL_TIMEOUT) {
+            return -1;
+        }
+    }
+    return Serial.read();
+}
+
+void drainSerial() {
+    while (readByte() >= 0) {}
+}
+
+void receiveKeymap() {
+    uint8_t header[KEYMAP_HEADER_SIZE];
+    for (uint8_t i = 0; i < KEYMAP_HEADER_SIZE; ++i) {
+        int c = readByte();
+        if (c < 0) {
+            Serial.println(F("ERR TIMEOUT"));
+            return;
+        }
+        header[i] = c;
+    }
+    uint16_t length = header[3] | ((uint16_t)header[4] << 8);
+    if (header[0] != 'K' || header[1] != 'M' || header[2] != KEYMAP_VERSION) {
+        drainSerial();
+        Serial.println(F("ERR FORMAT"));
+        return;
+    }
+    if (length < KEYMAP_HEADER_SIZE + 2 || length > EEPROM.length()) {
+        drainSerial();
+        Serial.println(F("ERR SIZE"));
+        return;
+    }
+    if (header[6] != NUM_BUTTONS) {
+        drainSerial();
+        Serial.println(F("ERR LAYOUT"));
+        return;
+    }
+
+    // Сигнатура пишется последней: оборванная загрузка не оставит битую раскладку
+    EEPROM.update(0, 0xFF);
+    uint16_t crc = 0xFFFF;
+    for (uint8_t i = 2; i < KEYMAP_HEADER_SIZE; ++i) {
+        crc = crc16Update(crc, header[i]);
+        EEPROM.update(i, header[i]);
+    }
+    for (uint16_t i = KEYMAP_HEADER_SIZE; i < length - 2; ++i) {
+        int c = readByte();
+        if (c < 0) {
+            Serial.println(F("ERR TIMEOUT"));
+            loadKeymap();
+            return;
+        }
+        crc = crc16Update(crc, c);
+        EEPROM.update(i, c);
+    }
+    int crcLow = readByte();
+    int crcHigh = readByte();
+    if (crcLow < 0 || crcHigh < 0 || (uint16_t)(crcLow | (crcHigh << 8)) != crc) {
+        Serial.println(F("ERR CRC"));
+        loadKeymap();
+        return;
+    }
+    EEPROM.update(length - 2, crcLow);
+    EEPROM.update(length - 1, crcHigh);
+    EEPROM.update(1, 'M');
+    EEPROM.update(0, 'K');
+
+    loadKeymap();
+    updateDisplay();
+    Serial.println(F("OK"));
+}
+
+void sendKeymap() {
+    if (!keymapValid()) {
+        Serial.println(F("ERR EMPTY"));
+        return;
+    }
+    uint16_t length = keymapLength();
+    for (uint16_t i = 0; i < length; ++i) {
+        Serial.write(EEPROM.read(i));
+    }
+}
+
+void handleSerial() {
+    if (Serial.available() < 2) {
+        return;
+    }
+    if (Serial.read() != 'K') {
+        return;
+    }
+    int command = Serial.read();
+    if (command == 'W') {
+        receiveKeymap();
+    } else if (command == 'R') {
+        sendKeymap();
+    }
+}
+
+
+enum EncoderFunction : uint8_t { ENCODER_NOTHING, ENCODER_VOLUME, ENCODER_SCROLL, ENCODER_BRIGHTNESS, ENCODER_SEEK };
+
+const uint16_t ENCODER_SAMPLE_HZ = 2000;
+const int16_t ENCODER_STEPS_PER_DETENT = 4;
+const unsigned long ENCODER_ACCEL_MS = 40;
+const uint8_t ENCODER_ACCEL_MAX = 4;
+
+// Изменение позиции по индексу (прежнее состояние S1 S2) | (новое << 2), как в библиотеке Encoder;
+// +-2 - переход, между отсчётами которого сигнал сменился дважды
+const int8_t QUADRATURE_DELTA[16] PROGMEM = {0, 1, -1, 2, -1, 0, -2, 1, 1, -2, 0, -1, 2, -1, 1, 0};
+
+volatile int16_t encoderTransitions = 0;
+uint8_t encoderPinState = 0;
+int16_t pendingEncoderSteps = 0;
+int16_t encoderLevel = 0;
+uint8_t encoderFunctionInUse = ENCODER_NOTHING;
+uint8_t encoderAcceleration = 1;
+unsigned long lastDetentAt = 0;
+
+uint8_t readEncoderPins() {
+    return ((PINC >> 6) & 1) | (((PIND >> 7) & 1) << 1);
+}
+
+ISR(TIMER3_COMPA_vect) {
+    uint8_t state = readEncoderPins();
+    encoderTransitions += (int8_t)pgm_read_byte(&QUADRATURE_DELTA[encoderPinState | (state << 2)]);
+    encoderPinState = state;
+}
+
+void setupEncoder() {
+    pinMode(ENCODER_S1_PIN, INPUT_PULLUP);
+    pinMode(ENCODER_S2_PIN, INPUT_PULLUP);
+    encoderPinState = readEncoderPins();
+    // Таймер 3: режим CTC, делитель 64
+    noInterrupts();
+    TCCR3A = 0;
+    TCCR3B = _BV(WGM32) | _BV(CS31) | _BV(CS30);
+    OCR3A = F_CPU / 64 / ENCODER_SAMPLE_HZ - 1;
+    TIMSK3 = _BV(OCIE3A);
+    interrupts();
+}
+
+// Забирает целые щелчки, накопленные прерыванием; неполный щелчок остаётся до следующего прохода
+int16_t takeEncoderDetents() {
+    noInterrupts();
+    int16_t detents = encoderTransitions / ENCODER_STEPS_PER_DETENT;
+    encoderTransitions -= detents * ENCODER_STEPS_PER_DETENT;
+    interrupts();
+    return detents;
+}
+
+void sendEncoderSteps() {
+    int16_t sent = pendingEncoderSteps > 0 ? 1 : -1;
+    switch (encoderFunctionInUse) {
+        case ENCODER_VOLUME:
+            Consumer.write(sent > 0 ? MEDIA_VOLUME_UP : MEDIA_VOLUME_DOWN);
+            break;
+        case ENCODER_SCROLL:
+            // По часовой стрелке страница прокручивается вниз
+            sent = constrain(pendingEncoderSteps, -127, 127);
+            Mouse.move(0, 0, -sent);
+            break;
+        case ENCODER_BRIGHTNESS:
+            Consumer.write(sent > 0 ? CONSUMER_BRIGHTNESS_UP : CONSUMER_BRIGHTNESS_DOWN);
+            break;
+        case ENCODER_SEEK:
+            Consumer.write(sent > 0 ? MEDIA_FAST_FORWARD : MEDIA_REWIND);
+            break;
+        default:
+            pendingEncoderSteps = 0;
+            return;
+    }
+    pendingEncoderSteps -= sent;
+    encoderLevel += sent;
+}
+
+void handleEncoderRotation(unsigned long now) {
+    uint8_t function = encoderFunction;
+    if (function != encoderFunctionInUse) {
+        // Шаги, накопленные для прежней функции, новой не передаются
+        encoderFunctionInUse = function;
+        pendingEncoderSteps = 0;
+        encoderLevel = 0;
+    }
+    int16_t detents = takeEncoderDetents();
+    if (detents != 0) {
+        // Смена направления отменяет ещё не отправленный хвост ускоренных шагов
+        if ((detents > 0) != (pendingEncoderSteps > 0)) {
+            pendingEncoderSteps = 0;
+        }
+        if (now - lastDetentAt < ENCODER_ACCEL_MS) {
+            if (encoderAcceleration < ENCODER_ACCEL_MAX) {
+                ++encoderAcceleration;
+            }
+        } else {
+            encoderAcceleration = 1;
+        }
+        lastDetentAt = now;
+        pendingEncoderSteps += detents * encoderAcceleration;
+    }
+    if (pendingEncoderSteps != 0) {
+        sendEncoderSteps();
+    }
+}
+
+void handleEncoderButton() {
+    if (digitalRead(ENCODER_KEY_PIN) == LOW) {
+        if ((millis() - lastDebounceTime) > debounceDelay && numModes > 0) {
+            selectMode((currentMode + 1) % numModes);
+            displayDirty = true;
+            lastDebounceTime = millis();
+        }
+    }
+}
+
+void handleButtons() {
+    unsigned long now = millis();
+    for (uint8_t b = 0; b < NUM_BUTTONS; ++b) {
+        bool pressed = digitalRead(buttonPins[b]) == LOW;
+        if (pressed != lastButtonState[b] && now - lastChangeTime[b] > buttonDebounce) {
+            lastButtonState[b] = pressed;
+            lastChangeTime[b] = now;
+            if (pressed) {
+                executeButton(b);
+            }
+        }
+    }
+}
+
+void setup() {
+    Serial.begin(115200);
+    pinMode(ENCODER_KEY_PIN, INPUT_PULLUP);
+    for (uint8_t b = 0; b < NUM_BUTTONS; ++b) {
+        pinMode(buttonPins[b], INPUT_PULLUP);
+    }
+
+    setupEncoder();
+
+    Keyboard.begin();
+    Consumer.begin();
+    Mouse.begin();
+    setupDisplay();
+    loadKeymap();
+    updateDisplay();
+}
+
+void loop() {
+    handleSerial();
+    handleEncoderRotation(millis());
+    handleEncoderButton();
+    handleButtons();
+    runAction(millis());
+    if (displayDirty && millis() - lastFrameAt >= FRAME_MS) {
+        updateDisplay();
+        displayDirty = false;
+        lastFrameAt = millis();
+    }
+}
\ No newline at end of file
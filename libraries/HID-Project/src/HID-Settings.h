@@ -73,6 +73,12 @@ THE SOFTWARE.
 #define HID_REPORTID_SURFACEDIAL 10
 #endif
 
+// Polling interval (bInterval, ms) of the keyboard endpoints with their own interface
+// (BootKeyboard, SingleNKROKeyboard). Set with -DHID_POLL_INTERVAL=n.
+#ifndef HID_POLL_INTERVAL
+#define HID_POLL_INTERVAL 1
+#endif
+
 #if defined(ARDUINO_ARCH_AVR)
 
 // Use default alignment for AVR
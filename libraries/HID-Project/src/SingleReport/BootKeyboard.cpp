@@ -83,7 +83,7 @@ int BootKeyboard_::getInterface(uint8_t* interfaceCount)
 	HIDDescriptor hidInterface = {
 		D_INTERFACE(pluggedInterface, 1, USB_DEVICE_CLASS_HUMAN_INTERFACE, HID_SUBCLASS_BOOT_INTERFACE, HID_PROTOCOL_KEYBOARD),
 		D_HIDREPORT(sizeof(_hidReportDescriptorKeyboard)),
-		D_ENDPOINT(USB_ENDPOINT_IN(pluggedEndpoint), USB_ENDPOINT_TYPE_INTERRUPT, USB_EP_SIZE, 0x01)
+		D_ENDPOINT(USB_ENDPOINT_IN(pluggedEndpoint), USB_ENDPOINT_TYPE_INTERRUPT, USB_EP_SIZE, HID_POLL_INTERVAL)
 	};
 	return USB_SendControl(0, &hidInterface, sizeof(hidInterface));
 }
@@ -1,16 +1,48 @@
+import copy
 import json
+import os
 import sys
+from collections import deque
+from functools import partial
+from itertools import count
 
 from PyQt5.QtGui import QRegularExpressionValidator
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QLabel,
-    QLineEdit, QPushButton, QComboBox, QGridLayout, QMessageBox, QStackedWidget, QHBoxLayout, QInputDialog
+    QLineEdit, QPushButton, QComboBox, QGridLayout, QMessageBox, QStackedWidget, QHBoxLayout, QInputDialog,
+    QSpinBox, QCheckBox, QScrollArea, QProgressBar, QPlainTextEdit, QFileDialog
 )
-from PyQt5.QtCore import Qt, QRegularExpression
+from PyQt5.QtCore import Qt, QRegularExpression, QObject, QThread, pyqtSignal, QAbstractListModel, QModelIndex
 import qdarkstyle
 
-from generate import generate_ino_file
-from upload import upload_ino_file
+from arduino_daemon import DaemonBackend, daemon_available
+from firmware_cache import config_key
+from generate import (
+    generate_ino_file, generate_keymap_firmware, default_matrix, firmware_build_properties, MATRIX_ROW_PINS,
+    MATRIX_COLUMN_PINS, MAX_WAIT_MS, POLL_INTERVAL_MS, ENCODER_FUNCTIONS, TAP_HOLD_MS, TAP_HOLD_PERMISSIVE,
+    TELEMETRY_FLAG, TYPING_PROFILE, validate_sketch_config
+)
+from keymap import push_keymap, serialize_modes
+from pipeline import ARDUINO_CLI_PATH, BuildPipeline, STAGES
+from profile_store import DEFAULT_PROFILE, ProfileStore
+from telemetry import TelemetryCollector, format_telemetry
+from tracing import save_chrome_trace
+
+DIRECT_BUTTONS = 4
+# Подписи выбора клавиатуры HID-Project и соответствующие значения generate.HID_KEYBOARDS
+KEYBOARD_OPTIONS = {"Keyboard": "keyboard", "Boot (6KRO)": "boot", "NKRO": "nkro"}
+# Подписи профилей печати текста generate.TYPING_PROFILES
+TYPING_OPTIONS = {"Safe": "safe", "Standard": "standard", "Fast": "fast"}
+# Файл режимов прежних версий: при первом запуске переносится в профиль default
+MODES_PATH = "modes.json"
+EMPTY_BUTTON = {"type": "Print Text", "action": ""}
+ACTION_TYPES = ["Print Text", "Key Combination", "Macro", "Host Action", "Momentary Layer", "Toggle Layer"]
+NO_HOLD = "None"
+# Синтаксис Host Action, см. generate.parse_host_action
+HOST_ACTION_HINT = ("paste <text> | paste-file <path> | run <command> | open <url>, "
+                    "optionally || <macro> when host_bridge.py is not running")
+LAYER_HINT = "Name of the mode used as a layer; its empty buttons keep the actions of the current mode"
+ACTION_HINTS = {"Host Action": HOST_ACTION_HINT, "Momentary Layer": LAYER_HINT, "Toggle Layer": LAYER_HINT}
 
 
 class KeyCaptureLineEdit(QLineEdit):
@@ -78,6 +110,105 @@ class KeyCaptureLineEdit(QLineEdit):
             super().keyReleaseEvent(event)
 
 
+class BuildWorker(QObject):
+    """Выполняет BuildPipeline в отдельном потоке и передаёт прогресс сигналами."""
+    stage_changed = pyqtSignal(str)
+    output = pyqtSignal(str)
+    finished = pyqtSignal(object)
+
+    def __init__(self, job, backend=None):
+        super().__init__()
+        self.job = job
+        self.pipeline = BuildPipeline(on_stage=self.stage_changed.emit, on_output=self.output.emit, backend=backend)
+
+    def run(self):
+        self.finished.emit(self.pipeline.run(**self.job["args"]))
+
+    def cancel(self):
+        self.pipeline.cancel()
+
+
+class SerialWorker(QObject):
+    """Выполняет обмен с платой по serial в отдельном потоке: запись EEPROM и ответ телеметрии ждут секунды."""
+    finished = pyqtSignal(object, object)
+
+    def __init__(self, function):
+        super().__init__()
+        self.function = function
+
+    def run(self):
+        """Передаёт (результат, None) или (None, исключение)."""
+        try:
+            result = self.function()
+        except Exception as e:
+            self.finished.emit(None, e)
+        else:
+            self.finished.emit(result, None)
+
+
+class ModeListModel(QAbstractListModel):
+    """
+    Режимы открытого профиля для mode_selector. Строки читаются из индекса профиля, данные режимов
+    не загружаются; режимы с несохранёнными изменениями помечены '*'.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.profile = None
+
+    def set_profile(self, profile):
+        self.beginResetModel()
+        self.profile = profile
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if self.profile is None or parent.isValid() else len(self.profile.names)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        name = self.profile.names[index.row()]
+        if role == Qt.DisplayRole:
+            return f"{name} *" if self.profile.is_mode_dirty(name) else name
+        if role == Qt.UserRole:
+            return name
+        return None
+
+    def mode_name(self, row):
+        if self.profile is None or not 0 <= row < len(self.profile.names):
+            return None
+        return self.profile.names[row]
+
+    def add_mode(self, name, mode_data):
+        row = len(self.profile.names)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.profile.add_mode(name, mode_data)
+        self.endInsertRows()
+        return row
+
+    def remove_mode(self, row):
+        self.beginRemoveRows(QModelIndex(), row, row)
+        self.profile.remove_mode(self.profile.names[row])
+        self.endRemoveRows()
+
+    def rename_mode(self, row, new_name):
+        # Ссылки слоёв на режим могли измениться и в других строках
+        self.profile.rename_mode(self.profile.names[row], new_name)
+        self.refresh()
+
+    def set_mode(self, row, mode_data):
+        if self.profile.set_mode(self.profile.names[row], mode_data):
+            self.refresh(row)
+
+    def refresh(self, row=None):
+        """Перерисовывает строку row или все строки, например после сохранения, снявшего пометки."""
+        if self.rowCount() == 0:
+            return
+        first = self.index(0 if row is None else row)
+        last = self.index(self.rowCount() - 1 if row is None else row)
+        self.dataChanged.emit(first, last, [Qt.DisplayRole])
+
+
 class ArduinoCodeGenerator(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -85,10 +216,30 @@ class ArduinoCodeGenerator(QMainWindow):
         self.setWindowTitle("Arduino Code Generator")
         self.setGeometry(100, 100, 1000, 700)
 
-        self.num_standard_buttons = 4
+        self.num_standard_buttons = DIRECT_BUTTONS
         self.num_dropdown_buttons = 1
-
-        self.modes = {}
+        self.matrix = None
+
+        # Режимы хранятся в профилях: открытие читает только индекс, сохранение пишет только изменённые режимы
+        self.profile_store = ProfileStore()
+        self.mode_model = ModeListModel(self)
+        self.current_mode = None
+        self.standard_button_widgets = []
+        self.hold_widgets = []
+        self.dropdown_selectors = []
+
+        # Очередь сборок: пока одна плата прошивается, следующие ждут, интерфейс не блокируется
+        self.build_queue = deque()
+        self.build_thread = None
+        self.build_worker = None
+        self.last_trace = None
+        # Обмен с платой по serial (Push Config) идёт в своём потоке, по одному за раз
+        self.serial_thread = None
+        self.serial_worker = None
+        # Один arduino-cli daemon на всё время работы приложения, если установлены grpcio и модули протокола
+        self.cli_backend = None
+        if daemon_available() and os.path.exists(ARDUINO_CLI_PATH):
+            self.cli_backend = DaemonBackend(ARDUINO_CLI_PATH)
 
         self.setup_ui()
 
@@ -99,8 +250,19 @@ class ArduinoCodeGenerator(QMainWindow):
         main_layout = QVBoxLayout()
         central_widget.setLayout(main_layout)
 
+        # Селектор профилей
+        profile_layout = QHBoxLayout()
+        self.profile_selector = QComboBox()
+        new_profile_button = QPushButton("New Profile")
+        new_profile_button.clicked.connect(self.new_profile)
+        profile_layout.addWidget(QLabel("Profile:"))
+        profile_layout.addWidget(self.profile_selector, 1)
+        profile_layout.addWidget(new_profile_button)
+        main_layout.addLayout(profile_layout)
+
         # Селектор режимов
         self.mode_selector = QComboBox()
+        self.mode_selector.setModel(self.mode_model)
         self.mode_selector.currentIndexChanged.connect(self.update_mode)
         main_layout.addWidget(QLabel("Select Mode:"))
         main_layout.addWidget(self.mode_selector)
@@ -116,14 +278,65 @@ class ArduinoCodeGenerator(QMainWindow):
         mode_control_layout.addWidget(add_mode_button)
         mode_control_layout.addWidget(remove_mode_button)
         mode_control_layout.addWidget(rename_mode_button)
+        self.layer_only_checkbox = QCheckBox("Layer Only")
+        self.layer_only_checkbox.setToolTip("Skip this mode when switching with the encoder key: "
+                                            "reach it through Momentary Layer or Toggle Layer buttons")
+        mode_control_layout.addWidget(self.layer_only_checkbox)
         main_layout.addLayout(mode_control_layout)
 
+        # Раскладка кнопок: отдельный вывод на кнопку или матрица строк и столбцов
+        layout_control_layout = QHBoxLayout()
+        self.layout_selector = QComboBox()
+        self.layout_selector.addItems(["Direct Pins", "Matrix"])
+        self.matrix_rows = QSpinBox()
+        self.matrix_rows.setRange(1, len(MATRIX_ROW_PINS))
+        self.matrix_rows.setValue(len(MATRIX_ROW_PINS))
+        self.matrix_cols = QSpinBox()
+        self.matrix_cols.setRange(1, len(MATRIX_COLUMN_PINS))
+        self.matrix_cols.setValue(len(MATRIX_COLUMN_PINS))
+        self.matrix_diodes = QCheckBox("Diodes")
+        self.matrix_diodes.setChecked(True)
+        layout_control_layout.addWidget(QLabel("Button Layout:"))
+        layout_control_layout.addWidget(self.layout_selector)
+        layout_control_layout.addWidget(QLabel("Rows:"))
+        layout_control_layout.addWidget(self.matrix_rows)
+        layout_control_layout.addWidget(QLabel("Columns:"))
+        layout_control_layout.addWidget(self.matrix_cols)
+        layout_control_layout.addWidget(self.matrix_diodes)
+        main_layout.addLayout(layout_control_layout)
+
+        # USB-клавиатура: тип отчёта и период опроса хостом
+        hid_control_layout = QHBoxLayout()
+        self.keyboard_selector = QComboBox()
+        self.keyboard_selector.addItems(list(KEYBOARD_OPTIONS))
+        self.poll_interval = QSpinBox()
+        self.poll_interval.setRange(1, 255)
+        self.poll_interval.setValue(POLL_INTERVAL_MS)
+        self.poll_interval.setSuffix(" ms")
+        hid_control_layout.addWidget(QLabel("USB Keyboard:"))
+        hid_control_layout.addWidget(self.keyboard_selector)
+        hid_control_layout.addWidget(QLabel("Poll Interval:"))
+        hid_control_layout.addWidget(self.poll_interval)
+        self.typing_selector = QComboBox()
+        self.typing_selector.addItems(list(TYPING_OPTIONS))
+        self.typing_selector.setToolTip("Safe: slow hosts and remote desktops; Fast: fewer reports per character")
+        hid_control_layout.addWidget(QLabel("Typing:"))
+        hid_control_layout.addWidget(self.typing_selector)
+        self.telemetry_checkbox = QCheckBox("Telemetry")
+        self.telemetry_checkbox.setToolTip("Build with counters readable by Read Telemetry")
+        hid_control_layout.addWidget(self.telemetry_checkbox)
+        hid_control_layout.addStretch()
+        main_layout.addLayout(hid_control_layout)
+        self.keyboard_selector.currentIndexChanged.connect(self.update_poll_interval_state)
+
         self.standard_buttons_layout = QGridLayout()
+        standard_buttons_widget = QWidget()
+        standard_buttons_widget.setLayout(self.standard_buttons_layout)
+        standard_buttons_scroll = QScrollArea()
+        standard_buttons_scroll.setWidgetResizable(True)
+        standard_buttons_scroll.setWidget(standard_buttons_widget)
         main_layout.addWidget(QLabel("Standard Buttons:"))
-        main_layout.addLayout(self.standard_buttons_layout)
-
-        for i in range(self.num_standard_buttons):
-            self.create_standard_button_ui(f"Button {i + 1}", i)
+        main_layout.addWidget(standard_buttons_scroll)
 
         self.dropdown_buttons_layout = QGridLayout()
         main_layout.addWidget(QLabel("Dropdown Buttons:"))
@@ -140,31 +353,164 @@ class ArduinoCodeGenerator(QMainWindow):
         self.generate_button.clicked.connect(self.on_upload_code_clicked)
         main_layout.addWidget(self.generate_button)
 
-        try:
-            with open("modes.json", "r+") as f:
-                try:
-                    self.modes = json.load(f)
-                    self.update_mode_selector()
-                except json.JSONDecodeError:
-                    self.modes = {}
-                    self.add_mode()
-        except FileNotFoundError:
-            self.modes = {}
+        keymap_layout = QHBoxLayout()
+        self.keymap_firmware_button = QPushButton("Upload Keymap Firmware")
+        self.keymap_firmware_button.clicked.connect(self.on_upload_keymap_firmware_clicked)
+        self.push_config_button = QPushButton("Push Config")
+        self.push_config_button.clicked.connect(self.on_push_config_clicked)
+        keymap_layout.addWidget(self.keymap_firmware_button)
+        keymap_layout.addWidget(self.push_config_button)
+        self.telemetry_collector = TelemetryCollector()
+        self.read_telemetry_button = QPushButton("Read Telemetry")
+        self.read_telemetry_button.clicked.connect(self.on_read_telemetry_clicked)
+        keymap_layout.addWidget(self.read_telemetry_button)
+        main_layout.addLayout(keymap_layout)
+
+        build_status_layout = QHBoxLayout()
+        self.build_status = QLabel("Idle")
+        self.build_progress = QProgressBar()
+        self.build_progress.setRange(0, len(STAGES))
+        self.build_progress.setValue(0)
+        self.cancel_build_button = QPushButton("Cancel")
+        self.cancel_build_button.setEnabled(False)
+        self.cancel_build_button.clicked.connect(self.cancel_build)
+        # Трасса Chrome последней сборки: время стадий и шагов внутри них
+        self.export_trace_button = QPushButton("Export Trace")
+        self.export_trace_button.setEnabled(False)
+        self.export_trace_button.clicked.connect(self.export_last_trace)
+        build_status_layout.addWidget(self.build_status)
+        build_status_layout.addWidget(self.build_progress)
+        build_status_layout.addWidget(self.cancel_build_button)
+        build_status_layout.addWidget(self.export_trace_button)
+        main_layout.addLayout(build_status_layout)
+
+        self.build_log = QPlainTextEdit()
+        self.build_log.setReadOnly(True)
+        self.build_log.setMaximumBlockCount(2000)
+        main_layout.addWidget(self.build_log)
+
+        self.load_settings()
+        self.layout_selector.currentIndexChanged.connect(self.update_button_layout)
+        self.matrix_rows.valueChanged.connect(self.update_button_layout)
+        self.matrix_cols.valueChanged.connect(self.update_button_layout)
+        self.matrix_diodes.stateChanged.connect(self.update_button_layout)
+        self.update_button_layout()
+        self.load_profiles()
+
+    def load_profiles(self):
+        """Открывает профиль прошлого запуска; при первом запуске переносит modes.json в профиль default."""
+        names = self.profile_store.profile_names()
+        if not names:
+            try:
+                with open(MODES_PATH, "r", encoding="utf-8") as f:
+                    modes = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                modes = None
+            self.profile_store.create(DEFAULT_PROFILE, modes if isinstance(modes, dict) else None)
+            names = [DEFAULT_PROFILE]
+        active = self.profile_store.active
+        self.profile_selector.addItems(names)
+        self.profile_selector.setCurrentText(active if active in names else names[0])
+        self.profile_selector.currentTextChanged.connect(self.open_profile)
+        self.open_profile(self.profile_selector.currentText())
+
+    def open_profile(self, name):
+        """Показывает профиль name; несохранённые правки прежнего профиля остаются в памяти до Save Changes."""
+        self.commit_current_mode()
+        self.current_mode = None
+        profile = self.profile_store.open(name)
+        self.mode_model.set_profile(profile)
+        self.profile_store.active = name
+        if len(profile) == 0:
             self.add_mode()
-
-    def update_mode_selector(self):
-        """Обновляет QComboBox mode_selector на основе данных self.modes."""
-        self.mode_selector.clear()
-        for mode_name in self.modes.keys():
-            self.mode_selector.addItem(mode_name)
-        if self.mode_selector.count() > 0:
+        else:
             self.mode_selector.setCurrentIndex(0)
-            self.update_mode()
+            self.show_mode()
+
+    def new_profile(self):
+        """Создаёт пустой профиль с одним режимом и переключается на него."""
+        name, accepted = QInputDialog.getText(self, "New Profile", "Profile name:")
+        if not accepted:
+            return
+        try:
+            self.profile_store.create(name.strip())
+        except ValueError as e:
+            QMessageBox.warning(self, "Error", str(e))
+            return
+        self.profile_selector.addItem(name.strip())
+        self.profile_selector.setCurrentText(name.strip())
+
+    def load_settings(self):
+        """Загружает настройки раскладки кнопок и USB-клавиатуры из settings.json."""
+        try:
+            with open("settings.json", "r") as f:
+                settings = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            settings = {}
+        matrix = settings.get("matrix")
+        if matrix:
+            self.layout_selector.setCurrentIndex(1)
+            self.matrix_rows.setValue(len(matrix["rows"]))
+            self.matrix_cols.setValue(len(matrix["cols"]))
+            self.matrix_diodes.setChecked(matrix.get("diodes", True))
+        keyboard = settings.get("keyboard", "keyboard")
+        for label, value in KEYBOARD_OPTIONS.items():
+            if value == keyboard:
+                self.keyboard_selector.setCurrentText(label)
+        self.poll_interval.setValue(settings.get("poll_interval_ms", POLL_INTERVAL_MS))
+        self.update_poll_interval_state()
+        typing = settings.get("typing", TYPING_PROFILE)
+        for label, value in TYPING_OPTIONS.items():
+            if value == typing:
+                self.typing_selector.setCurrentText(label)
+        self.telemetry_checkbox.setChecked(settings.get("telemetry", False))
+
+    def update_poll_interval_state(self):
+        """Период опроса задаётся только для клавиатур с собственной конечной точкой."""
+        self.poll_interval.setEnabled(self.selected_keyboard() != "keyboard")
+
+    def selected_keyboard(self):
+        return KEYBOARD_OPTIONS[self.keyboard_selector.currentText()]
+
+    def firmware_settings(self):
+        """Настройки прошивки помимо режимов: раскладка кнопок, USB-клавиатура, печать текста и телеметрия."""
+        return {"matrix": self.matrix, "keyboard": self.selected_keyboard(),
+                "poll_interval_ms": self.poll_interval.value(),
+                "typing": TYPING_OPTIONS[self.typing_selector.currentText()],
+                "telemetry": self.telemetry_checkbox.isChecked()}
+
+    def update_button_layout(self):
+        """Пересоздаёт поля кнопок под выбранную раскладку."""
+        self.commit_current_mode()
+        is_matrix = self.layout_selector.currentIndex() == 1
+        for widget in (self.matrix_rows, self.matrix_cols, self.matrix_diodes):
+            widget.setEnabled(is_matrix)
+        if is_matrix:
+            self.matrix = default_matrix(self.matrix_rows.value(), self.matrix_cols.value(),
+                                         self.matrix_diodes.isChecked())
+            self.num_standard_buttons = len(self.matrix["rows"]) * len(self.matrix["cols"])
+        else:
+            self.matrix = None
+            self.num_standard_buttons = DIRECT_BUTTONS
+
+        while self.standard_buttons_layout.count():
+            item = self.standard_buttons_layout.takeAt(0)
+            if item.widget():
+                item.widget().deleteLater()
+        self.standard_button_widgets = []
+        self.hold_widgets = []
+        for i in range(self.num_standard_buttons):
+            label = f"Button {i + 1}"
+            if self.matrix:
+                row, col = divmod(i, len(self.matrix["cols"]))
+                label += f" (R{row + 1}C{col + 1})"
+            self.create_standard_button_ui(label, i)
+        self.show_mode()
 
     def create_standard_button_ui(self, label, index):
         """Создаёт интерфейс для настройки кнопок."""
         action_type = QComboBox()
-        action_type.addItems(["Print Text", "Key Combination"])
+        action_type.addItems(ACTION_TYPES)
         action_type.currentIndexChanged.connect(self.update_input_type)
 
         stacked_input = QStackedWidget()
@@ -181,43 +527,65 @@ class ArduinoCodeGenerator(QMainWindow):
         self.standard_buttons_layout.addWidget(stacked_input, index, 2)
         self.standard_buttons_layout.addWidget(clear_button, index, 3)
 
-        setattr(self, f"standard_button{index + 1}_action_type", action_type)
-        setattr(self, f"standard_button{index + 1}_stacked_input", stacked_input)
+        # Действие при удержании дольше времени решения; без него кнопка срабатывает сразу по нажатию
+        hold_type = QComboBox()
+        hold_type.addItems([NO_HOLD] + ACTION_TYPES)
+        hold_type.currentIndexChanged.connect(self.update_input_type)
+        hold_input = QLineEdit()
+        hold_timeout = QSpinBox()
+        hold_timeout.setRange(1, MAX_WAIT_MS)
+        hold_timeout.setValue(TAP_HOLD_MS)
+        hold_timeout.setSuffix(" ms")
+        hold_timeout.setToolTip("Held longer than this: hold action, released earlier: tap action")
+        hold_permissive = QCheckBox("Permissive")
+        hold_permissive.setChecked(TAP_HOLD_PERMISSIVE)
+        hold_permissive.setToolTip("Choose hold as soon as another button is pressed and released")
+        self.standard_buttons_layout.addWidget(QLabel("Hold:"), index, 4)
+        self.standard_buttons_layout.addWidget(hold_type, index, 5)
+        self.standard_buttons_layout.addWidget(hold_input, index, 6)
+        self.standard_buttons_layout.addWidget(hold_timeout, index, 7)
+        self.standard_buttons_layout.addWidget(hold_permissive, index, 8)
+
+        self.standard_button_widgets.append((action_type, stacked_input))
+        self.hold_widgets.append((hold_type, hold_input, hold_timeout, hold_permissive))
+        for widget in (hold_input, hold_timeout, hold_permissive):
+            widget.setEnabled(False)
 
     def create_dropdown_button_ui(self, label, index):
         """Создаёт интерфейс для кнопок с выпадающими списками."""
         dropdown_selector = QComboBox()
-        dropdown_selector.addItems(["Nothing", "Volume"])
+        dropdown_selector.addItems(list(ENCODER_FUNCTIONS))
 
         self.dropdown_buttons_layout.addWidget(QLabel(f"{label}:"), index, 0)
         self.dropdown_buttons_layout.addWidget(dropdown_selector, index, 1)
 
-        setattr(self, f"dropdown_button{index + 1}_selector", dropdown_selector)
+        self.dropdown_selectors.append(dropdown_selector)
 
     def add_mode(self):
         """Добавление нового режима."""
-        new_mode_name = f"Mode {len(self.modes) + 1}"
-        self.modes[new_mode_name] = {
+        profile = self.mode_model.profile
+        new_mode_name = next(name for name in (f"Mode {n}" for n in count(len(profile) + 1)) if name not in profile)
+        row = self.mode_model.add_mode(new_mode_name, {
             "standard_buttons": {
-                f"button{i + 1}": {"type": "Print Text", "action": ""} for i in range(self.num_standard_buttons)
+                f"button{i + 1}": dict(EMPTY_BUTTON) for i in range(self.num_standard_buttons)
             },
             "dropdown_buttons": {
                 f"dropdown_button{i + 1}": "Nothing" for i in range(self.num_dropdown_buttons)
             }
-        }
-        self.mode_selector.addItem(new_mode_name)
-        self.mode_selector.setCurrentIndex(self.mode_selector.count() - 1)
+        })
+        self.mode_selector.setCurrentIndex(row)
 
     def remove_mode(self):
         """Удаление текущего режима."""
-        current_mode = self.mode_selector.currentText()
-        if current_mode and len(self.modes) > 1:
-            del self.modes[current_mode]
-            self.mode_selector.removeItem(self.mode_selector.currentIndex())
+        row = self.mode_selector.currentIndex()
+        if row >= 0 and len(self.mode_model.profile) > 1:
+            self.current_mode = None
+            self.mode_model.remove_mode(row)
+            self.show_mode()
 
     def rename_mode(self):
         """Переименовывает текущий режим с ограничением на ввод."""
-        current_mode = self.mode_selector.currentText()
+        current_mode = self.current_mode
         if current_mode:
             regex = QRegularExpression("^[a-zA-Z][a-zA-Z0-9]*$")
             validator = QRegularExpressionValidator(regex)
@@ -231,36 +599,79 @@ class ArduinoCodeGenerator(QMainWindow):
 
             if input_dialog.exec_() == QInputDialog.Accepted:
                 new_name = input_dialog.textValue().strip()
-                if new_name and new_name not in self.modes:
-                    self.modes[new_name] = self.modes.pop(current_mode)
-                    index = self.mode_selector.currentIndex()
-                    self.mode_selector.setItemText(index, new_name)
+                if new_name and new_name not in self.mode_model.profile:
+                    # Правки в полях - в профиль до переименования, чтобы их ссылки на режим тоже обновились
+                    self.commit_current_mode()
+                    self.mode_model.rename_mode(self.mode_selector.currentIndex(), new_name)
+                    self.show_mode()
                 else:
                     QMessageBox.warning(self, "Error", "Name is invalid or already exists.")
 
     def update_mode(self):
-        """Обновляет интерфейс для текущего режима."""
-        current_mode = self.mode_selector.currentText()
-        if current_mode in self.modes:
-            mode_data = self.modes[current_mode]
-            for i in range(self.num_standard_buttons):
-                button_data = mode_data["standard_buttons"][f"button{i + 1}"]
-                action_type = getattr(self, f"standard_button{i + 1}_action_type")
-                stacked_input = getattr(self, f"standard_button{i + 1}_stacked_input")
-                action_type.setCurrentText(button_data["type"])
-                stacked_input.widget(0).setText(button_data["action"])
-                stacked_input.widget(1).setText(button_data["action"])
-            for i in range(self.num_dropdown_buttons):
-                dropdown_value = mode_data["dropdown_buttons"][f"dropdown_button{i + 1}"]
-                dropdown_selector = getattr(self, f"dropdown_button{i + 1}_selector")
-                dropdown_selector.setCurrentText(dropdown_value)
+        """Переносит правки прежнего режима в профиль и показывает режим, выбранный в mode_selector."""
+        self.commit_current_mode()
+        self.show_mode()
+
+    def show_mode(self):
+        """Заполняет поля кнопок данными режима, выбранного в mode_selector; файл режима читается здесь."""
+        self.current_mode = self.mode_model.mode_name(self.mode_selector.currentIndex())
+        if self.current_mode is None:
+            return
+        mode_data = self.mode_model.profile.mode(self.current_mode)
+        standard_buttons = mode_data.get("standard_buttons", {})
+        for i, (action_type, stacked_input) in enumerate(self.standard_button_widgets):
+            button_data = standard_buttons.get(f"button{i + 1}", EMPTY_BUTTON)
+            action_type.setCurrentText(button_data["type"])
+            stacked_input.widget(0).setText(button_data["action"])
+            stacked_input.widget(1).setText(button_data["action"])
+            hold_type, hold_input, hold_timeout, hold_permissive = self.hold_widgets[i]
+            hold_data = button_data.get("hold", {})
+            hold_type.setCurrentText(hold_data.get("type", NO_HOLD))
+            hold_input.setText(hold_data.get("action", ""))
+            hold_timeout.setValue(hold_data.get("timeout_ms", TAP_HOLD_MS))
+            hold_permissive.setChecked(hold_data.get("permissive", TAP_HOLD_PERMISSIVE))
+        self.layer_only_checkbox.setChecked(mode_data.get("layer_only", False))
+        dropdown_buttons = mode_data.get("dropdown_buttons", {})
+        for i, dropdown_selector in enumerate(self.dropdown_selectors):
+            dropdown_selector.setCurrentText(dropdown_buttons.get(f"dropdown_button{i + 1}", "Nothing"))
+
+    def commit_current_mode(self):
+        """
+        Переносит значения полей в данные показанного режима. Профиль помечает режим изменённым,
+        только если данные отличаются: просмотр режима без правок не приводит к записи файла.
+        """
+        if self.current_mode is None:
+            return
+        mode_data = copy.deepcopy(self.mode_model.profile.mode(self.current_mode))
+        standard_buttons = mode_data.setdefault("standard_buttons", {})
+        for i, (action_type, stacked_input) in enumerate(self.standard_button_widgets):
+            button_data = {"type": action_type.currentText(), "action": stacked_input.currentWidget().text()}
+            hold_type, hold_input, hold_timeout, hold_permissive = self.hold_widgets[i]
+            if hold_type.currentText() != NO_HOLD:
+                button_data["hold"] = {"type": hold_type.currentText(), "action": hold_input.text(),
+                                       "timeout_ms": hold_timeout.value(), "permissive": hold_permissive.isChecked()}
+            if button_data != EMPTY_BUTTON or f"button{i + 1}" in standard_buttons:
+                standard_buttons[f"button{i + 1}"] = button_data
+        if self.layer_only_checkbox.isChecked():
+            mode_data["layer_only"] = True
+        else:
+            mode_data.pop("layer_only", None)
+        dropdown_buttons = mode_data.setdefault("dropdown_buttons", {})
+        for i, dropdown_selector in enumerate(self.dropdown_selectors):
+            dropdown_buttons[f"dropdown_button{i + 1}"] = dropdown_selector.currentText()
+        self.mode_model.set_mode(self.mode_model.profile.names.index(self.current_mode), mode_data)
 
     def update_input_type(self):
         """Обновляет видимость полей ввода."""
-        for i in range(self.num_standard_buttons):
-            action_type = getattr(self, f"standard_button{i + 1}_action_type").currentText()
-            stacked_input = getattr(self, f"standard_button{i + 1}_stacked_input")
-            stacked_input.setCurrentIndex(0 if action_type == "Print Text" else 1)
+        for action_type, stacked_input in self.standard_button_widgets:
+            # Макрос вводится текстом: шаги через ';', например Ctrl+C; wait 100; "text"
+            stacked_input.setCurrentIndex(1 if action_type.currentText() == "Key Combination" else 0)
+            stacked_input.widget(0).setToolTip(ACTION_HINTS.get(action_type.currentText(), ""))
+        for hold_type, hold_input, hold_timeout, hold_permissive in self.hold_widgets:
+            has_hold = hold_type.currentText() != NO_HOLD
+            for widget in (hold_input, hold_timeout, hold_permissive):
+                widget.setEnabled(has_hold)
+            hold_input.setToolTip(ACTION_HINTS.get(hold_type.currentText(), ""))
 
     def clear_field(self, stacked_input):
         """Очищает поля ввода."""
@@ -268,37 +679,203 @@ class ArduinoCodeGenerator(QMainWindow):
             stacked_input.widget(i).clear()
 
     def save_mode_data(self):
-        """Сохраняет текущие данные режима."""
-        current_mode = self.mode_selector.currentText()
-        if current_mode in self.modes:
-            for i in range(self.num_standard_buttons):
-                action_type = getattr(self, f"standard_button{i + 1}_action_type").currentText()
-                stacked_input = getattr(self, f"standard_button{i + 1}_stacked_input")
-                action_text = stacked_input.currentWidget().text()
-                self.modes[current_mode]["standard_buttons"][f"button{i + 1}"] = {"type": action_type,
-                                                                                  "action": action_text}
-
-            for i in range(self.num_dropdown_buttons):
-                dropdown_selector = getattr(self, f"dropdown_button{i + 1}_selector")
-                dropdown_value = dropdown_selector.currentText()
-                self.modes[current_mode]["dropdown_buttons"][f"dropdown_button{i + 1}"] = dropdown_value
-        with open("modes.json", "w") as f:
-            json.dump(self.modes, f, indent=4)
+        """Сохраняет изменённые режимы открытых профилей и настройки прошивки."""
+        self.commit_current_mode()
+        written = self.profile_store.save()
+        self.mode_model.refresh()
+        with open("settings.json", "w") as f:
+            json.dump(self.firmware_settings(), f, indent=4)
+        if written:
+            self.statusBar().showMessage(f"Saved {written} file(s)", 3000)
 
     def on_upload_code_clicked(self):
-        """Генерация файла .ino при нажатии кнопки."""
+        """Генерация файла .ino и загрузка в фоновом потоке."""
         self.save_mode_data()
-        check = generate_ino_file(self.modes, self.num_standard_buttons, self.num_dropdown_buttons)
+        modes = self.mode_model.profile.to_dict()
+        settings = copy.deepcopy(self.firmware_settings())
+        # Все ошибки конфигурации сразу, до очереди сборки и arduino-cli
+        errors, _ = validate_sketch_config(modes, self.num_standard_buttons, self.num_dropdown_buttons,
+                                           settings["matrix"], settings["keyboard"], settings["typing"])
+        if errors:
+            QMessageBox.warning(self, "Error", "Invalid configuration:\n" + "\n".join(errors))
+            return
+        key = config_key(modes, self.num_standard_buttons, self.num_dropdown_buttons, settings)
+        generate = partial(generate_ino_file, modes, self.num_standard_buttons, self.num_dropdown_buttons,
+                           matrix=settings["matrix"], keyboard=settings["keyboard"], typing=settings["typing"])
+        extra_flags = [TELEMETRY_FLAG] if settings["telemetry"] else []
+        self.enqueue_build("Firmware", {"sketch_path": "kurs.ino", "generate": generate, "cache_key": key,
+                                        "build_properties": firmware_build_properties(settings["poll_interval_ms"],
+                                                                                      extra_flags)})
+
+    def on_upload_keymap_firmware_clicked(self):
+        """Однократная прошивка универсальной прошивки, читающей раскладку из EEPROM."""
+        if self.matrix:
+            QMessageBox.warning(self, "Error", "Keymap firmware supports direct pin layout only.")
+            return
+        generate = partial(generate_keymap_firmware, self.num_standard_buttons)
+        self.enqueue_build("Keymap firmware", {"sketch_path": "keymap_firmware/keymap_firmware.ino",
+                                               "generate": generate})
+
+    def enqueue_build(self, name, args):
+        """Ставит сборку в очередь и запускает её, если другой сборки нет."""
+        self.build_queue.append({"name": name, "args": args})
+        self.start_next_build()
+        self.update_build_status()
+
+    def start_next_build(self):
+        # Порт, занятый обменом с платой, помешал бы сбросу в загрузчик: сборка ждёт его окончания
+        if self.build_thread is not None or self.serial_thread is not None or not self.build_queue:
+            return
+        # Открытый порт телеметрии тоже помешал бы сбросу; закрывается, только пока его не опрашивает поток
+        self.telemetry_collector.close()
+        job = self.build_queue.popleft()
+        self.build_log.appendPlainText(f"=== {job['name']} ===")
+        self.build_progress.setValue(0)
+
+        self.build_thread = QThread()
+        self.build_worker = BuildWorker(job, self.cli_backend)
+        self.build_worker.moveToThread(self.build_thread)
+        self.build_thread.started.connect(self.build_worker.run)
+        self.build_worker.stage_changed.connect(self.on_build_stage)
+        self.build_worker.output.connect(self.build_log.appendPlainText)
+        self.build_worker.finished.connect(self.on_build_finished)
+        self.build_worker.finished.connect(self.build_thread.quit)
+        self.build_thread.finished.connect(self.on_build_thread_finished)
+        self.cancel_build_button.setEnabled(True)
+        self.build_thread.start()
+
+    def on_build_stage(self, stage):
+        self.build_progress.setValue(STAGES.index(stage))
+        self.update_build_status(stage)
+
+    def on_build_finished(self, result):
+        """Выводит итог сборки в журнал; окно с результатом показывается, только если очередь пуста."""
+        durations = ", ".join(f"{stage} {seconds:.1f} s" for stage, seconds in result.durations.items())
+        self.last_trace = result.trace.to_entry()
+        self.export_trace_button.setEnabled(True)
+        if result.success:
+            self.build_progress.setValue(len(STAGES))
+            cache_note = " (cached)" if result.cache_hit else ""
+            self.build_log.appendPlainText(f"Uploaded to {result.port}{cache_note}: {durations}")
+            if not self.build_queue:
+                QMessageBox.information(self, "Success", "Drive upload successfully.")
+        else:
+            self.build_log.appendPlainText(f"Failed at {result.stage}: {result.error}")
+            if not self.build_queue and not result.cancelled:
+                QMessageBox.warning(self, "Error", result.error)
+
+    def on_build_thread_finished(self):
+        self.build_thread.deleteLater()
+        self.build_worker.deleteLater()
+        self.build_thread = None
+        self.build_worker = None
+        self.cancel_build_button.setEnabled(False)
+        self.start_next_build()
+        self.update_build_status()
+
+    def update_build_status(self, stage=None):
+        if self.build_thread is None:
+            text = "Idle"
+        else:
+            text = f"{self.build_worker.job['name']}: {stage or 'starting'}"
+        if self.build_queue:
+            text += f" (queued: {len(self.build_queue)})"
+        self.build_status.setText(text)
+
+    def export_last_trace(self):
+        """Сохраняет трассу последней сборки для chrome://tracing или ui.perfetto.dev."""
+        path, _ = QFileDialog.getSaveFileName(self, "Export Trace", "build_trace.json", "Chrome Trace (*.json)")
+        if not path:
+            return
+        try:
+            save_chrome_trace(self.last_trace, path)
+        except OSError as e:
+            QMessageBox.warning(self, "Error", str(e))
+
+    def cancel_build(self):
+        """Отменяет текущую сборку и очищает очередь."""
+        self.build_queue.clear()
+        if self.build_worker is not None:
+            self.build_worker.cancel()
+        self.update_build_status()
+
+    def closeEvent(self, event):
+        self.commit_current_mode()
+        if self.profile_store.dirty:
+            answer = QMessageBox.question(self, "Unsaved Changes", "Save changed modes before closing?",
+                                          QMessageBox.Save | QMessageBox.Discard | QMessageBox.Cancel)
+            if answer == QMessageBox.Cancel:
+                event.ignore()
+                return
+            if answer == QMessageBox.Save:
+                self.save_mode_data()
+        self.cancel_build()
+        if self.build_thread is not None:
+            self.build_thread.quit()
+            self.build_thread.wait()
+        if self.serial_thread is not None:
+            self.serial_thread.quit()
+            self.serial_thread.wait()
+        self.telemetry_collector.close()
+        if self.cli_backend is not None:
+            self.cli_backend.close()
+        super().closeEvent(event)
+
+    def on_push_config_clicked(self):
+        """Загрузка режимов в EEPROM по serial, без компиляции и сброса платы."""
+        self.save_mode_data()
+        try:
+            blob = serialize_modes(self.mode_model.profile.to_dict(), self.num_standard_buttons,
+                                   self.num_dropdown_buttons)
+        except ValueError as e:
+            QMessageBox.warning(self, "Error", str(e))
+            return
 
-        if check == 1:
-            check = upload_ino_file("kurs.ino")
+        self.start_serial_task(partial(push_keymap, blob), self.on_push_config_finished)
 
-            if check == 1:
-                QMessageBox.information(self, "Success", "Drive upload successfully.")
-            else:
-                QMessageBox.warning(self, "Error", str(check))
+    def on_push_config_finished(self, check, error):
+        if check == 1:
+            QMessageBox.information(self, "Success", "Config pushed successfully.")
         else:
-            QMessageBox.warning(self, "Error", str(check))
+            QMessageBox.warning(self, "Error", str(error or check))
+
+    def start_serial_task(self, function, on_finished):
+        """Запускает function в потоке SerialWorker; on_finished(результат, исключение) вызывается в потоке окна."""
+        if self.serial_thread is not None:
+            return
+        self.push_config_button.setEnabled(False)
+        self.read_telemetry_button.setEnabled(False)
+        self.serial_thread = QThread()
+        self.serial_worker = SerialWorker(function)
+        self.serial_worker.moveToThread(self.serial_thread)
+        self.serial_thread.started.connect(self.serial_worker.run)
+        self.serial_worker.finished.connect(on_finished)
+        self.serial_worker.finished.connect(self.serial_thread.quit)
+        self.serial_thread.finished.connect(self.on_serial_thread_finished)
+        self.serial_thread.start()
+
+    def on_serial_thread_finished(self):
+        self.serial_thread.deleteLater()
+        self.serial_worker.deleteLater()
+        self.serial_thread = None
+        self.serial_worker = None
+        self.push_config_button.setEnabled(True)
+        self.read_telemetry_button.setEnabled(True)
+        self.start_next_build()
+
+    def on_read_telemetry_clicked(self):
+        """Снимок телеметрии платы в журнал; показатели считаются от предыдущего нажатия."""
+        # Пока идёт сборка, порт занят загрузкой или плата в загрузчике
+        if self.build_thread is not None:
+            QMessageBox.warning(self, "Error", "Wait for the build to finish.")
+            return
+        self.start_serial_task(self.telemetry_collector.poll, self.on_read_telemetry_finished)
+
+    def on_read_telemetry_finished(self, rates, error):
+        if error is not None:
+            QMessageBox.warning(self, "Error", str(error))
+            return
+        self.build_log.appendPlainText(format_telemetry(rates))
 
 
 if __name__ == "__main__":
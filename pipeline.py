@@ -0,0 +1,419 @@
+import contextlib
+import json
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from ports import BoardPort, PortCache, find_board, list_boards, reset_to_bootloader, wait_for_bootloader
+from tracing import (TRACE_HISTORY_PATH, Tracer, append_history, find_regressions, format_regressions, load_history,
+                     span)
+
+BUILD_DIR = "build"
+ARDUINO_CLI_PATH = os.path.join("tools", "arduino-cli.exe" if os.name == "nt" else "arduino-cli")
+
+STAGES = ("generate", "detect", "compile", "upload")
+# Размер прошивки из вывода arduino-cli compile
+PROGRAM_SIZE_PATTERN = re.compile(r"Sketch uses (\d+) bytes")
+
+
+class BuildCancelled(Exception):
+    pass
+
+
+class BuildError(Exception):
+    pass
+
+
+@dataclass
+class BuildResult:
+    """Итог сборки и загрузки: успех, стадия, на которой всё закончилось, и подробности."""
+    success: bool
+    stage: str
+    error: str = ""
+    cancelled: bool = False
+    port: str = None
+    fqbn: str = None
+    cache_hit: bool = False
+    compile_warm: bool = None
+    durations: dict = field(default_factory=dict)
+    # tracing.Tracer со спанами стадий и шагов и стадии, ставшие заметно медленнее прошлых сборок
+    trace: Tracer = None
+    regressions: list = field(default_factory=list)
+
+
+@dataclass
+class DeviceResult:
+    """Итог прошивки одной платы из партии."""
+    device: str
+    serial_number: str = None
+    success: bool = False
+    error: str = ""
+    duration: float = 0.0
+
+
+@dataclass
+class FleetResult:
+    """Итог прошивки партии плат: общая стадия и отчёт по каждой плате."""
+    success: bool
+    stage: str
+    error: str = ""
+    cancelled: bool = False
+    cache_hit: bool = False
+    compile_warm: bool = None
+    devices: list = field(default_factory=list)
+    durations: dict = field(default_factory=dict)
+    trace: Tracer = None
+    regressions: list = field(default_factory=list)
+
+
+class CliBackend:
+    """
+    Запуск arduino-cli отдельным процессом на каждую команду. Каждый процесс заново читает
+    настройки, индексы пакетов и описание ядра; постоянный процесс - arduino_daemon.DaemonBackend.
+    """
+
+    def __init__(self, cli_command):
+        self.cli_command = list(cli_command)
+
+    def run(self, args, on_line, cancel_event):
+        """Выполняет команду, передавая вывод построчно; при отмене процесс завершается."""
+        process = subprocess.Popen(self.cli_command + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   text=True, encoding="utf-8", errors="replace")
+        lines = queue.Queue()
+
+        def read_output():
+            for line in process.stdout:
+                lines.put(line.rstrip("\n"))
+            lines.put(None)
+
+        threading.Thread(target=read_output, daemon=True).start()
+
+        output = []
+        while True:
+            if cancel_event.is_set():
+                process.terminate()
+                process.wait()
+                raise BuildCancelled()
+            try:
+                line = lines.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if line is None:
+                break
+            output.append(line)
+            on_line(line)
+
+        if process.wait() != 0:
+            raise BuildError("\n".join(output[-20:]) or f"arduino-cli {args[0]} завершился с ошибкой")
+        return output
+
+    def board_list(self):
+        """Разобранный вывод board list --format json."""
+        process = subprocess.run(self.cli_command + ["board", "list", "--format", "json"],
+                                 capture_output=True, text=True, encoding="utf-8", errors="replace", timeout=30)
+        if process.returncode != 0:
+            raise BuildError(process.stderr.strip() or "arduino-cli board list завершился с ошибкой")
+        return json.loads(process.stdout or "{}")
+
+    def close(self):
+        pass
+
+
+class BuildPipeline:
+    """
+    Генерация, поиск платы, компиляция и загрузка скетча через arduino-cli.
+    on_stage получает имя начавшейся стадии, on_output - строки вывода arduino-cli.
+    Колбэки вызываются из потока, в котором запущен run().
+    backend выполняет команды arduino-cli (по умолчанию CliBackend - процесс на команду);
+    один backend можно передавать нескольким сборкам, закрывает его создавший.
+    Каждый запуск пишет трассу стадий в result.trace и журнал trace_history_path (см. tracing.py).
+    """
+
+    def __init__(self, cli_path=ARDUINO_CLI_PATH, on_stage=None, on_output=None, port_cache=None,
+                 build_dir=BUILD_DIR, build_dirs=None, metrics_path=None, backend=None, trace_history_path=None):
+        # Путь к arduino-cli или команда списком, например [sys.executable, "stub_arduino_cli.py"]
+        self.cli_command = [cli_path] if isinstance(cli_path, str) else list(cli_path)
+        self.backend = backend or CliBackend(self.cli_command)
+        self.port_cache = port_cache or PortCache()
+        self.build_dir = build_dir
+        # Постоянные каталоги сборки (firmware_cache.BuildDirectories) и журнал времени компиляции
+        self.build_dirs = build_dirs
+        self.metrics_path = metrics_path
+        self.trace_history_path = trace_history_path
+        self.on_stage = on_stage or (lambda stage: None)
+        self.on_output = on_output or (lambda line: None)
+        self._cancel_event = threading.Event()
+        self._reset_lock = threading.Lock()
+        self._stage_span = None
+
+    def cancel(self):
+        """Прерывает сборку; безопасно вызывать из любого потока."""
+        self._cancel_event.set()
+
+    def run(self, sketch_path, generate=None, cache_key=None, build_properties=()):
+        """
+        Выполняет все стадии по порядку и возвращает BuildResult.
+        build_properties - свойства --build-property для компиляции, например из firmware_build_properties.
+        """
+        result = BuildResult(success=False, stage=STAGES[0], trace=Tracer("run"))
+        try:
+            with result.trace.activate():
+                self._generate(result, sketch_path, generate)
+
+                self._stage(result, "detect")
+                board = self.detect_board()
+                result.port, result.fqbn = board.device, board.fqbn
+                self._stage_span.args.update(port=board.device, fqbn=board.fqbn)
+
+                self._stage(result, "compile")
+                input_dir = self._compile(sketch_path, result, cache_key, build_properties=build_properties)
+
+                # Сброс на 1200 бод и ожидание загрузчика выполняет сам arduino-cli
+                self._stage(result, "upload")
+                self._stage_span.args.update(port=result.port)
+                self._run_cli(["upload", "--fqbn", result.fqbn, "--port", result.port,
+                               "--input-dir", input_dir, sketch_path])
+            result.success = True
+            self.port_cache.remember(board)
+        except BuildCancelled:
+            result.cancelled = True
+            result.error = "Сборка отменена"
+        except Exception as e:
+            result.error = str(e)
+        finally:
+            self._finish_stage(result)
+            self._record_trace(result)
+        return result
+
+    def compile(self, sketch_path, fqbn, cache_key=None, build_properties=()):
+        """Только компиляция, без поиска платы и загрузки. Возвращает BuildResult."""
+        result = BuildResult(success=False, stage="compile", fqbn=fqbn, trace=Tracer("compile"))
+        try:
+            with result.trace.activate():
+                self._stage(result, "compile")
+                self._compile(sketch_path, result, cache_key, build_properties=build_properties)
+            result.success = True
+        except BuildCancelled:
+            result.cancelled = True
+            result.error = "Сборка отменена"
+        except Exception as e:
+            result.error = str(e)
+        finally:
+            self._finish_stage(result)
+            self._record_trace(result)
+        return result
+
+    def _stage(self, result, stage):
+        if self._cancel_event.is_set():
+            raise BuildCancelled()
+        self._finish_stage(result)
+        result.stage = stage
+        self._stage_span = result.trace.begin(stage, "stage")
+        self.on_stage(stage)
+
+    def _finish_stage(self, result):
+        if self._stage_span is not None:
+            result.trace.end(self._stage_span)
+            result.durations[result.stage] = self._stage_span.duration
+            self._stage_span = None
+
+    def _generate(self, result, sketch_path, generate):
+        """Стадия генерации; спаны generate_ino_file попадают в трассу через Tracer.activate()."""
+        self._stage(result, "generate")
+        if generate is not None:
+            info = generate()
+            # generate_ino_file возвращает отчёт о памяти и USB-отчётах, он попадает в журнал сборки
+            if isinstance(info, dict) and info.get("report"):
+                self.on_output(info["report"])
+        if os.path.exists(sketch_path):
+            self._stage_span.args["sketch_bytes"] = os.path.getsize(sketch_path)
+
+    def _record_trace(self, result):
+        """Дописывает трассу в журнал сборок и сообщает о стадиях, ставших заметно медленнее обычного."""
+        result.trace.metadata.update(success=result.success, cancelled=result.cancelled, cache_hit=result.cache_hit,
+                                     compile_warm=result.compile_warm, fqbn=getattr(result, "fqbn", None),
+                                     port=getattr(result, "port", None))
+        entry = result.trace.to_entry()
+        path = self.trace_history_path or TRACE_HISTORY_PATH
+        try:
+            history = load_history(path)
+            append_history(entry, path)
+        except OSError as e:
+            self.on_output(f"Журнал сборок не записан: {e}")
+            return
+        result.regressions = find_regressions(history, entry)
+        if result.regressions:
+            self.on_output(format_regressions(result.regressions))
+
+    def detect_board(self, serial_number=None):
+        """
+        Возвращает BoardPort платы для прошивки. Платы ищутся по VID/PID в списке портов;
+        arduino-cli board list, который заметно медленнее, вызывается, только если так плата не найдена.
+        """
+        with span("find_board") as current:
+            try:
+                board = find_board(serial_number, self.port_cache)
+            except ImportError:
+                board = None
+            except ValueError as e:
+                raise BuildError(str(e))
+            current.args["found"] = board is not None
+        if board is not None:
+            self.on_output(f"Плата {board.fqbn} на {board.device}")
+            return board
+        return self._detect_with_cli()
+
+    def _detect_with_cli(self):
+        with span("arduino-cli board list"):
+            boards = self.backend.board_list()
+        detected_ports = boards.get("detected_ports", []) if isinstance(boards, dict) else boards
+        for detected in detected_ports:
+            if detected.get("matching_boards"):
+                port = detected["port"]
+                return BoardPort(port["address"], detected["matching_boards"][0]["fqbn"], False,
+                                 port.get("properties", {}).get("serialNumber"))
+        raise BuildError("Платы не найдены. Проверьте подключение.")
+
+    def _compile(self, sketch_path, result, cache_key, fqbn=None, build_dir=None, build_properties=()):
+        from firmware_cache import (COMPILE_METRICS_PATH, LIBRARIES_DIR, BuildDirectories, FirmwareCache,
+                                    record_compile_metrics, toolchain_fingerprint)
+
+        fqbn = fqbn or result.fqbn
+        cache = None
+        if cache_key is not None:
+            with result.trace.span("cache lookup", fqbn=fqbn) as current:
+                cache = FirmwareCache()
+                entry_key = cache.entry_key(cache_key, fqbn)
+                input_dir = cache.lookup(entry_key)
+                current.args["hit"] = input_dir is not None
+            if input_dir is not None:
+                result.cache_hit = True
+                self.on_output(f"Прошивка найдена в кеше: {input_dir}")
+                return input_dir
+
+        build_dir = build_dir or self.build_dir
+        build_dirs = self.build_dirs or BuildDirectories()
+        with result.trace.span("prepare build path"):
+            build_path, warm = build_dirs.prepare(sketch_path, fqbn, toolchain_fingerprint(self.cli_command[-1]))
+        result.compile_warm = warm
+        self.on_output(f"Каталог сборки: {build_path} ({'тёплая' if warm else 'холодная'} сборка)")
+
+        args = ["compile", "--fqbn", fqbn, "--build-path", build_path,
+                "--build-cache-path", build_dirs.core_cache_dir, "--output-dir", build_dir]
+        # Вендоренные библиотеки (в HID-Project добавлен HID_POLL_INTERVAL) важнее установленных
+        if os.path.isdir(LIBRARIES_DIR):
+            args += ["--libraries", LIBRARIES_DIR]
+        for build_property in build_properties:
+            args += ["--build-property", build_property]
+
+        with result.trace.span("arduino-cli compile", fqbn=fqbn, warm=warm,
+                               sketch_bytes=os.path.getsize(sketch_path)) as current:
+            output = self._run_cli(args + [sketch_path])
+        program_size = PROGRAM_SIZE_PATTERN.search(output)
+        if program_size:
+            current.args["program_bytes"] = int(program_size.group(1))
+        record_compile_metrics(fqbn, current.duration, warm, self.metrics_path or COMPILE_METRICS_PATH)
+        if cache is not None:
+            with result.trace.span("cache store"):
+                cache.store(entry_key, build_dir)
+        return build_dir
+
+    def run_fleet(self, sketch_path, generate=None, cache_key=None, boards=None, max_workers=None,
+                  build_properties=()):
+        """
+        Компилирует скетч один раз на каждый FQBN и прошивает все найденные платы параллельно.
+        boards - список BoardPort; по умолчанию все подключённые платы с известными VID/PID.
+        max_workers=1 прошивает платы по очереди. Возвращает FleetResult.
+        """
+        result = FleetResult(success=False, stage=STAGES[0], trace=Tracer("fleet"))
+        try:
+            with result.trace.activate():
+                self._generate(result, sketch_path, generate)
+
+                self._stage(result, "detect")
+                if boards is None:
+                    boards = [board for board in list_boards(self.port_cache) if not board.bootloader]
+                if not boards:
+                    raise BuildError("Платы не найдены. Проверьте подключение.")
+                self._stage_span.args["boards"] = len(boards)
+                self.on_output(f"Плат для прошивки: {len(boards)}")
+
+                self._stage(result, "compile")
+                fqbns = sorted({board.fqbn for board in boards})
+                input_dirs = {}
+                for fqbn in fqbns:
+                    build_dir = self.build_dir
+                    if len(fqbns) > 1:
+                        build_dir = os.path.join(self.build_dir, fqbn.replace(":", "."))
+                    input_dirs[fqbn] = self._compile(sketch_path, result, cache_key, fqbn, build_dir, build_properties)
+
+                self._stage(result, "upload")
+                with ThreadPoolExecutor(max_workers=max_workers or len(boards)) as executor:
+                    result.devices = list(executor.map(
+                        lambda board: self._flash_board(board, sketch_path, input_dirs[board.fqbn], result.trace),
+                        boards))
+                failed = [device for device in result.devices if not device.success]
+                if self._cancel_event.is_set():
+                    raise BuildCancelled()
+                result.success = not failed
+                if failed:
+                    result.error = f"Не удалось прошить плат: {len(failed)} из {len(boards)}"
+        except BuildCancelled:
+            result.cancelled = True
+            result.error = "Сборка отменена"
+        except Exception as e:
+            result.error = str(e)
+        finally:
+            self._finish_stage(result)
+            self._record_trace(result)
+        return result
+
+    def _flash_board(self, board, sketch_path, input_dir, trace):
+        """
+        Прошивает одну плату из партии. Сброс в загрузчик выполняется здесь, а не в arduino-cli:
+        arduino-cli берёт первый появившийся новый порт и при одновременном сбросе нескольких плат
+        может перепутать их, а здесь порт загрузчика ищется на том же разъёме USB.
+        """
+        device = DeviceResult(board.device, board.serial_number)
+        start = time.perf_counter()
+        # Потоки пула не наследуют активную трассу: tracing.span() из backend и генератора пишет в неё,
+        # только если поток активировал её сам
+        with trace.activate():
+            try:
+                port = board.device
+                if not board.bootloader:
+                    # Без известного разъёма платы приходится сбрасывать по одной
+                    with self._reset_lock if board.location is None else contextlib.nullcontext():
+                        old_devices = [other.device for other in list_boards() if other.bootloader]
+                        with trace.span("reset 1200 bps", port=board.device):
+                            reset_to_bootloader(board.device)
+                        with trace.span("wait bootloader", device=board.device) as current:
+                            bootloader = wait_for_bootloader(old_devices, cancel_event=self._cancel_event,
+                                                             location=board.location)
+                            current.args["port"] = bootloader.device if bootloader else None
+                    if bootloader is None:
+                        raise BuildError("Загрузчик не появился")
+                    port = bootloader.device
+                with trace.span("arduino-cli upload", device=board.device, port=port):
+                    self._run_cli(["upload", "--fqbn", board.fqbn, "--port", port, "--input-dir", input_dir,
+                                   "--upload-property", "upload.use_1200bps_touch=false",
+                                   "--upload-property", "upload.wait_for_upload_port=false", sketch_path],
+                                  prefix=f"[{board.device}] ")
+                device.success = True
+                self.port_cache.remember(board)
+            except BuildCancelled:
+                device.error = "Сборка отменена"
+            except Exception as e:
+                device.error = str(e)
+        device.duration = time.perf_counter() - start
+        return device
+
+    def _run_cli(self, args, prefix=""):
+        """Выполняет команду arduino-cli через backend, передавая вывод построчно в on_output."""
+        output = self.backend.run(args, lambda line: self.on_output(prefix + line), self._cancel_event)
+        return "\n".join(output)
@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+PORT_CACHE_PATH = os.path.join(".cache", "ports.json")
+POLL_INTERVAL = 0.05
+
+# (VID, PID) -> (FQBN, это загрузчик). Pro Micro от SparkFun и клоны прошиваются как Leonardo:
+# у них тот же ATmega32U4 и загрузчик Caterina
+USB_IDS = {
+    (0x2341, 0x8036): ("arduino:avr:leonardo", False),
+    (0x2341, 0x0036): ("arduino:avr:leonardo", True),
+    (0x2A03, 0x8036): ("arduino:avr:leonardo", False),
+    (0x2A03, 0x0036): ("arduino:avr:leonardo", True),
+    (0x2341, 0x8037): ("arduino:avr:micro", False),
+    (0x2341, 0x0037): ("arduino:avr:micro", True),
+    (0x1B4F, 0x9206): ("arduino:avr:leonardo", False),
+    (0x1B4F, 0x9205): ("arduino:avr:leonardo", True),
+    (0x1B4F, 0x9204): ("arduino:avr:leonardo", False),
+    (0x1B4F, 0x9203): ("arduino:avr:leonardo", True),
+}
+
+
+@dataclass
+class BoardPort:
+    """Последовательный порт распознанной платы."""
+    device: str
+    fqbn: str
+    bootloader: bool
+    serial_number: str = None
+    vid: int = None
+    pid: int = None
+    # Физическое место на шине USB; не меняется, когда плата уходит в загрузчик
+    location: str = None
+
+
+def _comports():
+    import serial.tools.list_ports
+
+    return serial.tools.list_ports.comports()
+
+
+def list_boards(cache=None):
+    """
+    Возвращает платы с известными VID/PID. Порты с неизвестными VID/PID попадают в список,
+    только если FQBN для их серийного номера уже есть в кеше.
+    """
+    boards = []
+    for info in _comports():
+        if info.vid is None:
+            continue
+        known = USB_IDS.get((info.vid, info.pid))
+        if known is not None:
+            fqbn, bootloader = known
+        elif cache is not None and cache.get(info.serial_number):
+            fqbn, bootloader = cache.get(info.serial_number)["fqbn"], False
+        else:
+            continue
+        boards.append(BoardPort(info.device, fqbn, bootloader, info.serial_number, info.vid, info.pid,
+                                getattr(info, "location", None)))
+    return boards
+
+
+class PortCache:
+    """Последний известный порт и FQBN для каждого серийного номера платы."""
+
+    def __init__(self, path=PORT_CACHE_PATH):
+        self.path = path
+        # remember вызывается из потоков параллельной прошивки
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, serial_number):
+        return self.entries.get(serial_number) if serial_number else None
+
+    def last_used(self):
+        """Серийный номер платы, которую прошивали последней."""
+        if not self.entries:
+            return None
+        return max(self.entries, key=lambda serial_number: self.entries[serial_number]["used_at"])
+
+    def remember(self, board):
+        if not board.serial_number:
+            return
+        with self._lock:
+            self.entries[board.serial_number] = {"port": board.device, "fqbn": board.fqbn, "used_at": time.time()}
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, indent=4)
+            os.replace(tmp_path, self.path)
+
+
+def reset_to_bootloader(port):
+    """Открытие порта на 1200 бод перезапускает ATmega32U4 в загрузчик."""
+    import serial
+
+    with serial.Serial(port, baudrate=1200) as ser:
+        ser.dtr = False
+
+
+def find_board(serial_number=None, cache=None):
+    """
+    Выбирает плату для прошивки. Если подключено несколько плат и серийный номер не указан,
+    берётся прошивавшаяся последней; иначе ValueError, чтобы не прошить не ту плату.
+    Возвращает None, если подходящих плат нет.
+    """
+    boards = list_boards(cache)
+    if serial_number is not None:
+        boards = [board for board in boards if board.serial_number == serial_number]
+    if len(boards) > 1 and cache is not None:
+        last_used = cache.last_used()
+        preferred = [board for board in boards if board.serial_number == last_used]
+        if preferred:
+            return preferred[0]
+    if len(boards) > 1:
+        devices = ", ".join(f"{board.device} ({board.serial_number or 'без номера'})" for board in boards)
+        raise ValueError(f"Подключено несколько плат: {devices}. Укажите серийный номер.")
+    return boards[0] if boards else None
+
+
+def wait_for_port(predicate, timeout, interval=POLL_INTERVAL, cancel_event=None):
+    """
+    Опрашивает список портов, пока predicate не вернёт подходящую плату.
+    Возвращает BoardPort или None по таймауту или отмене.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        for board in list_boards():
+            if predicate(board):
+                return board
+        if time.monotonic() >= deadline or (cancel_event is not None and cancel_event.is_set()):
+            return None
+        time.sleep(interval)
+
+
+def wait_for_bootloader(old_devices=(), timeout=8, cancel_event=None, location=None):
+    """
+    Ждёт появления порта загрузчика после сброса на 1200 бод.
+    location ограничивает поиск одним разъёмом USB, когда в загрузчик одновременно уходят несколько плат.
+    """
+    old_devices = set(old_devices)
+    return wait_for_port(lambda board: (board.bootloader and board.device not in old_devices
+                                        and (location is None or board.location == location)),
+                         timeout, cancel_event=cancel_event)
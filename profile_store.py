@@ -0,0 +1,230 @@
+import copy
+import json
+import os
+import re
+
+from generate import LAYER_ACTION_TYPES
+
+# Профили режимов: profiles/<профиль>/index.json хранит порядок режимов и имена их файлов,
+# каждый режим - отдельный файл в profiles/<профиль>/modes/. Режимы читаются при первом обращении,
+# сохраняются только изменённые режимы, а индекс - только если менялся состав или порядок.
+# Каждый файл записывается атомарно: временный файл и os.replace
+PROFILES_DIR = "profiles"
+STORE_STATE_FILE = "store.json"
+INDEX_FILE = "index.json"
+MODES_DIR = "modes"
+INDEX_VERSION = 1
+DEFAULT_PROFILE = "default"
+PROFILE_NAME_PATTERN = re.compile(r"^[\w\- ]+$")
+
+
+def _write_json_atomic(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class Profile:
+    """
+    Один профиль: упорядоченные имена режимов и лениво загружаемые данные режимов.
+    Изменения накапливаются в памяти до save().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self._files = {}
+        self._modes = {}
+        self._dirty = set()
+        self._removed_files = []
+        self._index_dirty = False
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            index = _read_json(index_path)
+            self.names = [entry["name"] for entry in index["modes"]]
+            self._files = {entry["name"]: entry["file"] for entry in index["modes"]}
+            self._next_id = index.get("next_id", len(self.names))
+        else:
+            self.names = []
+            self._next_id = 0
+            self._index_dirty = True
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._files or name in self._modes
+
+    @property
+    def dirty(self):
+        return bool(self._dirty or self._removed_files or self._index_dirty)
+
+    def is_mode_dirty(self, name):
+        return name in self._dirty
+
+    def mode(self, name):
+        """Данные режима; файл режима читается при первом обращении."""
+        if name not in self._modes:
+            if name not in self._files:
+                raise KeyError(name)
+            self._modes[name] = _read_json(os.path.join(self.path, MODES_DIR, self._files[name]))
+        return self._modes[name]
+
+    def set_mode(self, name, data):
+        """Заменяет данные режима; возвращает True, если они изменились."""
+        if self.mode(name) == data:
+            return False
+        self._modes[name] = copy.deepcopy(data)
+        self._dirty.add(name)
+        return True
+
+    def add_mode(self, name, data, index=None):
+        if not name or name in self:
+            raise ValueError(f"Режим '{name}' уже есть или имя пустое")
+        self.names.insert(len(self.names) if index is None else index, name)
+        self._files[name] = f"{self._next_id:06d}.json"
+        self._next_id += 1
+        self._modes[name] = copy.deepcopy(data)
+        self._dirty.add(name)
+        self._index_dirty = True
+
+    def remove_mode(self, name):
+        self.names.remove(name)
+        self._modes.pop(name, None)
+        self._dirty.discard(name)
+        self._removed_files.append(self._files.pop(name))
+        self._index_dirty = True
+
+    def rename_mode(self, old_name, new_name):
+        """
+        Файл переименованного режима остаётся прежним, меняется индекс. Кнопки слоёв (Momentary Layer,
+        Toggle Layer, в том числе на удержании), указывающие на old_name, переводятся на new_name:
+        для этого читаются все режимы, а изменённые помечаются к сохранению.
+        Возвращает имена режимов, в которых изменились ссылки.
+        """
+        if not new_name or new_name in self:
+            raise ValueError(f"Режим '{new_name}' уже есть или имя пустое")
+        self.names[self.names.index(old_name)] = new_name
+        self._files[new_name] = self._files.pop(old_name)
+        if old_name in self._modes:
+            self._modes[new_name] = self._modes.pop(old_name)
+        if old_name in self._dirty:
+            self._dirty.discard(old_name)
+            self._dirty.add(new_name)
+        self._index_dirty = True
+
+        updated = []
+        for name in self.names:
+            data = copy.deepcopy(self.mode(name))
+            changed = False
+            for button_data in data.get("standard_buttons", {}).values():
+                for action in (button_data, button_data.get("hold") or {}):
+                    if action.get("type") in LAYER_ACTION_TYPES and action.get("action", "").strip() == old_name:
+                        action["action"] = new_name
+                        changed = True
+            if changed and self.set_mode(name, data):
+                updated.append(name)
+        return updated
+
+    def to_dict(self):
+        """Все режимы по порядку, копией: для генерации прошивки и записи в EEPROM."""
+        return {name: copy.deepcopy(self.mode(name)) for name in self.names}
+
+    def save(self):
+        """
+        Записывает изменённые режимы, затем индекс; файлы удалённых режимов стираются последними,
+        поэтому прерванное сохранение оставляет индекс, ссылающийся только на существующие файлы.
+        Возвращает число записанных файлов.
+        """
+        modes_dir = os.path.join(self.path, MODES_DIR)
+        os.makedirs(modes_dir, exist_ok=True)
+        written = 0
+        for name in self._dirty:
+            _write_json_atomic(os.path.join(modes_dir, self._files[name]), self._modes[name])
+            written += 1
+        if self._index_dirty:
+            _write_json_atomic(os.path.join(self.path, INDEX_FILE), {
+                "version": INDEX_VERSION, "next_id": self._next_id,
+                "modes": [{"name": name, "file": self._files[name]} for name in self.names]})
+            written += 1
+        for file_name in self._removed_files:
+            try:
+                os.remove(os.path.join(modes_dir, file_name))
+            except FileNotFoundError:
+                pass
+        self._dirty.clear()
+        self._removed_files.clear()
+        self._index_dirty = False
+        return written
+
+
+class ProfileStore:
+    """Каталог профилей. Открытые профили остаются в памяти вместе с несохранёнными изменениями."""
+
+    def __init__(self, root=PROFILES_DIR):
+        self.root = root
+        self._profiles = {}
+
+    def profile_names(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.exists(os.path.join(self.root, name, INDEX_FILE)) or name in self._profiles)
+
+    def open(self, name):
+        if name not in self._profiles:
+            path = os.path.join(self.root, name)
+            if not os.path.exists(os.path.join(path, INDEX_FILE)):
+                raise KeyError(name)
+            self._profiles[name] = Profile(path)
+        return self._profiles[name]
+
+    def create(self, name, modes=None):
+        """Новый профиль с режимами modes ({имя: данные}); сохраняется сразу."""
+        if not PROFILE_NAME_PATTERN.match(name or ""):
+            raise ValueError(f"Недопустимое имя профиля: '{name}'")
+        path = os.path.join(self.root, name)
+        if os.path.exists(path):
+            raise ValueError(f"Профиль '{name}' уже существует")
+        profile = Profile(path)
+        for mode_name, mode_data in (modes or {}).items():
+            profile.add_mode(mode_name, mode_data)
+        profile.save()
+        self._profiles[name] = profile
+        return profile
+
+    def import_json(self, name, json_path):
+        """Создаёт профиль из файла режимов в формате modes.json."""
+        return self.create(name, _read_json(json_path))
+
+    def save(self):
+        """Сохраняет все открытые профили с изменениями; возвращает число записанных файлов."""
+        return sum(profile.save() for profile in self._profiles.values() if profile.dirty)
+
+    @property
+    def dirty(self):
+        return any(profile.dirty for profile in self._profiles.values())
+
+    @property
+    def active(self):
+        """Профиль, открытый последним, по store.json."""
+        try:
+            return _read_json(os.path.join(self.root, STORE_STATE_FILE)).get("active")
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    @active.setter
+    def active(self, name):
+        os.makedirs(self.root, exist_ok=True)
+        _write_json_atomic(os.path.join(self.root, STORE_STATE_FILE), {"active": name})
+
+
+def load_profile(path):
+    """Режимы профиля из каталога profiles/<профиль> без ProfileStore, например для cli.py."""
+    return Profile(path).to_dict()
@@ -0,0 +1,14 @@
+#pragma once
+#include <Arduino.h>
+
+// Рисование только сдвигает виртуальные часы: содержимое экрана симулятор не проверяет
+class Adafruit_GFX : public Print {
+public:
+    void setCursor(int16_t, int16_t) {}
+    void setTextSize(uint8_t) {}
+    void setTextColor(uint16_t) {}
+    void setTextWrap(bool) {}
+    void fillRect(int16_t, int16_t, int16_t width, int16_t height, uint16_t);
+    size_t write(uint8_t c) override;
+    using Print::write;
+};
@@ -0,0 +1,32 @@
+#pragma once
+#include <Adafruit_GFX.h>
+#include <Wire.h>
+
+#define SSD1306_SWITCHCAPVCC 0x02
+#define SSD1306_BLACK 0
+#define SSD1306_WHITE 1
+#define SSD1306_PAGEADDR 0x22
+#define SSD1306_COLUMNADDR 0x21
+
+class Adafruit_SSD1306 : public Adafruit_GFX {
+public:
+    Adafruit_SSD1306(uint8_t width, uint8_t height, TwoWire* wire = &Wire, int8_t = -1,
+                     uint32_t clockDuring = 400000, uint32_t clockAfter = 100000)
+        : width(width), height(height), wire(wire), clockDuring(clockDuring), clockAfter(clockAfter) {}
+    bool begin(uint8_t = SSD1306_SWITCHCAPVCC, uint8_t = 0x3C) {
+        wire->setClock(clockAfter);
+        return true;
+    }
+    void clearDisplay() { memset(buffer, 0, sizeof(buffer)); }
+    void display();
+    void ssd1306_command(uint8_t command);
+    uint8_t* getBuffer() { return buffer; }
+
+private:
+    uint8_t width;
+    uint8_t height;
+    TwoWire* wire;
+    uint32_t clockDuring;
+    uint32_t clockAfter;
+    uint8_t buffer[128 * 64 / 8];
+};
@@ -0,0 +1,117 @@
+// Заглушка ядра Arduino для сборки сгенерированного скетча на компьютере (см. simulator.py).
+// Время виртуальное: каждый вызов, который на ATmega32U4 занимает заметное время, сдвигает часы sim_advance().
+#pragma once
+#include <stdint.h>
+#include <stdlib.h>
+#include <stddef.h>
+#include <string.h>
+#include <stdio.h>
+
+#define F_CPU 16000000UL
+#define LOW 0
+#define HIGH 1
+#define INPUT 0
+#define OUTPUT 1
+#define INPUT_PULLUP 2
+
+#define PROGMEM
+#define pgm_read_byte(p) (*(const uint8_t*)(p))
+#define pgm_read_word(p) (*(const uint16_t*)(p))
+#define pgm_read_ptr(p) (*(void* const*)(p))
+#define memcpy_P memcpy
+#define strlen_P strlen
+#define _BV(bit) (1U << (bit))
+#define constrain(amt, low, high) ((amt) < (low) ? (low) : ((amt) > (high) ? (high) : (amt)))
+
+typedef bool boolean;
+typedef uint8_t byte;
+
+class __FlashStringHelper;
+#define F(s) ((const __FlashStringHelper*)(s))
+
+// Виртуальные часы и стоимость операций
+uint64_t sim_now_ns();
+void sim_advance(uint64_t ns);
+
+unsigned long millis();
+unsigned long micros();
+void delay(unsigned long ms);
+void delayMicroseconds(unsigned int us);
+int digitalRead(uint8_t pin);
+void digitalWrite(uint8_t pin, uint8_t value);
+void pinMode(uint8_t pin, uint8_t mode);
+void noInterrupts();
+void interrupts();
+
+// Регистры портов: выводы энкодера выставляет симулятор, остальные скетч читает через digitalRead
+extern volatile uint8_t PINB, PINC, PIND, PINE, PINF;
+extern volatile uint8_t DDRB, DDRC, DDRD, DDRE, DDRF;
+extern volatile uint8_t PORTB, PORTC, PORTD, PORTE, PORTF;
+
+// Таймер 3 энкодера: симулятор вызывает прерывание с частотой, заданной OCR3A
+extern volatile uint8_t TCCR3A, TCCR3B, TIMSK3;
+extern volatile uint16_t OCR3A;
+#define WGM32 3
+#define CS31 1
+#define CS30 0
+#define OCIE3A 1
+#define ISR(vector) extern "C" void vector(void)
+
+class Print {
+public:
+    virtual size_t write(uint8_t c) = 0;
+    virtual ~Print() {}
+    size_t write(const char* s) {
+        size_t n = 0;
+        while (*s) {
+            n += write((uint8_t)*s++);
+        }
+        return n;
+    }
+    size_t print(const char* s) { return write(s); }
+    size_t print(const __FlashStringHelper* s) { return write((const char*)s); }
+    size_t print(char c) { return write((uint8_t)c); }
+    size_t print(long value) {
+        char buffer[12];
+        snprintf(buffer, sizeof(buffer), "%ld", value);
+        return write(buffer);
+    }
+    size_t print(int value) { return print((long)value); }
+    size_t print(unsigned long value) {
+        char buffer[12];
+        snprintf(buffer, sizeof(buffer), "%lu", value);
+        return write(buffer);
+    }
+    size_t print(unsigned int value) { return print((unsigned long)value); }
+    size_t println() { return write((uint8_t)'\n'); }
+    template <typename T>
+    size_t println(T value) { return print(value) + println(); }
+};
+
+// USB-serial: входные байты задаёт сценарий, вывод симулятор печатает построчно
+int sim_serial_available();
+int sim_serial_read();
+void sim_serial_write(uint8_t c);
+
+class SerialPort : public Print {
+public:
+    void begin(unsigned long) {}
+    int available() { return sim_serial_available(); }
+    int read() { return sim_serial_read(); }
+    size_t write(uint8_t c) override {
+        sim_serial_write(c);
+        return 1;
+    }
+    size_t write(const uint8_t* buffer, size_t size) {
+        for (size_t i = 0; i < size; ++i) {
+            sim_serial_write(buffer[i]);
+        }
+        return size;
+    }
+    using Print::write;
+    // Хост в симуляторе забирает вывод сразу: в буфере конечной точки всегда свободно
+    int availableForWrite() { return 64; }
+    operator bool() { return true; }
+};
+
+extern SerialPort Serial;
@@ -0,0 +1,104 @@
+#pragma once
+#include <Arduino.h>
+
+enum KeyboardKeycode : uint8_t {
+    KEY_RESERVED = 0x00,
+    KEY_A = 0x04, KEY_B, KEY_C, KEY_D, KEY_E, KEY_F, KEY_G, KEY_H, KEY_I, KEY_J, KEY_K, KEY_L, KEY_M,
+    KEY_N, KEY_O, KEY_P, KEY_Q, KEY_R, KEY_S, KEY_T, KEY_U, KEY_V, KEY_W, KEY_X, KEY_Y, KEY_Z,
+    KEY_1 = 0x1E, KEY_2, KEY_3, KEY_4, KEY_5, KEY_6, KEY_7, KEY_8, KEY_9, KEY_0,
+    KEY_ENTER = 0x28, KEY_ESC, KEY_BACKSPACE, KEY_TAB, KEY_SPACE, KEY_MINUS, KEY_EQUAL,
+    KEY_LEFT_BRACE, KEY_RIGHT_BRACE, KEY_BACKSLASH,
+    KEY_SEMICOLON = 0x33, KEY_QUOTE, KEY_TILDE, KEY_COMMA, KEY_PERIOD, KEY_SLASH,
+    KEY_F1 = 0x3A, KEY_F2, KEY_F3, KEY_F4, KEY_F5, KEY_F6, KEY_F7, KEY_F8, KEY_F9, KEY_F10, KEY_F11, KEY_F12,
+    KEY_INSERT = 0x49, KEY_DELETE = 0x4C,
+    KEY_RIGHT_ARROW = 0x4F, KEY_LEFT_ARROW, KEY_DOWN_ARROW, KEY_UP_ARROW,
+    KEY_LEFT_CTRL = 0xE0, KEY_LEFT_SHIFT, KEY_LEFT_ALT, KEY_LEFT_GUI,
+};
+
+enum ConsumerKeycode : uint16_t {
+    CONSUMER_BRIGHTNESS_UP = 0x6F,
+    CONSUMER_BRIGHTNESS_DOWN = 0x70,
+    MEDIA_FAST_FORWARD = 0xB3,
+    MEDIA_REWIND = 0xB4,
+    MEDIA_NEXT = 0xB5,
+    MEDIA_PREVIOUS = 0xB6,
+    MEDIA_VOLUME_UP = 0xE9,
+    MEDIA_VOLUME_DOWN = 0xEA,
+};
+
+// Каждая отправка отчёта проходит через sim_send_report: симулятор ставит его в конечную точку USB
+// и записывает время, когда хост его забрал
+void sim_send_report(const char* kind, const uint8_t* data, uint8_t length);
+
+class SimKeyboard : public Print {
+public:
+    explicit SimKeyboard(const char* kind) : kind(kind) {}
+    void begin() {}
+    size_t add(KeyboardKeycode key);
+    size_t remove(KeyboardKeycode key);
+    int send() {
+        sim_send_report(kind, keys, count);
+        return 1;
+    }
+    size_t press(KeyboardKeycode key) {
+        add(key);
+        send();
+        return 1;
+    }
+    size_t release(KeyboardKeycode key) {
+        remove(key);
+        send();
+        return 1;
+    }
+    size_t releaseAll() {
+        count = 0;
+        send();
+        return 1;
+    }
+    size_t removeAll() {
+        count = 0;
+        return 1;
+    }
+    // Символ ASCII: нажатие и отпускание, два отчёта
+    size_t write(uint8_t c) override;
+    size_t write(KeyboardKeycode key) {
+        press(key);
+        return release(key);
+    }
+    using Print::write;
+
+private:
+    const char* kind;
+    uint8_t keys[32];
+    uint8_t count = 0;
+};
+
+class SimConsumer {
+public:
+    void begin() {}
+    void write(ConsumerKeycode code) {
+        press(code);
+        release(code);
+    }
+    void press(ConsumerKeycode code) {
+        uint8_t data[2] = {(uint8_t)(code & 0xFF), (uint8_t)(code >> 8)};
+        sim_send_report("consumer", data, 2);
+    }
+    void release(ConsumerKeycode) { sim_send_report("consumer", nullptr, 0); }
+    void releaseAll() { sim_send_report("consumer", nullptr, 0); }
+};
+
+class SimMouse {
+public:
+    void begin() {}
+    void move(signed char x, signed char y, signed char wheel = 0) {
+        uint8_t data[3] = {(uint8_t)x, (uint8_t)y, (uint8_t)wheel};
+        sim_send_report("mouse", data, 3);
+    }
+};
+
+extern SimKeyboard Keyboard;
+extern SimKeyboard BootKeyboard;
+extern SimKeyboard SingleNKROKeyboard;
+extern SimConsumer Consumer;
+extern SimMouse Mouse;
@@ -0,0 +1,20 @@
+#pragma once
+#include <Arduino.h>
+
+// I2C: передача стоит 9 тактов шины на байт плюс адрес, частота задаётся setClock
+class TwoWire {
+public:
+    void begin() {}
+    void setClock(uint32_t hz) { clockHz = hz; }
+    void beginTransmission(uint8_t) { pending = 1; }
+    size_t write(uint8_t) {
+        ++pending;
+        return 1;
+    }
+    uint8_t endTransmission();
+
+    uint32_t clockHz = 100000;
+    uint16_t pending = 0;
+};
+
+extern TwoWire Wire;
@@ -0,0 +1,372 @@
+// Среда выполнения симулятора: виртуальные часы, выводы, конечная точка USB и прерывание энкодера.
+// Собирается вместе со скетчем (см. simulator.py) и читает сценарий из файла:
+//   <мс> pin <вывод> <уровень>          - сменить уровень вывода
+//   <мс> encoder <щелчки> <мкс на щелчок> - повернуть энкодер, положительные щелчки - по часовой стрелке
+//   <мс> serial <текст>                 - передать текст в USB-serial
+//   <мс> end                            - закончить симуляцию
+// и печатает в stdout:
+//   I <мкс> <вывод> <уровень>           - вход применён
+//   R <мкс> <вид> <байты hex>          - хост забрал отчёт HID
+//   O <мкс> <строка>                    - строка, которую скетч напечатал в Serial
+//   S <проходов loop> <мкс> <макс. мкс прохода> <нс процессора компьютера на проход>
+#include <Arduino.h>
+#include <HID-Project.h>
+#include <Wire.h>
+#include <Adafruit_SSD1306.h>
+
+#include <algorithm>
+#include <chrono>
+#include <fstream>
+#include <string>
+#include <vector>
+
+void setup();
+void loop();
+extern "C" void TIMER3_COMPA_vect(void) __attribute__((weak));
+
+// Оценки стоимости операций на ATmega32U4 при 16 МГц, нс
+const uint64_t DIGITAL_IO_NS = 3000;
+const uint64_t LOOP_OVERHEAD_NS = 2000;
+const uint64_t USB_SEND_NS = 40000;
+const uint64_t I2C_TRANSMISSION_NS = 10000;
+const uint64_t GLYPH_NS = 30000;
+const uint64_t FILL_BYTE_NS = 200;
+// Хост забирает отчёт из конечной точки раз в период опроса; пока отчёт не забран, следующий ждёт
+const uint64_t USB_POLL_NS = 1000000;
+const uint8_t ENCODER_S1_PIN = 5;
+const uint8_t ENCODER_S2_PIN = 6;
+
+volatile uint8_t PINB, PINC, PIND, PINE, PINF;
+volatile uint8_t DDRB, DDRC, DDRD, DDRE, DDRF;
+volatile uint8_t PORTB, PORTC, PORTD, PORTE, PORTF;
+volatile uint8_t TCCR3A, TCCR3B, TIMSK3;
+volatile uint16_t OCR3A;
+
+SerialPort Serial;
+TwoWire Wire;
+SimKeyboard Keyboard("keyboard");
+SimKeyboard BootKeyboard("boot");
+SimKeyboard SingleNKROKeyboard("nkro");
+SimConsumer Consumer;
+SimMouse Mouse;
+
+struct InputEvent {
+    uint64_t at;
+    uint8_t pin;
+    uint8_t level;
+};
+
+struct SerialInput {
+    uint64_t at;
+    std::string text;
+};
+
+static uint64_t now = 0;
+static uint64_t endpointFreeAt = 0;
+static uint64_t nextTimerTick = 0;
+static bool interruptsEnabled = true;
+static bool inInterrupt = false;
+static uint8_t pinLevels[32];
+static std::vector<InputEvent> inputs;
+static size_t nextInput = 0;
+static std::vector<SerialInput> serialInputs;
+static size_t nextSerialInput = 0;
+static std::string serialReceived;
+static std::string serialLine;
+
+// Уровни выводов энкодера по фазам кода Грея; фаза 0 - оба вывода подтянуты вверх
+static const uint8_t ENCODER_PHASES[4][2] = {{HIGH, HIGH}, {LOW, HIGH}, {LOW, LOW}, {HIGH, LOW}};
+static uint8_t encoderPhase = 0;
+
+static void setPin(uint8_t pin, uint8_t level) {
+    pinLevels[pin] = level;
+    // Выводы энкодера скетч читает прямо из регистров порта
+    if (pin == ENCODER_S1_PIN) {
+        PINC = level ? (PINC | _BV(6)) : (PINC & ~_BV(6));
+    } else if (pin == ENCODER_S2_PIN) {
+        PIND = level ? (PIND | _BV(7)) : (PIND & ~_BV(7));
+    }
+}
+
+static void applyInputs() {
+    while (nextInput < inputs.size() && inputs[nextInput].at <= now) {
+        const InputEvent& event = inputs[nextInput++];
+        setPin(event.pin, event.level);
+        if (event.pin != ENCODER_S1_PIN && event.pin != ENCODER_S2_PIN) {
+            printf("I %llu %u %u\n", (unsigned long long)(event.at / 1000), event.pin, event.level);
+        }
+    }
+}
+
+static uint64_t timerPeriodNs() {
+    if (!(TIMSK3 & _BV(OCIE3A))) {
+        return 0;
+    }
+    return (uint64_t)(OCR3A + 1) * 64 * 1000000000ULL / F_CPU;
+}
+
+int sim_serial_available() {
+    while (nextSerialInput < serialInputs.size() && serialInputs[nextSerialInput].at <= now) {
+        serialReceived += serialInputs[nextSerialInput++].text;
+    }
+    return (int)serialReceived.size();
+}
+
+int sim_serial_read() {
+    if (sim_serial_available() == 0) {
+        return -1;
+    }
+    uint8_t c = serialReceived[0];
+    serialReceived.erase(0, 1);
+    return c;
+}
+
+void sim_serial_write(uint8_t c) {
+    if (c == '\n') {
+        printf("O %llu %s\n", (unsigned long long)(now / 1000), serialLine.c_str());
+        serialLine.clear();
+    } else if (c != '\r') {
+        serialLine += (char)c;
+    }
+}
+
+uint64_t sim_now_ns() {
+    return now;
+}
+
+void sim_advance(uint64_t ns) {
+    now += ns;
+    applyInputs();
+    uint64_t period = timerPeriodNs();
+    if (period == 0 || TIMER3_COMPA_vect == nullptr) {
+        return;
+    }
+    if (nextTimerTick == 0) {
+        nextTimerTick = now + period;
+    }
+    while (nextTimerTick <= now && interruptsEnabled && !inInterrupt) {
+        inInterrupt = true;
+        TIMER3_COMPA_vect();
+        inInterrupt = false;
+        nextTimerTick += period;
+    }
+}
+
+unsigned long millis() {
+    return (unsigned long)(now / 1000000);
+}
+
+unsigned long micros() {
+    return (unsigned long)(now / 1000);
+}
+
+void delay(unsigned long ms) {
+    sim_advance((uint64_t)ms * 1000000);
+}
+
+void delayMicroseconds(unsigned int us) {
+    sim_advance((uint64_t)us * 1000);
+}
+
+int digitalRead(uint8_t pin) {
+    sim_advance(DIGITAL_IO_NS);
+    return pinLevels[pin];
+}
+
+void digitalWrite(uint8_t, uint8_t) {
+    sim_advance(DIGITAL_IO_NS);
+}
+
+void pinMode(uint8_t pin, uint8_t mode) {
+    if (mode == INPUT_PULLUP) {
+        setPin(pin, HIGH);
+    }
+}
+
+void noInterrupts() {
+    interruptsEnabled = false;
+}
+
+void interrupts() {
+    interruptsEnabled = true;
+    sim_advance(0);
+}
+
+void sim_send_report(const char* kind, const uint8_t* data, uint8_t length) {
+    // USB_Send ждёт, пока хост заберёт предыдущий отчёт, затем копирует новый в конечную точку
+    if (endpointFreeAt > now) {
+        sim_advance(endpointFreeAt - now);
+    }
+    sim_advance(USB_SEND_NS);
+    endpointFreeAt = (now / USB_POLL_NS + 1) * USB_POLL_NS;
+    printf("R %llu %s ", (unsigned long long)(endpointFreeAt / 1000), kind);
+    for (uint8_t i = 0; i < length; ++i) {
+        printf("%02x", data[i]);
+    }
+    printf("%s\n", length ? "" : "-");
+}
+
+size_t SimKeyboard::add(KeyboardKeycode key) {
+    for (uint8_t i = 0; i < count; ++i) {
+        if (keys[i] == key) {
+            return 1;
+        }
+    }
+    if (count < sizeof(keys)) {
+        keys[count++] = key;
+    }
+    return 1;
+}
+
+size_t SimKeyboard::remove(KeyboardKeycode key) {
+    for (uint8_t i = 0; i < count; ++i) {
+        if (keys[i] == key) {
+            keys[i] = keys[--count];
+            return 1;
+        }
+    }
+    return 0;
+}
+
+// Буквы, цифры и пробел переводятся в коды раскладки US, остальные символы записываются кодом ASCII
+size_t SimKeyboard::write(uint8_t c) {
+    KeyboardKeycode key = (KeyboardKeycode)c;
+    bool shift = false;
+    if (c >= 'a' && c <= 'z') {
+        key = (KeyboardKeycode)(KEY_A + c - 'a');
+    } else if (c >= 'A' && c <= 'Z') {
+        key = (KeyboardKeycode)(KEY_A + c - 'A');
+        shift = true;
+    } else if (c >= '1' && c <= '9') {
+        key = (KeyboardKeycode)(KEY_1 + c - '1');
+    } else if (c == '0') {
+        key = KEY_0;
+    } else if (c == ' ') {
+        key = KEY_SPACE;
+    }
+    if (shift) {
+        add(KEY_LEFT_SHIFT);
+    }
+    press(key);
+    remove(key);
+    if (shift) {
+        remove(KEY_LEFT_SHIFT);
+    }
+    send();
+    return 1;
+}
+
+uint8_t TwoWire::endTransmission() {
+    // 9 тактов шины на байт, включая адрес
+    sim_advance(I2C_TRANSMISSION_NS + (uint64_t)pending * 9 * 1000000000ULL / clockHz);
+    pending = 0;
+    return 0;
+}
+
+void Adafruit_GFX::fillRect(int16_t, int16_t, int16_t width, int16_t height, uint16_t) {
+    sim_advance((uint64_t)width * height / 8 * FILL_BYTE_NS);
+}
+
+size_t Adafruit_GFX::write(uint8_t) {
+    sim_advance(GLYPH_NS);
+    return 1;
+}
+
+void Adafruit_SSD1306::ssd1306_command(uint8_t) {
+    wire->setClock(clockDuring);
+    wire->beginTransmission(0x3C);
+    wire->write(0x00);
+    wire->write(0);
+    wire->endTransmission();
+    wire->setClock(clockAfter);
+}
+
+// Полный кадр: окно на весь экран и буфер кусками по 31 байту, как в Adafruit_SSD1306
+void Adafruit_SSD1306::display() {
+    for (uint8_t i = 0; i < 6; ++i) {
+        ssd1306_command(0);
+    }
+    wire->setClock(clockDuring);
+    uint16_t remaining = (uint16_t)width * height / 8;
+    while (remaining > 0) {
+        uint16_t chunk = std::min<uint16_t>(remaining, 31);
+        wire->beginTransmission(0x3C);
+        wire->write(0x40);
+        for (uint16_t i = 0; i < chunk; ++i) {
+            wire->write(0);
+        }
+        wire->endTransmission();
+        remaining -= chunk;
+    }
+    wire->setClock(clockAfter);
+}
+
+static void addEncoderTurn(uint64_t at, long detents, uint64_t detentNs) {
+    // Положительные щелчки увеличивают громкость, как прежний Encoder::read() / 4
+    int direction = detents > 0 ? -1 : 1;
+    long transitions = (detents > 0 ? detents : -detents) * 4;
+    for (long i = 0; i < transitions; ++i) {
+        encoderPhase = (encoderPhase + direction + 4) % 4;
+        uint64_t when = at + (uint64_t)i * detentNs / 4;
+        inputs.push_back({when, ENCODER_S1_PIN, ENCODER_PHASES[encoderPhase][0]});
+        inputs.push_back({when, ENCODER_S2_PIN, ENCODER_PHASES[encoderPhase][1]});
+    }
+}
+
+int main(int argc, char** argv) {
+    if (argc < 2) {
+        fprintf(stderr, "usage: %s trace.txt\n", argv[0]);
+        return 2;
+    }
+    std::ifstream trace(argv[1]);
+    uint64_t endAt = 0;
+    double atMs;
+    std::string command;
+    while (trace >> atMs >> command) {
+        uint64_t at = (uint64_t)(atMs * 1000000);
+        if (command == "pin") {
+            unsigned pin, level;
+            trace >> pin >> level;
+            inputs.push_back({at, (uint8_t)pin, (uint8_t)level});
+        } else if (command == "encoder") {
+            long detents;
+            double detentUs;
+            trace >> detents >> detentUs;
+            addEncoderTurn(at, detents, (uint64_t)(detentUs * 1000));
+        } else if (command == "serial") {
+            std::string text;
+            trace >> text;
+            serialInputs.push_back({at, text});
+        } else if (command == "end") {
+            endAt = at;
+        } else {
+            fprintf(stderr, "unknown trace command: %s\n", command.c_str());
+            return 2;
+        }
+    }
+    std::stable_sort(inputs.begin(), inputs.end(),
+                     [](const InputEvent& a, const InputEvent& b) { return a.at < b.at; });
+    for (uint8_t pin = 0; pin < sizeof(pinLevels); ++pin) {
+        pinLevels[pin] = HIGH;
+    }
+    PINC |= _BV(6);
+    PIND |= _BV(7);
+
+    setup();
+    uint64_t loops = 0;
+    uint64_t maxLoopNs = 0;
+    uint64_t loopStart = now;
+    auto hostStart = std::chrono::steady_clock::now();
+    while (now < endAt) {
+        uint64_t passStart = now;
+        sim_advance(LOOP_OVERHEAD_NS);
+        loop();
+        maxLoopNs = std::max(maxLoopNs, now - passStart);
+        ++loops;
+    }
+    auto hostNs = std::chrono::duration_cast<std::chrono::nanoseconds>(
+        std::chrono::steady_clock::now() - hostStart).count();
+    printf("S %llu %llu %llu %llu\n", (unsigned long long)loops, (unsigned long long)((now - loopStart) / 1000),
+           (unsigned long long)(maxLoopNs / 1000), (unsigned long long)(loops ? hostNs / loops : 0));
+    return 0;
+}
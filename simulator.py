@@ -0,0 +1,217 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from dataclasses import dataclass, field
+
+from generate import DIRECT_BUTTON_PINS, HID_KEYCODES, KEY_PRESS_MS, TYPING_SHIFT, generate_ino_file, typing_code
+
+# Скетч собирается g++ вместе с заглушками Arduino, HID-Project, Wire и SSD1306 из sim/.
+# Вместо USB и I2C они двигают виртуальные часы на оценку длительности операции на ATmega32U4
+SIM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sim")
+CXX = os.environ.get("CXX", "g++")
+CXX_FLAGS = ["-std=gnu++11", "-O1", "-w"]
+
+# Вывод кнопки энкодера; кнопки без матрицы generate_ino_file назначает на DIRECT_BUTTON_PINS
+ENCODER_KEY_PIN = 4
+HOLD_MS = KEY_PRESS_MS
+ACTION_GAP_MS = 300
+# Нажатия сдвигаются относительно периода опроса USB, иначе все задержки выходят одинаковыми
+PRESS_PHASE_MS = 0.37
+KEYBOARD_REPORTS = {"keyboard", "boot", "nkro"}
+DETENT_US = 20000
+# Символ по коду HID с битом Shift, как их печатает typeText()
+TYPED_CHARS = {typing_code(chr(c)): chr(c) for c in range(32, 127)}
+TYPED_CHARS.update({typing_code(char): char for char in "\n\t"})
+
+
+class SimulatorError(Exception):
+    pass
+
+
+@dataclass
+class Report:
+    """Отчёт HID в момент, когда хост забрал его из конечной точки."""
+    time_us: int
+    kind: str
+    data: str
+
+
+@dataclass
+class SimulationResult:
+    """Входы и отчёты симуляции в виртуальном времени и статистика проходов loop()."""
+    inputs: list = field(default_factory=list)
+    reports: list = field(default_factory=list)
+    # (время, строка), напечатанные скетчем в Serial
+    serial_output: list = field(default_factory=list)
+    loops: int = 0
+    virtual_us: int = 0
+    loop_max_us: int = 0
+    host_ns_per_loop: int = 0
+
+    @property
+    def loop_us(self):
+        return self.virtual_us / self.loops if self.loops else 0.0
+
+
+class Trace:
+    """Сценарий нажатий кнопок и поворотов энкодера; время в миллисекундах от старта."""
+
+    def __init__(self):
+        self.lines = []
+        self.end_ms = 0
+
+    def _extend(self, end_ms):
+        self.end_ms = max(self.end_ms, end_ms)
+
+    def press(self, button, at_ms, hold_ms=HOLD_MS):
+        """Нажимает кнопку button (с нуля) и отпускает через hold_ms."""
+        self.pin(DIRECT_BUTTON_PINS[button], at_ms, hold_ms)
+
+    def switch_mode(self, at_ms, hold_ms=HOLD_MS):
+        self.pin(ENCODER_KEY_PIN, at_ms, hold_ms)
+
+    def pin(self, pin, at_ms, hold_ms):
+        self.lines.append(f"{at_ms} pin {pin} 0")
+        self.lines.append(f"{at_ms + hold_ms} pin {pin} 1")
+        self._extend(at_ms + hold_ms)
+
+    def rotate(self, detents, at_ms, detent_us=DETENT_US):
+        """Поворачивает энкодер на detents щелчков, положительные - по часовой стрелке."""
+        self.lines.append(f"{at_ms} encoder {detents} {detent_us}")
+        self._extend(at_ms + abs(detents) * detent_us / 1000)
+
+    def idle(self, until_ms):
+        """Продолжает симуляцию без входов до until_ms, например пока печатается длинный текст."""
+        self._extend(until_ms)
+
+    def serial(self, text, at_ms):
+        """Передаёт текст без пробелов в USB-serial скетча."""
+        self.lines.append(f"{at_ms} serial {text}")
+        self._extend(at_ms)
+
+    def render(self, tail_ms=ACTION_GAP_MS):
+        return "\n".join(self.lines + [f"{self.end_ms + tail_ms} end"]) + "\n"
+
+
+def action_trace(modes, num_standard_buttons, gap_ms=ACTION_GAP_MS):
+    """Нажимает по очереди все кнопки каждого режима, переключая режимы кнопкой энкодера."""
+    trace = Trace()
+    at_ms = gap_ms
+    for mode_index in range(len(modes)):
+        for button in range(num_standard_buttons):
+            trace.press(button, round(at_ms + (len(trace.lines) * PRESS_PHASE_MS) % 1, 3))
+            at_ms += gap_ms
+        if mode_index < len(modes) - 1:
+            trace.switch_mode(at_ms)
+            at_ms += gap_ms
+    return trace
+
+
+def compile_firmware(ino_path, binary_path, defines=()):
+    """Собирает скетч со средой симулятора в исполняемый файл компьютера; defines - флаги -D, как при сборке."""
+    if shutil.which(CXX) is None:
+        raise SimulatorError(f"Компилятор {CXX} не найден")
+    process = subprocess.run([CXX] + CXX_FLAGS + list(defines) + ["-I", SIM_DIR, "-x", "c++", ino_path,
+                                                   os.path.join(SIM_DIR, "sim_runtime.cpp"), "-o", binary_path],
+                             capture_output=True, text=True)
+    if process.returncode != 0:
+        raise SimulatorError(process.stderr.strip()[-2000:] or f"{CXX} завершился с ошибкой")
+    return binary_path
+
+
+def run_firmware(binary_path, trace, workdir):
+    """Прогоняет сценарий через собранный скетч и возвращает SimulationResult."""
+    trace_path = os.path.join(workdir, "trace.txt")
+    with open(trace_path, "w", encoding="utf-8") as f:
+        f.write(trace.render())
+    process = subprocess.run([binary_path, trace_path], capture_output=True, text=True)
+    if process.returncode != 0:
+        raise SimulatorError(process.stderr.strip() or f"Симуляция завершилась с кодом {process.returncode}")
+
+    result = SimulationResult()
+    for line in process.stdout.splitlines():
+        parts = line.split()
+        if parts[0] == "I":
+            result.inputs.append((int(parts[1]), int(parts[2]), int(parts[3])))
+        elif parts[0] == "R":
+            result.reports.append(Report(int(parts[1]), parts[2], parts[3]))
+        elif parts[0] == "O":
+            result.serial_output.append((int(parts[1]), line.split(" ", 2)[2] if len(parts) > 2 else ""))
+        elif parts[0] == "S":
+            result.loops, result.virtual_us, result.loop_max_us, result.host_ns_per_loop = map(int, parts[1:])
+    return result
+
+
+def simulate(modes, num_standard_buttons, num_drop_buttons, trace, defines=(), **generate_options):
+    """
+    Генерирует скетч, собирает его g++ с флагами defines и прогоняет сценарий trace.
+    generate_options передаются в generate_ino_file; матрица кнопок не поддерживается:
+    заглушки не моделируют опрос строк через регистры порта.
+    """
+    if generate_options.get('matrix'):
+        raise ValueError("Симулятор поддерживает только кнопки на отдельных выводах")
+    with tempfile.TemporaryDirectory() as workdir:
+        ino_path = os.path.join(workdir, "kurs.ino")
+        generate_ino_file(modes, num_standard_buttons, num_drop_buttons, output_filename=ino_path, **generate_options)
+        binary_path = compile_firmware(ino_path, os.path.join(workdir, "kurs_sim"), defines)
+        return run_firmware(binary_path, trace, workdir)
+
+
+def _keyboard_reports(result):
+    return [report for report in result.reports if report.kind in KEYBOARD_REPORTS]
+
+
+def _press_windows(result):
+    """Нажатия кнопок действий: (время, вывод, время следующего нажатия любой кнопки)."""
+    presses = [(time_us, pin) for time_us, pin, level in result.inputs if level == 0]
+    for i, (time_us, pin) in enumerate(presses):
+        if pin in DIRECT_BUTTON_PINS:
+            yield time_us, pin, presses[i + 1][0] if i + 1 < len(presses) else float("inf")
+
+
+def press_latencies(result):
+    """
+    Задержка в мкс от нажатия кнопки действия до первого отчёта клавиатуры, забранного хостом:
+    [(вывод, задержка)].
+    Нажатия, после которых до следующего нажатия отчётов нет (кнопка без действия), пропускаются.
+    """
+    reports = _keyboard_reports(result)
+    latencies = []
+    for time_us, pin, next_us in _press_windows(result):
+        report = next((report for report in reports if time_us <= report.time_us < next_us), None)
+        if report is not None:
+            latencies.append((pin, report.time_us - time_us))
+    return latencies
+
+
+def reports_per_press(result):
+    """
+    Число отчётов клавиатуры между нажатием кнопки действия и следующим нажатием.
+    Нажатия без отчётов пропускаются.
+    """
+    reports = _keyboard_reports(result)
+    counts = []
+    for time_us, pin, next_us in _press_windows(result):
+        count = sum(1 for report in reports if time_us <= report.time_us < next_us)
+        if count:
+            counts.append(count)
+    return counts
+
+
+def typed_text(result):
+    """
+    Текст, который увидел бы хост: каждая клавиша, которой не было в предыдущем отчёте клавиатуры,
+    - нажатие символа с учётом Shift в том же отчёте. Неизвестные коды пропускаются.
+    """
+    shift_key = HID_KEYCODES['KEY_LEFT_SHIFT']
+    text = []
+    previous = set()
+    for report in _keyboard_reports(result):
+        keys = [] if report.data == "-" else list(bytes.fromhex(report.data))
+        shift = TYPING_SHIFT if shift_key in keys else 0
+        for key in keys:
+            if key not in previous and key < shift_key and (key | shift) in TYPED_CHARS:
+                text.append(TYPED_CHARS[key | shift])
+        previous = set(keys)
+    return "".join(text)
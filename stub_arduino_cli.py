@@ -0,0 +1,149 @@
+# Заменитель arduino-cli для проверки пайплайна и бенчмарков без платы и без установленного ядра.
+# Понимает board list, compile и upload с теми же аргументами, что передаёт BuildPipeline.
+# Время стадий и отказы задаются переменными окружения:
+#   STUB_STARTUP_SECONDS - загрузка настроек, индексов и ядра при запуске процесса
+#   STUB_COMPILE_SECONDS, STUB_UPLOAD_SECONDS - длительность компиляции скетча и загрузки
+#   STUB_CORE_SECONDS - сборка ядра и библиотек, если их объектов ещё нет в --build-path
+#   STUB_PORTS - порты для board list через запятую
+#   STUB_FAIL_PORTS - порты, загрузка на которые завершается ошибкой
+# "daemon" - постоянный процесс для arduino_daemon.StubDaemonBackend: запуск оплачивается один раз,
+# команды приходят строками JSON {"id", "args"} или {"id", "cancel"} на stdin и выполняются параллельно,
+# ответ - строки {"id", "line"} и завершающая {"id", "exit"} на stdout.
+import json
+import os
+import sys
+import threading
+import time
+
+FQBN = "arduino:avr:leonardo"
+
+
+def _option(args, name, default=None):
+    return args[args.index(name) + 1] if name in args else default
+
+
+def _env_list(name, default=""):
+    return [item for item in os.environ.get(name, default).split(",") if item]
+
+
+def _print_output(line):
+    print(line, flush=True)
+
+
+def _print_error(line):
+    print(line, file=sys.stderr)
+
+
+def _wait(name, cancel_event):
+    """Пауза из переменной окружения name; True, если команду отменили."""
+    seconds = float(os.environ.get(name, "0"))
+    if cancel_event is None:
+        time.sleep(seconds)
+        return False
+    return cancel_event.wait(seconds)
+
+
+def board_list(out=_print_output):
+    detected_ports = [{"port": {"address": port, "properties": {"serialNumber": f"STUB{i}"}},
+                       "matching_boards": [{"fqbn": FQBN}]}
+                      for i, port in enumerate(_env_list("STUB_PORTS", "/dev/ttyACM0"))]
+    out(json.dumps({"detected_ports": detected_ports}))
+    return 0
+
+
+def compile_sketch(args, out=_print_output, err=_print_error, cancel_event=None):
+    sketch = args[-1]
+    output_dir = _option(args, "--output-dir", os.path.join(os.path.dirname(sketch) or ".", "build"))
+    name = os.path.basename(sketch.rstrip("/\\"))
+    if not name.endswith(".ino"):
+        name += ".ino"
+    if not os.path.exists(sketch):
+        err(f"Error opening sketch: {sketch}")
+        return 1
+    build_path = _option(args, "--build-path")
+    core_archive = os.path.join(build_path, "core", "core.a") if build_path else None
+    if core_archive is None or not os.path.exists(core_archive):
+        out("Compiling core...")
+        if _wait("STUB_CORE_SECONDS", cancel_event):
+            return 1
+        if core_archive is not None:
+            os.makedirs(os.path.dirname(core_archive), exist_ok=True)
+            open(core_archive, "wb").close()
+    else:
+        out("Using previously compiled core")
+    out(f"Compiling {name} for {_option(args, '--fqbn', FQBN)}")
+    if _wait("STUB_COMPILE_SECONDS", cancel_event):
+        return 1
+    os.makedirs(output_dir, exist_ok=True)
+    for suffix in (".hex", ".elf", ".eep"):
+        with open(os.path.join(output_dir, name + suffix), "w", encoding="utf-8") as f:
+            f.write(":00000001FF\n")
+    out("Sketch uses 0 bytes (0%) of program storage space.")
+    return 0
+
+
+def upload(args, out=_print_output, err=_print_error, cancel_event=None):
+    port = _option(args, "--port")
+    out(f"Uploading to {port}")
+    if _wait("STUB_UPLOAD_SECONDS", cancel_event):
+        return 1
+    if port in _env_list("STUB_FAIL_PORTS"):
+        err(f"avrdude: ser_open(): can't open device \"{port}\"")
+        return 1
+    out("avrdude done.  Thank you.")
+    return 0
+
+
+def run_command(args, out=_print_output, err=_print_error, cancel_event=None):
+    if args[:2] == ["board", "list"]:
+        return board_list(out)
+    if args and args[0] == "compile":
+        return compile_sketch(args, out, err, cancel_event)
+    if args and args[0] == "upload":
+        return upload(args, out, err, cancel_event)
+    err(f"stub arduino-cli: неизвестная команда {' '.join(args)}")
+    return 1
+
+
+def daemon():
+    """Выполняет команды со stdin, каждую в своём потоке, пока stdin не закроется."""
+    write_lock = threading.Lock()
+    cancel_events = {}
+
+    def send(message):
+        with write_lock:
+            sys.stdout.write(json.dumps(message) + "\n")
+            sys.stdout.flush()
+
+    def execute(request_id, args, cancel_event):
+        def out(line):
+            send({"id": request_id, "line": line})
+
+        try:
+            code = run_command(args, out, out, cancel_event)
+        except Exception as e:
+            out(f"stub arduino-cli: {e}")
+            code = 1
+        cancel_events.pop(request_id, None)
+        send({"id": request_id, "exit": code})
+
+    send({"ready": True})
+    for line in sys.stdin:
+        request = json.loads(line)
+        if request.get("cancel"):
+            cancel_events.get(request["id"], threading.Event()).set()
+            continue
+        cancel_event = cancel_events[request["id"]] = threading.Event()
+        threading.Thread(target=execute, args=(request["id"], request["args"], cancel_event), daemon=True).start()
+    return 0
+
+
+def main(args):
+    time.sleep(float(os.environ.get("STUB_STARTUP_SECONDS", "0")))
+    if args[:1] == ["daemon"]:
+        return daemon()
+    return run_command(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
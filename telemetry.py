@@ -0,0 +1,185 @@
+import argparse
+import json
+import sys
+import time
+
+from generate import (TELEMETRY_BUCKETS, TELEMETRY_COUNTERS, TELEMETRY_FIRST_BUCKET_US, TELEMETRY_MAXIMA,
+                      TELEMETRY_VERSION)
+from keymap import open_connection
+
+# Прошивка, собранная с -DTELEMETRY, отвечает на TR одной строкой:
+# TLM version=1 uptimeMs=... <счётчики> <максимумы> loopHistogram=a,b,...
+TELEMETRY_COMMAND = b"TR"
+TELEMETRY_PREFIX = "TLM"
+POLL_INTERVAL = 1.0
+
+
+def loop_bucket_bounds():
+    """Границы корзин гистограммы loop() в мкс: [(от, до)], у последней корзины верхней границы нет (None)."""
+    bounds = [(0, TELEMETRY_FIRST_BUCKET_US)]
+    for bucket in range(1, TELEMETRY_BUCKETS):
+        low = TELEMETRY_FIRST_BUCKET_US << (bucket - 1)
+        bounds.append((low, low * 2 if bucket < TELEMETRY_BUCKETS - 1 else None))
+    return bounds
+
+
+def parse_telemetry(line):
+    """Разбирает строку TLM в словарь; для любой другой строки возвращает None."""
+    parts = line.strip().split()
+    if not parts or parts[0] != TELEMETRY_PREFIX:
+        return None
+    snapshot = {}
+    for part in parts[1:]:
+        name, _, value = part.partition("=")
+        if name == "loopHistogram":
+            snapshot[name] = [int(count) for count in value.split(",")]
+        else:
+            snapshot[name] = int(value)
+    if snapshot.get("version") != TELEMETRY_VERSION:
+        raise ValueError(f"Неподдерживаемая версия телеметрии: {snapshot.get('version')}")
+    missing = [name for name in ["uptimeMs", "loopHistogram"] + TELEMETRY_COUNTERS + TELEMETRY_MAXIMA
+               if name not in snapshot]
+    if missing:
+        raise ValueError(f"В строке телеметрии нет полей: {', '.join(missing)}")
+    return snapshot
+
+
+def histogram_percentile(histogram, fraction):
+    """Верхняя граница корзины, в которую попадает доля fraction проходов loop(); None - без границы."""
+    total = sum(histogram)
+    if total == 0:
+        return 0
+    seen = 0
+    for count, (_, high) in zip(histogram, loop_bucket_bounds()):
+        seen += count
+        if seen >= total * fraction:
+            return high
+    return None
+
+
+def telemetry_rates(previous, current):
+    """
+    Показатели за интервал между двумя снимками: частота опроса, действия и энкодер.
+    Без предыдущего снимка или после перезагрузки платы интервал считается от её старта.
+    Максимумы прошивка сбрасывает после каждого ответа, поэтому они уже относятся к интервалу.
+    """
+    if previous is None or current["uptimeMs"] < previous["uptimeMs"]:
+        previous = {name: 0 for name in ["uptimeMs"] + TELEMETRY_COUNTERS}
+        previous["loopHistogram"] = [0] * len(current["loopHistogram"])
+    delta = {name: current[name] - previous[name] for name in ["uptimeMs"] + TELEMETRY_COUNTERS}
+    histogram = [now - before for now, before in zip(current["loopHistogram"], previous["loopHistogram"])]
+    seconds = delta["uptimeMs"] / 1000
+    return {
+        "uptimeMs": current["uptimeMs"],
+        "intervalMs": delta["uptimeMs"],
+        "scanRateHz": round(delta["loops"] / seconds) if seconds else 0,
+        "loopAvgUs": round(delta["uptimeMs"] * 1000 / delta["loops"], 1) if delta["loops"] else None,
+        "loopP99Us": histogram_percentile(histogram, 0.99),
+        "loopMaxUs": current["loopMaxUs"],
+        "actionsQueued": delta["actionsQueued"],
+        "actionsDropped": delta["actionsDropped"],
+        "actionsDone": delta["actionsDone"],
+        "actionAvgMs": round(delta["actionMsTotal"] / delta["actionsDone"], 1) if delta["actionsDone"] else None,
+        "actionMaxMs": current["actionMsMax"],
+        "encoderDetents": delta["encoderDetents"],
+        "encoderSteps": delta["encoderSteps"],
+        "encoderSkipped": delta["encoderSkipped"],
+        "encoderDiscarded": delta["encoderDiscarded"],
+        "loopHistogram": histogram,
+    }
+
+
+def format_telemetry(rates):
+    """Краткая строка для журнала: опрос, действия и энкодер за интервал."""
+    p99 = rates["loopP99Us"]
+    return (f"[{rates['uptimeMs'] / 1000:.1f} s] scan {rates['scanRateHz']} Hz, "
+            f"loop avg {rates['loopAvgUs']} us, p99 {'<' + str(p99) if p99 is not None else '>max'} us, "
+            f"max {rates['loopMaxUs']} us; actions {rates['actionsDone']}/{rates['actionsQueued']} "
+            f"(dropped {rates['actionsDropped']}), avg {rates['actionAvgMs']} ms, max {rates['actionMaxMs']} ms; "
+            f"encoder {rates['encoderDetents']} detents, {rates['encoderSteps']} steps, "
+            f"skipped {rates['encoderSkipped']}, discarded {rates['encoderDiscarded']}")
+
+
+def _request_telemetry(connection):
+    connection.reset_input_buffer()
+    connection.write(TELEMETRY_COMMAND)
+    connection.flush()
+    reply = connection.readline().decode("ascii", errors="replace").strip()
+    if not reply:
+        raise TimeoutError("Устройство не ответило. Прошивка собрана с телеметрией?")
+    snapshot = parse_telemetry(reply)
+    if snapshot is None:
+        raise ValueError(f"Неожиданный ответ устройства: {reply}")
+    return snapshot
+
+
+def read_telemetry(port=None, connection=None):
+    """Запрашивает у платы один снимок телеметрии."""
+    connection = connection or open_connection(port)
+    try:
+        return _request_telemetry(connection)
+    finally:
+        connection.close()
+
+
+class TelemetryCollector:
+    """
+    Опрашивает плату через одно открытое соединение и считает показатели между соседними снимками.
+    Если задан output, каждый снимок с показателями дописывается в файл строкой JSON.
+    """
+
+    def __init__(self, port=None, connection=None, output=None):
+        self.port = port
+        self.connection = connection
+        self.output = output
+        self.previous = None
+
+    def poll(self):
+        if self.connection is None:
+            self.connection = open_connection(self.port)
+        try:
+            snapshot = _request_telemetry(self.connection)
+        except Exception:
+            self.close()
+            raise
+        rates = telemetry_rates(self.previous, snapshot)
+        self.previous = snapshot
+        if self.output:
+            with open(self.output, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"time": time.time(), "snapshot": snapshot, "rates": rates}) + "\n")
+        return rates
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сбор телеметрии с платы, прошитой с -DTELEMETRY")
+    parser.add_argument("--port", help="порт платы (по умолчанию - найденный Pro Micro)")
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL, help="период опроса, с")
+    parser.add_argument("--count", type=int, default=0, help="число опросов (0 - до Ctrl+C)")
+    parser.add_argument("--output", help="дописывать снимки в файл JSON Lines")
+    args = parser.parse_args()
+
+    collector = TelemetryCollector(args.port, output=args.output)
+    polls = 0
+    try:
+        while not args.count or polls < args.count:
+            print(format_telemetry(collector.poll()), flush=True)
+            polls += 1
+            if not args.count or polls < args.count:
+                time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        collector.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# Модули проекта лежат в корне репозитория, а не в пакете
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+STUB_COMMAND = [sys.executable, os.path.join(ROOT, "stub_arduino_cli.py")]
+STUB_VARIABLES = ("STUB_STARTUP_SECONDS", "STUB_COMPILE_SECONDS", "STUB_UPLOAD_SECONDS", "STUB_CORE_SECONDS",
+                  "STUB_PORTS", "STUB_FAIL_PORTS")
+
+
+@pytest.fixture
+def sketch(tmp_path, monkeypatch):
+    """Скетч во временном каталоге; кеши и журналы пайплайна пишутся туда же, заменитель без задержек."""
+    monkeypatch.chdir(tmp_path)
+    for name in STUB_VARIABLES:
+        monkeypatch.delenv(name, raising=False)
+    sketch_dir = tmp_path / "kurs"
+    sketch_dir.mkdir()
+    sketch_path = sketch_dir / "kurs.ino"
+    sketch_path.write_text("void setup() {}\nvoid loop() {}\n", encoding="utf-8")
+    return str(sketch_path)
+
+
+@pytest.fixture
+def stub_command():
+    """Команда заменителя arduino-cli для BuildPipeline и бэкендов."""
+    return list(STUB_COMMAND)
@@ -0,0 +1,96 @@
+import os
+import threading
+
+import pytest
+
+from arduino_daemon import DaemonBackend, StubDaemonBackend, _parse_cli_args, daemon_available
+from pipeline import BuildCancelled, BuildError, BuildPipeline, CliBackend
+from ports import PortCache
+
+FQBN = "arduino:avr:leonardo"
+BACKENDS = pytest.mark.parametrize("make_backend", [CliBackend, StubDaemonBackend], ids=["cli", "daemon"])
+
+
+@pytest.fixture
+def backend_factory(stub_command):
+    backends = []
+
+    def make(backend_class):
+        backend = backend_class(stub_command)
+        backends.append(backend)
+        return backend
+
+    yield make
+    for backend in backends:
+        backend.close()
+
+
+def upload_args(sketch, port="/dev/ttyA"):
+    return ["upload", "--fqbn", FQBN, "--port", port, "--input-dir", "build", sketch]
+
+
+@BACKENDS
+def test_compile_through_pipeline(sketch, tmp_path, stub_command, backend_factory, make_backend):
+    pipeline = BuildPipeline(stub_command, backend=backend_factory(make_backend),
+                             port_cache=PortCache(str(tmp_path / "ports.json")), build_dir=str(tmp_path / "build"),
+                             metrics_path=str(tmp_path / "metrics.jsonl"),
+                             trace_history_path=str(tmp_path / "traces.jsonl"))
+    result = pipeline.compile(sketch, FQBN)
+
+    assert result.success, result.error
+    assert result.compile_warm is False
+    assert os.path.exists(tmp_path / "build" / "kurs.ino.hex")
+    assert pipeline.compile(sketch, FQBN).compile_warm is True
+
+
+@BACKENDS
+def test_upload_and_board_list_output(sketch, backend_factory, make_backend):
+    backend = backend_factory(make_backend)
+    lines = []
+
+    assert backend.run(upload_args(sketch), lines.append, threading.Event()) == [
+        "Uploading to /dev/ttyA", "avrdude done.  Thank you."]
+    assert lines == ["Uploading to /dev/ttyA", "avrdude done.  Thank you."]
+    detected = backend.board_list()["detected_ports"]
+    assert [(item["port"]["address"], item["matching_boards"]) for item in detected] == [
+        ("/dev/ttyACM0", [{"fqbn": FQBN}])]
+
+
+@BACKENDS
+def test_failed_upload_raises_with_output(sketch, backend_factory, make_backend, monkeypatch):
+    monkeypatch.setenv("STUB_FAIL_PORTS", "/dev/ttyA")
+    backend = backend_factory(make_backend)
+
+    with pytest.raises(BuildError, match="can't open device \"/dev/ttyA\""):
+        backend.run(upload_args(sketch), lambda line: None, threading.Event())
+    # После ошибки тот же backend выполняет следующие команды
+    assert backend.run(upload_args(sketch, "/dev/ttyB"), lambda line: None, threading.Event())
+
+
+@BACKENDS
+def test_cancel_raises_build_cancelled(sketch, backend_factory, make_backend, monkeypatch):
+    monkeypatch.setenv("STUB_UPLOAD_SECONDS", "30")
+    backend = backend_factory(make_backend)
+    cancel_event = threading.Event()
+    threading.Timer(0.3, cancel_event.set).start()
+
+    with pytest.raises(BuildCancelled):
+        backend.run(upload_args(sketch), lambda line: None, cancel_event)
+
+
+def test_daemon_parses_pipeline_arguments():
+    options, positional = _parse_cli_args(["compile", "--fqbn", FQBN, "--build-property", "a=1",
+                                           "--build-property", "b=2", "--output-dir", "build", "kurs/kurs.ino"])
+
+    assert options == {"--fqbn": [FQBN], "--build-property": ["a=1", "b=2"], "--output-dir": ["build"]}
+    assert positional == ["kurs/kurs.ino"]
+
+
+@pytest.mark.skipif(daemon_available(), reason="grpcio и модули протокола arduino-cli установлены")
+def test_daemon_without_grpc_reports_missing_modules(sketch, stub_command):
+    backend = DaemonBackend(stub_command)
+
+    with pytest.raises(BuildError, match="grpcio"):
+        backend.run(["compile", "--fqbn", FQBN, sketch], lambda line: None, threading.Event())
+    with pytest.raises(BuildError, match="grpcio"):
+        backend.board_list()
@@ -0,0 +1,20 @@
+import json
+
+import cli
+import generate
+
+
+def test_validate_counts_telemetry_sram_like_generation(tmp_path, monkeypatch, capsys):
+    modes = {"Base": {"standard_buttons": {"button1": {"type": "Print Text", "action": "hi"}},
+                      "dropdown_buttons": {"dropdown_button1": "Volume"}}}
+    modes_path = tmp_path / "modes.json"
+    modes_path.write_text(json.dumps(modes), encoding="utf-8")
+    settings_path = tmp_path / "settings.json"
+    settings_path.write_text(json.dumps({"telemetry": False}), encoding="utf-8")
+    # Без телеметрии прошивка помещается, со счётчиками - нет, а скетч содержит их всегда
+    tables = generate.build_progmem_tables(modes, cli.DIRECT_BUTTONS)
+    sram = generate.estimate_memory(modes, tables, cli.DIRECT_BUTTONS)['sram']
+    monkeypatch.setattr(generate, "SRAM_SIZE", sram + generate.TELEMETRY_SRAM - 1)
+
+    assert cli.main(["validate", str(modes_path), "--settings", str(settings_path)]) == 1
+    assert "SRAM" in capsys.readouterr().err
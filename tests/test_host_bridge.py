@@ -0,0 +1,19 @@
+import json
+
+import host_bridge
+import upload
+
+
+def test_main_reports_several_boards(tmp_path, monkeypatch, capsys):
+    modes_path = tmp_path / "modes.json"
+    modes_path.write_text(json.dumps({"Base": {"standard_buttons": {
+        "button1": {"type": "Host Action", "action": "open https://example.com"}}}}), encoding="utf-8")
+
+    def several_boards():
+        raise ValueError("Подключено несколько плат: /dev/ttyA (SN0), /dev/ttyB (SN1). Укажите серийный номер.")
+
+    monkeypatch.setattr(upload, "find_pro_micro_port", several_boards)
+
+    assert host_bridge.main([str(modes_path), "--settings", str(tmp_path / "settings.json")]) == 1
+    err = capsys.readouterr().err
+    assert "Подключено несколько плат" in err and "--port" in err
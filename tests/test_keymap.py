@@ -0,0 +1,58 @@
+import pytest
+
+from keymap import SimulatedKeymapDevice, deserialize_keymap, push_keymap, read_keymap, serialize_modes
+
+MODES = {
+    "Editor": {
+        "standard_buttons": {
+            "button1": {"type": "Key Combination", "action": "Ctrl+C"},
+            "button2": {"type": "Key Combination", "action": "Ctrl+Shift+Esc"},
+            "button3": {"type": "Print Text", "action": "Hello, world!"},
+            "button4": {"type": "Print Text", "action": ""},
+        },
+        "dropdown_buttons": {"dropdown_button1": "Volume"},
+    },
+    "Browser": {
+        "standard_buttons": {
+            "button1": {"type": "Key Combination", "action": "Alt+F4"},
+            "button2": {"type": "Print Text", "action": "https://example.com"},
+            "button3": {"type": "Key Combination", "action": "Win+Tab"},
+            "button4": {"type": "Key Combination", "action": "F5"},
+        },
+        "dropdown_buttons": {"dropdown_button1": "Scroll"},
+    },
+}
+
+
+def test_push_and_read_round_trip():
+    device = SimulatedKeymapDevice(num_buttons=4)
+    blob = serialize_modes(MODES, 4, 1)
+
+    assert push_keymap(blob, connection=device) == 1
+    read_blob = read_keymap(connection=device)
+
+    assert read_blob == blob
+    assert deserialize_keymap(read_blob) == MODES
+
+
+def test_crc_mismatch_is_rejected():
+    device = SimulatedKeymapDevice(num_buttons=4)
+    blob = bytearray(serialize_modes(MODES, 4, 1))
+    blob[-3] ^= 0xFF
+
+    assert push_keymap(bytes(blob), connection=device) == "ERR CRC"
+    assert device.eeprom[:2] != b"KM"
+    with pytest.raises(ValueError):
+        deserialize_keymap(bytes(blob))
+
+
+def test_layout_mismatch_is_rejected():
+    device = SimulatedKeymapDevice(num_buttons=6)
+    assert push_keymap(serialize_modes(MODES, 4, 1), connection=device) == "ERR LAYOUT"
+
+
+def test_layers_are_not_serialized():
+    modes = {"Base": {"standard_buttons": {"button1": {"type": "Momentary Layer", "action": "Fn"}},
+                      "dropdown_buttons": {}}}
+    with pytest.raises(ValueError):
+        serialize_modes(modes, 4, 1)
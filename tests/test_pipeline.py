@@ -0,0 +1,81 @@
+from pipeline import BuildPipeline
+from ports import BoardPort, PortCache
+from tracing import span
+
+FQBN = "arduino:avr:leonardo"
+
+
+def make_pipeline(tmp_path, stub_command):
+    return BuildPipeline(stub_command, port_cache=PortCache(str(tmp_path / "ports.json")),
+                         build_dir=str(tmp_path / "build"), metrics_path=str(tmp_path / "metrics.jsonl"),
+                         trace_history_path=str(tmp_path / "traces.jsonl"))
+
+
+def bootloader_boards(*devices):
+    # Платы уже в загрузчике: _flash_board не сбрасывает их и не опрашивает порты через pyserial
+    return [BoardPort(device, FQBN, True, f"SN{i}") for i, device in enumerate(devices)]
+
+
+def test_fleet_flashes_all_boards(sketch, tmp_path, stub_command):
+    result = make_pipeline(tmp_path, stub_command).run_fleet(sketch, boards=bootloader_boards("/dev/ttyA",
+                                                                                               "/dev/ttyB"))
+
+    assert result.success, result.error
+    assert result.stage == "upload"
+    assert [device.device for device in result.devices] == ["/dev/ttyA", "/dev/ttyB"]
+    assert [device.serial_number for device in result.devices] == ["SN0", "SN1"]
+    assert all(device.success and not device.error for device in result.devices)
+
+
+def test_fleet_reports_each_failed_board(sketch, tmp_path, stub_command, monkeypatch):
+    monkeypatch.setenv("STUB_FAIL_PORTS", "/dev/ttyB")
+    boards = bootloader_boards("/dev/ttyA", "/dev/ttyB", "/dev/ttyC")
+    result = make_pipeline(tmp_path, stub_command).run_fleet(sketch, boards=boards, max_workers=3)
+
+    assert not result.success
+    assert result.stage == "upload"
+    assert result.error == "Не удалось прошить плат: 1 из 3"
+    by_device = {device.device: device for device in result.devices}
+    assert by_device["/dev/ttyA"].success and by_device["/dev/ttyC"].success
+    assert not by_device["/dev/ttyB"].success
+    assert "can't open device \"/dev/ttyB\"" in by_device["/dev/ttyB"].error
+
+
+def test_fleet_sequential_matches_parallel(sketch, tmp_path, stub_command, monkeypatch):
+    monkeypatch.setenv("STUB_FAIL_PORTS", "/dev/ttyA")
+    boards = bootloader_boards("/dev/ttyA", "/dev/ttyB")
+    pipeline = make_pipeline(tmp_path, stub_command)
+    parallel = pipeline.run_fleet(sketch, boards=boards)
+    sequential = pipeline.run_fleet(sketch, boards=boards, max_workers=1)
+
+    assert [(d.device, d.success) for d in parallel.devices] == [(d.device, d.success) for d in sequential.devices]
+    assert [(d.device, d.success) for d in parallel.devices] == [("/dev/ttyA", False), ("/dev/ttyB", True)]
+
+
+def test_fleet_without_boards_fails_at_detect(sketch, tmp_path, stub_command):
+    result = make_pipeline(tmp_path, stub_command).run_fleet(sketch, boards=[])
+
+    assert not result.success
+    assert result.stage == "detect"
+    assert result.error == "Платы не найдены. Проверьте подключение."
+    assert result.devices == []
+
+
+def test_fleet_workers_write_into_fleet_trace(sketch, tmp_path, stub_command):
+    pipeline = make_pipeline(tmp_path, stub_command)
+    backend_run = pipeline.backend.run
+
+    def traced_run(args, on_line, cancel_event):
+        # Как DaemonBackend или generate_ino_file: спан без явной трассы, в трассу потока
+        with span(f"backend {args[0]}"):
+            return backend_run(args, on_line, cancel_event)
+
+    pipeline.backend.run = traced_run
+    result = pipeline.run_fleet(sketch, boards=bootloader_boards("/dev/ttyA", "/dev/ttyB"))
+
+    assert result.success, result.error
+    names = [item.name for item in result.trace.spans]
+    assert names.count("backend compile") == 1
+    uploads = [item for item in result.trace.spans if item.name == "backend upload"]
+    assert len(uploads) == 2
+    assert all(item.duration is not None for item in uploads)
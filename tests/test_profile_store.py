@@ -0,0 +1,39 @@
+from profile_store import Profile, ProfileStore
+
+
+def layer(action_type, target):
+    return {"type": action_type, "action": target}
+
+
+def test_rename_updates_layer_references(tmp_path):
+    store = ProfileStore(str(tmp_path))
+    store.create("p", {
+        "Base": {"standard_buttons": {"button1": layer("Momentary Layer", "Fn"),
+                                      "button2": {"type": "Print Text", "action": "Fn",
+                                                  "hold": dict(layer("Toggle Layer", " Fn "), timeout_ms=200)}}},
+        "Fn": {"standard_buttons": {"button1": layer("Toggle Layer", "Base")}},
+        "Other": {"standard_buttons": {"button1": layer("Momentary Layer", "Base")}},
+    })
+    profile = Profile(str(tmp_path / "p"))
+
+    assert profile.rename_mode("Fn", "Function") == ["Base"]
+    assert profile.is_mode_dirty("Base") and not profile.is_mode_dirty("Other")
+    profile.save()
+
+    modes = Profile(str(tmp_path / "p")).to_dict()
+    assert list(modes) == ["Base", "Function", "Other"]
+    buttons = modes["Base"]["standard_buttons"]
+    assert buttons["button1"] == layer("Momentary Layer", "Function")
+    # Текст с именем режима не ссылка на слой и не меняется
+    assert buttons["button2"]["action"] == "Fn"
+    assert buttons["button2"]["hold"] == {"type": "Toggle Layer", "action": "Function", "timeout_ms": 200}
+    assert modes["Function"]["standard_buttons"]["button1"] == layer("Toggle Layer", "Base")
+
+
+def test_rename_without_references_writes_only_index(tmp_path):
+    store = ProfileStore(str(tmp_path))
+    store.create("p", {"A": {"standard_buttons": {}}, "B": {"standard_buttons": {}}})
+    profile = Profile(str(tmp_path / "p"))
+
+    assert profile.rename_mode("A", "C") == []
+    assert profile.save() == 1
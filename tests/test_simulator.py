@@ -0,0 +1,66 @@
+import shutil
+
+import pytest
+
+from benchmark import synthetic_modes
+from generate import TYPING_PROFILES
+from simulator import CXX, Trace, action_trace, press_latencies, reports_per_press, simulate, typed_text
+
+pytestmark = pytest.mark.skipif(shutil.which(CXX) is None, reason=f"нет компилятора {CXX}")
+
+# Пороги регрессий: хост забирает отчёт раз в 1 мс, поэтому задержка нажатия - до одного периода опроса
+# с небольшим запасом, а самый долгий проход loop() - отправка отчёта и один кусок данных дисплея
+MAX_PRESS_LATENCY_US = 1500
+MAX_LOOP_US = 3000
+
+
+def mode(buttons, encoder="Volume"):
+    return {"standard_buttons": buttons, "dropdown_buttons": {"dropdown_button1": encoder}}
+
+
+def test_press_latency_and_loop_time():
+    modes = synthetic_modes(4, 4)
+    result = simulate(modes, 4, 1, action_trace(modes, 4))
+
+    latencies = [latency for _, latency in press_latencies(result)]
+    assert len(latencies) == 16
+    assert max(latencies) <= MAX_PRESS_LATENCY_US
+    assert result.loop_max_us <= MAX_LOOP_US
+
+
+def test_key_combination_is_one_report():
+    modes = {"Keys": mode({"button1": {"type": "Key Combination", "action": "Ctrl+Shift+Esc"}})}
+    trace = Trace()
+    trace.press(0, 100)
+    result = simulate(modes, 4, 1, trace)
+
+    # Нажатие всей комбинации и отпускание
+    assert reports_per_press(result) == [2]
+
+
+@pytest.mark.parametrize("profile", list(TYPING_PROFILES))
+def test_typed_text_matches_input(profile):
+    text = "Hello, World! 1+1=2 (ok)? a_b; \"quoted\" path/to\\file"
+    modes = {"Text": mode({"button1": {"type": "Print Text", "action": text}})}
+    trace = Trace()
+    trace.press(0, 100)
+    trace.idle(100 + len(text) * 10)
+    result = simulate(modes, 4, 1, trace, typing=profile)
+
+    assert typed_text(result) == text
+
+
+def test_tap_and_hold_choose_different_actions():
+    modes = {"Base": mode({"button1": {"type": "Print Text", "action": "a",
+                                       "hold": {"type": "Momentary Layer", "action": "Fn"}},
+                           "button2": {"type": "Print Text", "action": "b"}}),
+             "Fn": mode({"button2": {"type": "Print Text", "action": "x"}})}
+    trace = Trace()
+    trace.press(0, 100, hold_ms=60)
+    trace.press(0, 500, hold_ms=600)
+    trace.press(1, 900, hold_ms=50)
+    trace.press(1, 1400, hold_ms=50)
+    result = simulate(modes, 4, 1, trace)
+
+    # Тап печатает a, под удержанием вторая кнопка берёт действие слоя, после отпускания - снова своё
+    assert typed_text(result) == "axb"
@@ -0,0 +1,219 @@
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+
+# Каждая сборка записывает спаны стадий и шагов внутри них (генерация, поиск платы, компиляция, сброс,
+# ожидание загрузчика, загрузка) в журнал: по строке JSON на сборку, хранится TRACE_HISTORY_MAX последних.
+# Любую сборку из журнала можно выгрузить трассой Chrome (chrome://tracing, ui.perfetto.dev)
+TRACE_HISTORY_PATH = os.path.join(".cache", "build_traces.jsonl")
+TRACE_HISTORY_MAX = 200
+# Стадия медленнее медианы REGRESSION_WINDOW прошлых сравнимых сборок в REGRESSION_FACTOR раз
+# и не меньше чем на REGRESSION_MIN_SECONDS считается регрессией
+REGRESSION_FACTOR = 1.5
+REGRESSION_MIN_SECONDS = 0.5
+REGRESSION_WINDOW = 10
+# Сборки сравниваются только с такими же: неудача, попадание в кеш и тёплая сборка меняют время в разы
+COMPARABLE_METADATA = ("success", "cache_hit", "compile_warm")
+
+_active = threading.local()
+
+
+@dataclass
+class Span:
+    """Отрезок времени: начало и длительность в секундах от начала трассы, поток и подробности."""
+    name: str
+    category: str
+    start: float
+    thread: str
+    duration: float = None
+    args: dict = field(default_factory=dict)
+
+
+class Tracer:
+    """
+    Трасса одной сборки. Спаны можно открывать из любого потока: параллельные загрузки партии плат
+    попадают в трассу каждая в своём потоке.
+    """
+
+    def __init__(self, name="build"):
+        self.name = name
+        self.started_at = time.time()
+        self.metadata = {}
+        self.spans = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def begin(self, name, category="step", **args):
+        span = Span(name, category, time.perf_counter() - self._origin, threading.current_thread().name, args=args)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def end(self, span, **args):
+        span.duration = time.perf_counter() - self._origin - span.start
+        span.args.update(args)
+        return span
+
+    @contextlib.contextmanager
+    def span(self, name, category="step", **args):
+        """Спан на время блока; подробности, известные только в конце, дописываются в span.args."""
+        span = self.begin(name, category, **args)
+        try:
+            yield span
+        finally:
+            self.end(span)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Делает трассу текущей для потока: в неё пишут span() модулей, которым трассу не передают."""
+        previous = getattr(_active, "tracer", None)
+        _active.tracer = self
+        try:
+            yield self
+        finally:
+            _active.tracer = previous
+
+    def stage_durations(self):
+        return {span.name: span.duration for span in self.spans
+                if span.category == "stage" and span.duration is not None}
+
+    def to_entry(self):
+        """Запись журнала: время, метаданные сборки и все законченные спаны."""
+        return {"time": self.started_at, "name": self.name, "metadata": self.metadata,
+                "spans": [asdict(span) for span in self.spans if span.duration is not None]}
+
+
+@contextlib.contextmanager
+def span(name, category="step", **args):
+    """Спан в трассе, активной в текущем потоке (Tracer.activate); без трассы ничего не записывает."""
+    tracer = getattr(_active, "tracer", None)
+    if tracer is None:
+        yield Span(name, category, 0.0, threading.current_thread().name, args=args)
+        return
+    with tracer.span(name, category, **args) as current:
+        yield current
+
+
+def chrome_trace(entry):
+    """Запись журнала в формате Trace Event: спаны - события "X" в микросекундах, потоки подписаны."""
+    threads = {}
+    events = []
+    for item in entry["spans"]:
+        tid = threads.setdefault(item["thread"], len(threads) + 1)
+        events.append({"name": item["name"], "cat": item["category"], "ph": "X", "pid": 1, "tid": tid,
+                       "ts": round(item["start"] * 1_000_000), "dur": round(item["duration"] * 1_000_000),
+                       "args": item["args"]})
+    events += [{"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": thread}}
+               for thread, tid in threads.items()]
+    events.append({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": entry["name"]}})
+    return {"traceEvents": events, "displayTimeUnit": "ms",
+            "otherData": dict(entry["metadata"], time=entry["time"])}
+
+
+def save_chrome_trace(entry, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(chrome_trace(entry), f)
+
+
+def load_history(path=TRACE_HISTORY_PATH):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def append_history(entry, path=TRACE_HISTORY_PATH, max_entries=TRACE_HISTORY_MAX):
+    """Дописывает сборку в журнал; когда записей становится вдвое больше max_entries, старые отбрасываются."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    history = load_history(path)
+    if len(history) > 2 * max_entries:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(item, ensure_ascii=False) + "\n" for item in history[-max_entries:])
+        os.replace(tmp_path, path)
+
+
+def entry_durations(entry, category="stage"):
+    """Суммарное время спанов категории по именам."""
+    durations = {}
+    for item in entry["spans"]:
+        if item["category"] == category:
+            durations[item["name"]] = durations.get(item["name"], 0.0) + item["duration"]
+    return durations
+
+
+def find_regressions(history, entry, factor=REGRESSION_FACTOR, min_seconds=REGRESSION_MIN_SECONDS,
+                     window=REGRESSION_WINDOW):
+    """
+    Стадии и шаги entry, которые заметно медленнее медианы последних window сравнимых сборок из history:
+    [{"span", "seconds", "median"}]. Сравнимые - с тем же именем и COMPARABLE_METADATA.
+    """
+    def signature(item):
+        return item["name"], tuple(item["metadata"].get(key) for key in COMPARABLE_METADATA)
+
+    previous = [item for item in history if item is not entry and signature(item) == signature(entry)]
+    regressions = []
+    for category in ("stage", "step"):
+        for name, seconds in entry_durations(entry, category).items():
+            samples = [durations[name] for durations in (entry_durations(item, category) for item in previous)
+                       if name in durations][-window:]
+            if not samples:
+                continue
+            median = statistics.median(samples)
+            if seconds > median * factor and seconds - median >= min_seconds:
+                regressions.append({"span": name, "seconds": round(seconds, 3), "median": round(median, 3)})
+    return regressions
+
+
+def format_regressions(regressions):
+    return "Медленнее обычного: " + ", ".join(
+        f"{item['span']} {item['seconds']:.1f} с (медиана {item['median']:.1f} с)" for item in regressions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Журнал времени стадий сборки и выгрузка трасс Chrome")
+    parser.add_argument("--history", default=TRACE_HISTORY_PATH, help="журнал сборок")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="время стадий последних сборок")
+    summary_parser.add_argument("--last", type=int, default=20)
+    export_parser = subparsers.add_parser("export", help="выгрузить сборку трассой Chrome")
+    export_parser.add_argument("output", help="файл трассы .json")
+    export_parser.add_argument("--index", type=int, default=-1, help="номер сборки в журнале, -1 - последняя")
+    args = parser.parse_args()
+
+    history = load_history(args.history)
+    if not history:
+        print(f"Журнал {args.history} пуст", file=sys.stderr)
+        return 1
+    if args.command == "export":
+        save_chrome_trace(history[args.index], args.output)
+        print(f"Трасса сохранена в {args.output}")
+        return 0
+
+    stages = list(dict.fromkeys(name for entry in history for name in entry_durations(entry)))
+    print(f"{'time':<20}{'name':<10}{'cache':>6}{'warm':>6}" + "".join(f"{stage:>10}" for stage in stages))
+    for i, entry in enumerate(history[-args.last:], start=max(len(history) - args.last, 0)):
+        durations = entry_durations(entry)
+        metadata = entry["metadata"]
+        row = (f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time'])):<20}{entry['name']:<10}"
+               f"{str(metadata.get('cache_hit', '-')):>6}{str(metadata.get('compile_warm', '-')):>6}")
+        row += "".join(f"{durations[stage]:>10.2f}" if stage in durations else f"{'-':>10}" for stage in stages)
+        print(row)
+        regressions = find_regressions(history[:i], entry)
+        if regressions:
+            print("    " + format_regressions(regressions))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
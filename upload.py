@@ -1,70 +1,82 @@
-import serial.tools.list_ports
-import time
+import argparse
+import sys
+
+from pipeline import BuildPipeline
+from ports import PortCache, find_board, wait_for_bootloader
+from tracing import save_chrome_trace, span
 
 
 def find_pro_micro_port():
-    ports = serial.tools.list_ports.comports()
-    for port in ports:
-        print("Найдено устройство:", port.description)
-        if "USB" in port.description or "COM4" in port.description:
-            return port.device
-    return None
+    """Порт платы, найденной по VID/PID; при нескольких платах - прошивавшейся последней."""
+    board = find_board(cache=PortCache())
+    if board is None:
+        return None
+    print("Найдено устройство:", board.device, board.serial_number or "")
+    return board.device
 
 
-def reset_pro_micro(port):
-    try:
-        with serial.Serial(port, baudrate=1200, timeout=1) as ser:
-            ser.dtr = False
-            time.sleep(0.1)
-            ser.dtr = True
-            time.sleep(0.1)
-    except Exception as e:
-        print(f"Ошибка при сбросе: {e}")
+def find_bootloader_port(timeout=8):
+    """Ждёт порт загрузчика после ports.reset_to_bootloader и возвращает его сразу после появления."""
+    with span("wait bootloader") as current:
+        board = wait_for_bootloader(timeout=timeout)
+        current.args["port"] = board.device if board else None
+    if board is None:
+        return None
+    print(f"Новый загрузочный порт: {board.device}")
+    return board.device
 
 
-def find_bootloader_port(old_port):
-    time.sleep(3)
-    ports = serial.tools.list_ports.comports()
-    for port in ports:
-        if port.device != old_port:
-            print(f"Новый загрузочный порт: {port.device}")
-            return port.device
-    return None
+def print_durations(result):
+    print("Время стадий: " + ", ".join(f"{stage} {seconds:.2f} с" for stage, seconds in result.durations.items()))
 
 
-def upload_ino_file(ino_path):
-    try:
-        import pyduinocli
+def upload_ino_file(ino_path, cache_key=None, trace_path=None):
+    """
+    Синхронная сборка и загрузка скетча. Возвращает 1 или текст ошибки.
+    trace_path - куда сохранить трассу Chrome со временем стадий (см. tracing.py).
+    """
+    result = BuildPipeline(on_stage=lambda stage: print(f"Стадия: {stage}"), on_output=print).run(
+        ino_path, cache_key=cache_key)
+    print_durations(result)
+    if trace_path:
+        save_chrome_trace(result.trace.to_entry(), trace_path)
+    if not result.success:
+        return result.error
+    print("Загрузка успешна")
+    return 1
 
-        arduino = pyduinocli.Arduino(r"tools/arduino-cli.exe")
 
-        boards = arduino.board.list()
-        if not boards['result']:
-            return "Платы не найдены. Проверьте подключение."
-        print(boards)
-        port = boards['result']['detected_ports'][0]['port']['address']
-        fqbn = boards['result']['detected_ports'][0]['matching_boards'][0]['fqbn']
+def upload_fleet(ino_path, cache_key=None, max_workers=None, trace_path=None):
+    """Компилирует скетч один раз и прошивает все подключённые платы. Возвращает FleetResult."""
+    result = BuildPipeline(on_stage=lambda stage: print(f"Стадия: {stage}"), on_output=print).run_fleet(
+        ino_path, cache_key=cache_key, max_workers=max_workers)
+    print_durations(result)
+    if trace_path:
+        save_chrome_trace(result.trace.to_entry(), trace_path)
+    for device in result.devices:
+        status = "OK" if device.success else f"ошибка: {device.error.splitlines()[-1] if device.error else ''}"
+        print(f"{device.device:<16}{device.serial_number or '':<24}{device.duration:>7.1f} с  {status}")
+    return result
 
-        compile_result = arduino.compile(sketch=ino_path, fqbn=fqbn)
-        print(compile_result)
-        if not compile_result['result']['success']:
-            print(compile_result['result']['compiler_err'])
-            return compile_result['result']['compiler_err']
 
-        upload_result = arduino.upload(sketch=ino_path, fqbn=fqbn, port=port)
-        print(upload_result)
-        if 'Found programmer' in upload_result['result']['stderr']:
-            print("Загрузка успешна")
-        else:
-            print(upload_result['result']['stderr'])
-            return upload_result['result']['stderr']
-        return 1
-    except Exception as e:
-        return e
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Сборка и загрузка скетча на Pro Micro")
+    parser.add_argument("sketch", nargs="?", default="kurs.ino", help="путь к скетчу")
+    parser.add_argument("--all", action="store_true", help="прошить все подключённые платы")
+    parser.add_argument("--trace", help="сохранить трассу Chrome со временем стадий")
+    args = parser.parse_args(argv)
+    if args.all:
+        result = upload_fleet(args.sketch, trace_path=args.trace)
+        if not result.success:
+            print("Ошибка:", result.error)
+            return 1
+    else:
+        result = upload_ino_file(args.sketch, trace_path=args.trace)
+        if result != 1:
+            print("Ошибка:", result)
+            return 1
+    return 0
 
 
 if __name__ == "__main__":
-    ino_file = "kurs.ino"
-    result = upload_ino_file(ino_file)
-    if result != 1:
-        print("Ошибка:", result)
+    sys.exit(main())